@@ -1,15 +1,61 @@
+import asyncio
+import hashlib
+import json
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
+from functools import partial
 from uuid import UUID, uuid4
-import threading
 
 import aiofiles
-from fastapi import FastAPI, HTTPException, UploadFile
+from fastapi import FastAPI, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse
+from starlette.responses import FileResponse, PlainTextResponse, StreamingResponse
 
 from document_processor import DocumentProcessor
+from utils.file_types import IMAGE_TYPES, SNIFF_BYTES, sniff_file_type
+from utils.job_queue import AsyncJobQueue, QueueFullError
+from utils.job_store import DONE, FAILED, QUEUED, RUNNING, get_job_store
+from utils.progress import hub
+from utils.result_cache import get_default_cache
+from utils.tracing import metrics, tracer
 
-app = FastAPI()
+# Finished jobs, with their input and output files, are deleted after this long.
+JOB_TTL_SECONDS = float(os.getenv("TEXIFY_JOB_TTL_HOURS", "24")) * 3600
+SWEEP_INTERVAL_SECONDS = float(os.getenv("TEXIFY_SWEEP_INTERVAL", "600"))
+# Event streams for jobs running in another worker process re-check the store this often.
+# Jobs in this process wake their streams immediately.
+EVENT_POLL_SECONDS = float(os.getenv("TEXIFY_EVENT_POLL_SECONDS", "2"))
+
+store = get_job_store()
+# SQLite calls block, so they stay off the event loop. Writes go through one
+# thread, in submission order, which keeps every job's events in order.
+store_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-store")
+
+
+async def _sweep_periodically() -> None:
+    while True:
+        try:
+            removed = await asyncio.to_thread(store.sweep, JOB_TTL_SECONDS)
+            if removed:
+                print(f"Swept {removed} expired jobs.")
+        except Exception as e:
+            print(f"Job sweep failed: {e}")
+        await asyncio.sleep(SWEEP_INTERVAL_SECONDS)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    orphans = await asyncio.to_thread(store.recover_orphans)
+    if orphans:
+        print(f"Marked {orphans} jobs interrupted by a restart as failed.")
+    sweeper = asyncio.create_task(_sweep_periodically())
+    yield
+    sweeper.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,37 +65,290 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-status = {}
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("TEXIFY_MAX_UPLOAD_MB", "200")) * 1024 * 1024
+# Most images accepted by /verbatim/pages in one submission.
+MAX_UPLOAD_PAGES = int(os.getenv("TEXIFY_MAX_UPLOAD_PAGES", "100"))
+# 0 disables sharding; long documents are then sent to the LLM in one request.
+PAGES_PER_SHARD = int(os.getenv("TEXIFY_PAGES_PER_SHARD", "8"))
+
+# Jobs are coroutines on the server's event loop, so many can be in flight at once;
+# LLM calls and asy processes are still capped globally in utils.limits.
+jobs = AsyncJobQueue(
+    workers=int(os.getenv("TEXIFY_WORKERS", "64")),
+    max_queued=int(os.getenv("TEXIFY_MAX_QUEUED", "256")),
+)
+
+
+def _queue_full_error(retry_after: int) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Server is busy, please retry later.",
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+def _check_capacity() -> None:
+    try:
+        jobs.check_capacity()
+    except QueueFullError as e:
+        raise _queue_full_error(e.retry_after)
+
+
+def _job_dir(tid: UUID) -> str:
+    """Every job writes into its own directory so concurrent figures never collide."""
+    return os.path.join("output", str(tid))
+
+
+def _publish(job_id: str, kind: str, data: dict) -> None:
+    """Records a progress event and wakes this process's streams for the job. Runs on `store_writer`."""
+    if kind == "stage":
+        store.record_stage(job_id, data["stage"], data["state"], data["seconds"], data["error"])
+    store.add_event(job_id, kind, data)
+    hub.notify(job_id)
+
+
+def _report_write_error(future) -> None:
+    if future.exception() is not None:
+        print(f"Job store write failed: {future.exception()}")
+
+
+def _publish_later(job_id: str, kind: str, data: dict) -> None:
+    """Progress handler for DocumentProcessor: queues the event without waiting on the database. Safe from any thread."""
+    store_writer.submit(_publish, job_id, kind, data).add_done_callback(_report_write_error)
+
+
+async def _write(fn, *args):
+    """Runs a job store write on `store_writer`, after every write queued before it."""
+    return await asyncio.wrap_future(store_writer.submit(fn, *args))
+
+
+async def _run_job(path: str | list[str], output_dir: str, tid: UUID) -> None:
+    job_id = str(tid)
+    await _write(store.mark_running, job_id)
+    _publish_later(job_id, "state", {"state": "processing"})
+    processor = None
+    try:
+        processor = DocumentProcessor(
+            path,
+            output_dir,
+            "verbatim",
+            bundle=True,
+            pages_per_shard=PAGES_PER_SHARD or None,
+            job_id=job_id,
+            on_event=partial(_publish_later, job_id),
+        )
+        await processor.process_async()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        await _write(store.mark_failed, job_id, error, processor.timings if processor else None)
+        await _write(_publish, job_id, FAILED, {"error": error})
+        raise
+    await _write(store.mark_done, job_id, processor.timings)
+    await _write(_publish, job_id, DONE, {"timings": processor.timings})
+
+
+async def _save_upload(
+    file: UploadFile, stem: str, allowed: tuple[str, ...] = (".pdf",) + IMAGE_TYPES
+) -> tuple[str, str]:
+    """
+    Streams an upload to `stem` plus its extension in chunks, enforcing MAX_UPLOAD_BYTES as it goes.
+
+    The file type is sniffed from the first bytes, so uploads of a type not
+    in `allowed` are rejected before anything is written.
+
+    Returns:
+        The saved path and the SHA-256 of the contents.
+    """
+    too_large = HTTPException(
+        status_code=413,
+        detail=f"Upload exceeds the {MAX_UPLOAD_BYTES // (1024 * 1024)} MB limit.",
+    )
+    # Starlette knows the size once the multipart part is spooled; fail fast when it can.
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise too_large
+
+    chunk = await file.read(max(UPLOAD_CHUNK_BYTES, SNIFF_BYTES))
+    ext = sniff_file_type(chunk)
+    if ext not in allowed:
+        if allowed == IMAGE_TYPES:
+            raise HTTPException(status_code=415, detail="Only PNG and JPEG images can be combined into one document.")
+        raise HTTPException(status_code=415, detail="Only PDF, PNG and JPEG files are supported.")
+
+    path = f"{stem}{ext}"
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(path, "wb") as out_file:
+            while chunk:
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise too_large
+                digest.update(chunk)
+                await out_file.write(chunk)
+                chunk = await file.read(UPLOAD_CHUNK_BYTES)
+    except BaseException:
+        # The file may never have been created; don't let that hide the real error.
+        with suppress(FileNotFoundError):
+            os.remove(path)
+        raise
+
+    return path, digest.hexdigest()
 
 
 @app.post("/verbatim")
 async def process_pdf(file: UploadFile):
+    # Reject before reading the upload when there is no room for another job.
+    _check_capacity()
+
+    task_id = uuid4()
+    path, sha256 = await _save_upload(file, f"input/{task_id}")
+    await _enqueue(task_id, path, path, sha256)
+    return {"tid": task_id, "sha256": sha256}
+
+
+@app.post("/verbatim/pages")
+async def process_pages(files: list[UploadFile]):
+    """Converts several photos or scans as one document, one page per image in upload order."""
+    _check_capacity()
+    if len(files) > MAX_UPLOAD_PAGES:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_UPLOAD_PAGES} pages per document.")
+
     task_id = uuid4()
-    _, ext = os.path.splitext(file.filename)
-    path = f"input/{task_id}{ext}"
-    async with aiofiles.open(path, "wb") as out_file:
-        await out_file.write(await file.read())
-    
-    status[task_id] = path
+    input_dir = f"input/{task_id}"
+    os.makedirs(input_dir)
+    paths, digests = [], []
+    try:
+        for number, file in enumerate(files, start=1):
+            path, sha256 = await _save_upload(file, f"{input_dir}/{number:03d}", IMAGE_TYPES)
+            paths.append(path)
+            digests.append(sha256)
+    except BaseException:
+        shutil.rmtree(input_dir, ignore_errors=True)
+        raise
+
+    # The document's hash covers its pages in order.
+    sha256 = hashlib.sha256("".join(digests).encode("ascii")).hexdigest()
+    # The output is named after the input folder, i.e. the task id, like single uploads.
+    await _enqueue(task_id, input_dir, paths, sha256)
+    return {"tid": task_id, "sha256": sha256, "pages": len(paths)}
+
 
-    doc = DocumentProcessor(path, "output", "verbatim")
-    thread = threading.Thread(target=doc.process)
-    thread.start()
+async def _enqueue(task_id: UUID, input_path: str, job_input: str | list[str], sha256: str) -> None:
+    """Records and queues a job whose input is saved at `input_path` (a file or folder)."""
+    # The record must exist before a worker can pick the job up and update it.
+    await _write(store.create, str(task_id), input_path, _job_dir(task_id), sha256)
+    try:
+        jobs.submit(task_id, _run_job, job_input, _job_dir(task_id), task_id)
+    except QueueFullError as e:
+        await _write(store.delete, str(task_id))
+        if os.path.isdir(input_path):
+            shutil.rmtree(input_path, ignore_errors=True)
+        else:
+            os.remove(input_path)
+        raise _queue_full_error(e.retry_after)
 
-    return {"tid": task_id}
+
+# Job store states as /status reports them.
+_STATUS_NAMES = {QUEUED: "processing", RUNNING: "processing", DONE: "done", FAILED: "failed"}
 
 
 @app.get("/status/{tid}")
 async def pdf_status(tid: UUID):
-    if tid not in status:
+    """
+    Reports a job's state as "processing", "done" or "failed".
+
+    A queued job counts as processing, as it did before jobs were queued;
+    `stages` stays empty until a worker has started it.
+    """
+    job = await asyncio.to_thread(store.get, str(tid))
+    if job is None:
         raise HTTPException(status_code=404, detail="Task not found")
 
-    if os.path.exists(f"output/{tid}.tex"):
-        return {"status": "done"}
-    else:
-        return {"status": "processing"}
+    # The store only marks a job done after its .tex and bundle are written.
+    return {
+        "status": _STATUS_NAMES[job["state"]],
+        "error": job["error"],
+        "stages": job["stages"],
+        "timings": job["timings"],
+    }
+
+
+@app.get("/events/{tid}")
+async def job_events(tid: UUID, request: Request):
+    """
+    Streams the job's progress as Server-Sent Events.
+
+    Every event is replayed from the start (or after the Last-Event-ID a
+    reconnecting client sends), then new ones are pushed as they happen.
+    The stream ends after the final 'done' or 'failed' event.
+    """
+    job_id = str(tid)
+    if await asyncio.to_thread(store.state, job_id) is None:
+        raise HTTPException(status_code=404, detail="Task not found")
+    last_event_id = request.headers.get("last-event-id", "")
+    after = int(last_event_id) if last_event_id.isdigit() else 0
+
+    async def stream():
+        nonlocal after
+        with hub.subscribe(job_id) as wake:
+            while True:
+                wake.clear()
+                for event in await asyncio.to_thread(store.events_since, job_id, after):
+                    after = event["id"]
+                    yield f"id: {event['id']}\nevent: {event['kind']}\ndata: {json.dumps(event['data'])}\n\n"
+                    if event["kind"] in (DONE, FAILED):
+                        return
+                if await request.is_disconnected():
+                    return
+                try:
+                    await asyncio.wait_for(wake.wait(), EVENT_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle connection.
+                    yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/queue")
+async def queue_metrics():
+    return jobs.metrics()
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    queue = jobs.metrics()
+    metrics.set_gauge("texify_queue_depth", queue["depth"], help_text="Jobs waiting for a worker.")
+    metrics.set_gauge("texify_jobs_active", queue["active"], help_text="Jobs currently being processed.")
+    for state, count in (await asyncio.to_thread(store.counts)).items():
+        metrics.set_gauge("texify_jobs_stored", count, help_text="Jobs in the job store, by state.", state=state)
+    for namespace, counts in get_default_cache().stats()["namespaces"].items():
+        metrics.set_gauge("texify_cache_hits", counts["hits"], help_text="Cache hits.", namespace=namespace)
+        metrics.set_gauge("texify_cache_misses", counts["misses"], help_text="Cache misses.", namespace=namespace)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/traces/{tid}")
+async def job_traces(tid: UUID):
+    return tracer.spans_for(str(tid))
+
 
 @app.get("/dl/{tid}")
-async def pdf_dl(tid: UUID):
-    path = f"output/{tid}.tex"
-    return FileResponse(path, media_type="application/octet-stream")
+async def pdf_dl(tid: UUID, fmt: str = "tex"):
+    """
+    Downloads the job's .tex file, its zip bundle, or, with TEXIFY_COMPILE_PDF=1,
+    the built PDF. 'log' is the pdflatex log of a failed build.
+    """
+    if fmt not in ("tex", "zip", "pdf", "log"):
+        raise HTTPException(status_code=400, detail="fmt must be 'tex', 'zip', 'pdf' or 'log'")
+
+    path = os.path.join(_job_dir(tid), f"{tid}.{fmt}")
+    if not os.path.exists(path):
+        if fmt == "pdf" and os.path.exists(os.path.join(_job_dir(tid), f"{tid}.log")):
+            raise HTTPException(status_code=422, detail="The PDF failed to build; see fmt=log.")
+        raise HTTPException(status_code=404, detail="Output not found")
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{tid}.{fmt}")
@@ -0,0 +1,276 @@
+# batch_processor.py
+
+import asyncio
+import glob
+import hashlib
+import json
+import math
+import os
+import time
+
+from document_processor import DocumentProcessor
+from handlers.llm_backend import LLMBackend, get_llm_backend
+from utils.file_types import IMAGE_TYPES, sniff_path
+from utils.latex_renderer import LatexRenderer
+from utils.rate_limit import BATCH, llm_priority
+
+SUPPORTED_EXTENSIONS = (".pdf", ".png", ".jpg", ".jpeg")
+
+
+def collect_inputs(specs: list[str]) -> list[str]:
+    """
+    Expands input specs into a sorted, de-duplicated list of absolute file paths.
+
+    Each spec is one of:
+        a file:       converted as-is
+        a directory:  every PDF/PNG/JPEG below it, recursively
+        a glob:       e.g. 'scans/**/*.pdf'
+        @manifest:    a text file with one spec per line; blank lines and
+                      lines starting with '#' are ignored, relative paths are
+                      resolved against the manifest's directory
+
+    Raises:
+        FileNotFoundError: If a spec matches nothing.
+    """
+    paths = set()
+    for spec in specs:
+        if spec.startswith("@"):
+            manifest = spec[1:]
+            base = os.path.dirname(os.path.abspath(manifest))
+            with open(manifest, encoding="utf-8") as f:
+                lines = [line.strip() for line in f]
+            nested = [
+                line if os.path.isabs(line) or line.startswith("@") else os.path.join(base, line)
+                for line in lines if line and not line.startswith("#")
+            ]
+            paths.update(collect_inputs(nested))
+        elif os.path.isdir(spec):
+            for root, _, names in os.walk(spec):
+                paths.update(
+                    os.path.abspath(os.path.join(root, name))
+                    for name in names if name.lower().endswith(SUPPORTED_EXTENSIONS)
+                )
+        elif os.path.isfile(spec):
+            paths.add(os.path.abspath(spec))
+        else:
+            matches = [path for path in glob.glob(spec, recursive=True) if os.path.isfile(path)]
+            if not matches:
+                raise FileNotFoundError(f"No input files match: {spec}")
+            paths.update(os.path.abspath(path) for path in matches)
+    return sorted(paths)
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _page_count(path: str) -> int:
+    if sniff_path(path) in IMAGE_TYPES:
+        return 1
+    import fitz
+
+    with fitz.open(path) as doc:
+        return len(doc)
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(pct / 100 * len(ordered))) - 1]
+
+
+class BatchProcessor:
+    """
+    Converts many documents in one process.
+
+    Documents run concurrently on one event loop and share a single LLM
+    backend, renderer and result cache, so the per-file cost is only the
+    work itself. Every finished document is appended to a JSONL progress
+    manifest; a rerun skips documents that already succeeded with the same
+    contents, so a crash never redoes completed files.
+    """
+
+    def __init__(
+        self,
+        inputs: list[str],
+        output_dir: str,
+        text_mode: str,
+        concurrency: int = 8,
+        progress_path: str | None = None,
+        resume: bool = True,
+        pages_per_shard: int | None = None,
+        max_shard_workers: int = 4,
+        incremental: bool = False,
+        compile_pdf: bool = False,
+        llm: LLMBackend | None = None,
+        renderer: LatexRenderer | None = None,
+    ):
+        """
+        Args:
+            inputs: Paths of the documents to convert; see `collect_inputs`.
+            output_dir: Every document gets its own subdirectory here.
+            text_mode: One of 'rewriting', 'summarizing' or 'verbatim'.
+            concurrency: Maximum number of documents in flight at once.
+                LLM calls and asy processes are additionally capped by utils.limits.
+            progress_path: The progress manifest. Defaults to
+                <output_dir>/batch-progress.jsonl.
+            resume: Skip documents the manifest records as done. If False,
+                the manifest is started afresh.
+            pages_per_shard: Passed on to every DocumentProcessor.
+            max_shard_workers: Passed on to every DocumentProcessor.
+            incremental: Passed on to every DocumentProcessor.
+            compile_pdf: Passed on to every DocumentProcessor.
+            llm: The backend shared by all documents. Defaults to the one
+                selected by TEXIFY_LLM_BACKEND.
+            renderer: The renderer shared by all documents.
+        """
+        self.inputs = inputs
+        self.output_dir = output_dir
+        self.text_mode = text_mode
+        self.concurrency = concurrency
+        self.progress_path = progress_path or os.path.join(output_dir, "batch-progress.jsonl")
+        self.resume = resume
+        self.pages_per_shard = pages_per_shard
+        self.max_shard_workers = max_shard_workers
+        self.incremental = incremental
+        self.compile_pdf = compile_pdf
+        self.llm = llm if llm is not None else get_llm_backend()
+        self.renderer = renderer if renderer is not None else LatexRenderer()
+        self.summary = None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+
+    def _job_dir(self, path: str) -> str:
+        """A stable per-document directory; the hash keeps equal file names in different folders apart."""
+        stem = os.path.splitext(os.path.basename(path))[0]
+        return os.path.join(self.output_dir, f"{stem}-{hashlib.sha1(path.encode('utf-8')).hexdigest()[:8]}")
+
+    def _load_progress(self) -> dict:
+        """Returns the last manifest record per input path."""
+        records = {}
+        if not self.resume:
+            if os.path.exists(self.progress_path):
+                os.remove(self.progress_path)
+            return records
+        if not os.path.exists(self.progress_path):
+            return records
+        with open(self.progress_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash mid-write can leave a truncated last line.
+                    continue
+                records[record["input"]] = record
+        return records
+
+    def _append_progress(self, record: dict) -> None:
+        with open(self.progress_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _already_done(record: dict | None, sha256: str) -> bool:
+        return (
+            record is not None
+            and record["status"] == "done"
+            and record["sha256"] == sha256
+            and os.path.exists(record["output"])
+        )
+
+    async def _process_one(self, path: str, previous: dict | None, slots: asyncio.Semaphore) -> dict:
+        async with slots:
+            sha256 = await asyncio.to_thread(_file_sha256, path)
+            if self._already_done(previous, sha256):
+                return {**previous, "status": "skipped"}
+
+            record = {"input": path, "sha256": sha256, "output": None, "pages": 0, "seconds": 0.0, "error": None}
+            start = time.perf_counter()
+            try:
+                record["pages"] = await asyncio.to_thread(_page_count, path)
+                processor = DocumentProcessor(
+                    path,
+                    self._job_dir(path),
+                    self.text_mode,
+                    pages_per_shard=self.pages_per_shard,
+                    max_shard_workers=self.max_shard_workers,
+                    incremental=self.incremental,
+                    compile_pdf=self.compile_pdf,
+                    llm=self.llm,
+                    renderer=self.renderer,
+                )
+                record["output"] = await processor.process_async()
+                record["status"] = "done"
+            except Exception as e:
+                print(f"Failed to convert {path}: {e}")
+                record["status"] = "failed"
+                record["error"] = f"{type(e).__name__}: {e}"
+            record["seconds"] = time.perf_counter() - start
+            self._append_progress(record)
+            return record
+
+    async def run_async(self) -> dict:
+        """
+        Converts every input and returns the summary report.
+
+        One document failing does not stop the others; failures are listed
+        in the report and retried on the next run.
+        """
+        previous = self._load_progress()
+        slots = asyncio.Semaphore(self.concurrency)
+        start = time.perf_counter()
+        # Batch documents yield LLM slots to interactive jobs sharing the process.
+        priority = llm_priority.set(BATCH)
+        try:
+            records = await asyncio.gather(
+                *(self._process_one(path, previous.get(path), slots) for path in self.inputs)
+            )
+        finally:
+            llm_priority.reset(priority)
+        wall = time.perf_counter() - start
+
+        converted = [r for r in records if r["status"] == "done"]
+        failed = [r for r in records if r["status"] == "failed"]
+        latencies = [r["seconds"] for r in converted]
+        pages = sum(r["pages"] for r in converted)
+        self.summary = {
+            "inputs": len(records),
+            "converted": len(converted),
+            "skipped": sum(r["status"] == "skipped" for r in records),
+            "failed": len(failed),
+            "wall_seconds": wall,
+            "documents_per_minute": len(converted) * 60 / wall if wall else 0.0,
+            "pages_per_minute": pages * 60 / wall if wall else 0.0,
+            "latency": {
+                "p50": _percentile(latencies, 50),
+                "p95": _percentile(latencies, 95),
+                "max": max(latencies, default=0.0),
+            },
+            "failures": [{"input": r["input"], "error": r["error"]} for r in failed],
+            "progress_manifest": os.path.abspath(self.progress_path),
+        }
+        with open(os.path.join(self.output_dir, "batch-summary.json"), "w", encoding="utf-8") as f:
+            json.dump(self.summary, f, indent=2)
+        return self.summary
+
+    def run(self) -> dict:
+        """Runs `run_async` on a new event loop."""
+        return asyncio.run(self.run_async())
+
+    def print_summary(self) -> None:
+        s = self.summary
+        print("\n--- Batch Summary ---")
+        print(f"  {s['converted']} converted, {s['skipped']} skipped (already done), {s['failed']} failed")
+        print(f"  {s['wall_seconds']:.1f}s wall, {s['documents_per_minute']:.1f} documents/min, "
+              f"{s['pages_per_minute']:.1f} pages/min")
+        print(f"  latency p50 {s['latency']['p50']:.1f}s, p95 {s['latency']['p95']:.1f}s")
+        for failure in s["failures"]:
+            print(f"  FAILED {failure['input']}: {failure['error']}")
+        print(f"  Progress manifest: {s['progress_manifest']}")
@@ -0,0 +1,388 @@
+# benchmarks/bench_pipeline.py
+"""
+End-to-end benchmark for the conversion pipeline.
+
+Generates a corpus of PDFs and images, runs it through DocumentProcessor (or
+the FastAPI service) with the fake LLM backend, and prints a JSON report with
+latency percentiles, throughput, peak RSS, peak thread count and a per-stage
+breakdown. Compare two reports to catch regressions.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_pipeline --jobs 20 --concurrency 4 -o bench.json
+    python -m benchmarks.bench_pipeline --async --jobs 200 --concurrency 200
+    python -m benchmarks.bench_pipeline --api --jobs 20
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz
+from PIL import Image, ImageDraw
+
+from document_processor import DocumentProcessor
+from handlers.fake_llm import FakeLLM
+from utils.latex_renderer import LatexRenderer
+from utils.result_cache import NullCache
+
+# Median seconds per call, taken from production Gemini traces. Scaled by --latency-scale.
+LLM_MEDIAN_LATENCY = {
+    "extract_text_to_latex": 8.0,
+    # Photos are converted one page per call.
+    "extract_text_from_images": 6.0,
+    "get_figure_descriptions": 5.0,
+    "generate_figure_code": 4.0,
+    "repair_figure_code": 4.0,
+}
+ASY_MEDIAN_LATENCY = 1.5
+LATENCY_SIGMA = 0.5
+
+# (pages, figures per page) for PDFs and (width, height) for photos.
+CORPUS_PDFS = [(1, 0), (1, 1), (3, 1), (8, 1), (20, 0)]
+CORPUS_IMAGES = [(1200, 1600), (3024, 4032)]
+
+
+class LatencySampler:
+    """Draws log-normal latencies per method and records them for the report."""
+
+    def __init__(self, medians: dict, scale: float, seed: int):
+        self.medians = medians
+        self.scale = scale
+        self.samples = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, method: str) -> float:
+        with self._lock:
+            median = self.medians.get(method, 1.0) * self.scale
+            delay = self._random.lognormvariate(0, LATENCY_SIGMA) * median
+            self.samples.setdefault(method, []).append(delay)
+        return delay
+
+
+class TimedRenderer(LatexRenderer):
+    """A LatexRenderer that records every asy run, optionally simulating asy itself."""
+
+    def __init__(self, simulate: bool, sampler: LatencySampler):
+        super().__init__(cache=NullCache())
+        self.simulate = simulate
+        self.sampler = sampler
+        self.compile_seconds = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fake_pdf(args, cwd):
+        pdf_name = os.path.splitext(args[-1])[0] + ".pdf"
+        with fitz.open() as doc:
+            doc.new_page(width=100, height=100)
+            doc.save(os.path.join(cwd, pdf_name))
+
+    def _run_asy(self, args, cwd, timeout):
+        start = time.perf_counter()
+        try:
+            if not self.simulate:
+                return super()._run_asy(args, cwd, timeout)
+            time.sleep(self.sampler("asy"))
+            self._fake_pdf(args, cwd)
+        finally:
+            with self._lock:
+                self.compile_seconds.append(time.perf_counter() - start)
+
+    async def _run_asy_async(self, args, cwd, timeout):
+        start = time.perf_counter()
+        try:
+            if not self.simulate:
+                return await super()._run_asy_async(args, cwd, timeout)
+            await asyncio.sleep(self.sampler("asy"))
+            self._fake_pdf(args, cwd)
+        finally:
+            with self._lock:
+                self.compile_seconds.append(time.perf_counter() - start)
+
+
+def make_corpus(corpus_dir: str) -> list[str]:
+    """Writes the benchmark inputs and returns their paths."""
+    os.makedirs(corpus_dir, exist_ok=True)
+    paths = []
+    for pages, figures in CORPUS_PDFS:
+        path = os.path.join(corpus_dir, f"doc_{pages}p_{figures}f.pdf")
+        with fitz.open() as doc:
+            for page_num in range(pages):
+                page = doc.new_page()
+                page.insert_text((72, 72), f"Problem {page_num + 1}. Prove that x^2 >= 0.", fontsize=12)
+                for line in range(20):
+                    page.insert_text((72, 100 + 14 * line), "Lorem ipsum dolor sit amet " * 3, fontsize=10)
+                for figure in range(figures):
+                    rect = fitz.Rect(150, 420 + 150 * figure, 450, 550 + 150 * figure)
+                    page.draw_rect(rect, color=(0, 0, 0))
+                    page.draw_circle((rect.tl + rect.br) / 2, 50, color=(0, 0, 1))
+            doc.save(path)
+        paths.append(path)
+
+    for width, height in CORPUS_IMAGES:
+        path = os.path.join(corpus_dir, f"photo_{width}x{height}.jpg")
+        image = Image.new("RGB", (width, height), "white")
+        draw = ImageDraw.Draw(image)
+        for line in range(0, height, 40):
+            draw.line((50, line, width - 50, line), fill=(60, 60, 60), width=2)
+        draw.ellipse((width // 4, height // 3, 3 * width // 4, 2 * height // 3), outline="black", width=6)
+        image.save(path, "JPEG", quality=90)
+        paths.append(path)
+
+    return paths
+
+
+class ResourceMonitor:
+    """Samples the live thread count in the background to find its peak."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """Nearest-rank percentile."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(values: list[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else 0.0,
+    }
+
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and bytes on macOS.
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run_pipeline(inputs: list[str], work_dir: str, args) -> dict:
+    """Runs every input through DocumentProcessor directly, on threads or with --async on one event loop."""
+    sampler = LatencySampler(
+        {**LLM_MEDIAN_LATENCY, "asy": ASY_MEDIAN_LATENCY}, args.latency_scale, args.seed
+    )
+    llm = FakeLLM(latency=sampler, failure_rate=args.failure_rate, seed=args.seed)
+    renderer = TimedRenderer(simulate=not args.real_asy, sampler=sampler)
+
+    latencies = []
+    stage_timings = {}
+    failures = 0
+    lock = threading.Lock()
+
+    def make_processor(index, path):
+        return DocumentProcessor(
+            path,
+            os.path.join(work_dir, f"job{index}"),
+            "verbatim",
+            pages_per_shard=args.pages_per_shard,
+            llm=llm,
+            renderer=renderer,
+        )
+
+    def record(index, processor, error):
+        nonlocal failures
+        with lock:
+            if error is not None:
+                print(f"Job {index} failed: {error}")
+                failures += 1
+                return
+            latencies.append(processor.timings["total"])
+            for stage, seconds in processor.timings.items():
+                stage_timings.setdefault(stage, []).append(seconds)
+
+    def run_one(job):
+        processor = make_processor(*job)
+        try:
+            processor.process()
+        except Exception as e:
+            return record(job[0], processor, e)
+        record(job[0], processor, None)
+
+    async def run_all_async(jobs):
+        slots = asyncio.Semaphore(args.concurrency)
+
+        async def run_one_async(job):
+            async with slots:
+                processor = make_processor(*job)
+                try:
+                    await processor.process_async()
+                except Exception as e:
+                    return record(job[0], processor, e)
+                record(job[0], processor, None)
+
+        await asyncio.gather(*(run_one_async(job) for job in jobs))
+
+    jobs = [(i, inputs[i % len(inputs)]) for i in range(args.jobs)]
+    with ResourceMonitor() as monitor:
+        start = time.perf_counter()
+        if args.use_async:
+            asyncio.run(run_all_async(jobs))
+        else:
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                list(executor.map(run_one, jobs))
+        wall = time.perf_counter() - start
+
+    return {
+        "wall_seconds": wall,
+        "jobs_per_second": len(latencies) / wall if wall else 0.0,
+        "failures": failures,
+        "latency": summarize(latencies),
+        "peak_threads": monitor.peak_threads,
+        "stages": {stage: summarize(values) for stage, values in stage_timings.items()},
+        "llm_calls": {
+            method: summarize(values)
+            for method, values in sampler.samples.items() if method != "asy"
+        },
+        "asy_compile": summarize(renderer.compile_seconds),
+    }
+
+
+def run_api(inputs: list[str], work_dir: str, args) -> dict:
+    """Submits every input to the FastAPI service and waits for completion."""
+    # The service builds its own backend, so configure it through the environment.
+    os.environ["TEXIFY_LLM_BACKEND"] = "fake"
+    os.environ["TEXIFY_FAKE_LATENCY"] = str(LLM_MEDIAN_LATENCY["generate_figure_code"] * args.latency_scale)
+    os.environ["TEXIFY_FAKE_FAILURE_RATE"] = str(args.failure_rate)
+    os.chdir(work_dir)
+    os.makedirs("input", exist_ok=True)
+
+    from fastapi.testclient import TestClient
+    import api
+
+    # Entering the client keeps one event loop alive, which the service's job workers run on.
+    with TestClient(api.app) as client:
+        latencies = []
+        failures = 0
+        lock = threading.Lock()
+
+        def run_one(job):
+            nonlocal failures
+            _, path = job
+            start = time.perf_counter()
+            with open(path, "rb") as f:
+                response = client.post("/verbatim", files={"file": (os.path.basename(path), f)})
+            if response.status_code != 200:
+                with lock:
+                    failures += 1
+                return
+            tid = response.json()["tid"]
+            while True:
+                state = client.get(f"/status/{tid}").json()["status"]
+                if state in ("done", "failed"):
+                    break
+                time.sleep(0.02)
+            with lock:
+                if state == "done":
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    failures += 1
+
+        jobs = [(i, inputs[i % len(inputs)]) for i in range(args.jobs)]
+        with ResourceMonitor() as monitor:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                list(executor.map(run_one, jobs))
+            wall = time.perf_counter() - start
+
+        return {
+            "wall_seconds": wall,
+            "jobs_per_second": len(latencies) / wall if wall else 0.0,
+            "failures": failures,
+            "latency": summarize(latencies),
+            "peak_threads": monitor.peak_threads,
+            "queue": client.get("/queue").json(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the conversion pipeline.")
+    parser.add_argument("--jobs", type=int, default=20, help="Number of documents to process (default: 20).")
+    parser.add_argument("--concurrency", type=int, default=4, help="Documents in flight at once (default: 4).")
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=0.05,
+        help="Multiplier on the production LLM/asy latencies (default: 0.05).",
+    )
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Injected LLM failure rate (default: 0).")
+    parser.add_argument("--pages-per-shard", type=int, default=None, help="Enable sharding with this chunk size.")
+    parser.add_argument("--real-asy", action="store_true", help="Compile figures with the real 'asy' binary.")
+    parser.add_argument("--api", action="store_true", help="Drive the FastAPI service instead of the processor.")
+    parser.add_argument(
+        "--async", dest="use_async", action="store_true", help="Run the processor's asyncio path on one event loop."
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0).")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Write the JSON report here.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="texify-bench-")
+    try:
+        inputs = make_corpus(os.path.join(work_dir, "corpus"))
+        results = run_api(inputs, work_dir, args) if args.api else run_pipeline(inputs, work_dir, args)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "config": {
+            "mode": "api" if args.api else "pipeline-async" if args.use_async else "pipeline",
+            "jobs": args.jobs,
+            "concurrency": args.concurrency,
+            "latency_scale": args.latency_scale,
+            "failure_rate": args.failure_rate,
+            "pages_per_shard": args.pages_per_shard,
+            "real_asy": args.real_asy,
+            "corpus": [os.path.basename(path) for path in inputs],
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": {**results, "peak_rss_mb": peak_rss_mb()},
+    }
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,162 @@
 # document_processor.py
 
+import asyncio
 import os
-from handlers.llm_handler import GeminiLLM
-from handlers.pdf_handler import PDFHandler
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+import aiofiles
+
+from handlers.llm_backend import DetectedFigure, LLMBackend, get_llm_backend
+from handlers.page_image import PHOTO_MAX_DIMENSION, RasterOptions
 from handlers.figure_processor import FigureProcessor
+from utils.file_types import IMAGE_TYPES, sniff_path
+from utils.latex_builder import LatexBuilder, get_latex_builder
 from utils.latex_renderer import LatexRenderer
+from utils.latex_stitcher import stitch_documents
+from utils.result_cache import ResultCache
+from utils.stage_graph import StageGraph
+from utils.tracing import current_job_id, metrics, submit_with_context
+
+# fitz and PIL take a while to import, so the modules using them are imported
+# where they are needed; the CLI and the API start without loading them.
+if TYPE_CHECKING:
+    from handlers.page_prefilter import PagePrefilter
+
+# Cache namespace for the LaTeX and figure code of pages converted before, keyed by page fingerprint.
+PAGE_FRAGMENT_NAMESPACE = "page_fragment"
 
 class DocumentProcessor:
     """Orchestrates the entire conversion process from input file to .tex output."""
 
-    def __init__(self, input_path: str, output_dir: str, text_mode: str):
-        if not os.path.exists(input_path):
-            raise FileNotFoundError(f"Input file not found: {input_path}")
-        
-        self.input_path = input_path
+    def __init__(
+        self,
+        input_path: str | list[str],
+        output_dir: str,
+        text_mode: str,
+        bundle: bool = False,
+        pages_per_shard: int | None = None,
+        max_shard_workers: int = 4,
+        llm: LLMBackend | None = None,
+        renderer: LatexRenderer | None = None,
+        job_id: str | None = None,
+        raster_options: RasterOptions | None = None,
+        raster_workers: int = int(os.getenv("TEXIFY_RASTER_WORKERS", "0")),
+        prefilter: "PagePrefilter | None" = None,
+        incremental: bool = os.getenv("TEXIFY_INCREMENTAL", "") in ("1", "true", "yes"),
+        compile_pdf: bool = os.getenv("TEXIFY_COMPILE_PDF", "") in ("1", "true", "yes"),
+        builder: LatexBuilder | None = None,
+        on_event=None,
+    ):
+        """
+        Args:
+            input_path: Path to the input image or PDF file, or a list of image
+                paths that form one document, one image per page in list order.
+            output_dir: Directory for the .tex file and its figures. Give every
+                concurrent job its own directory; figure names are only unique per job.
+            text_mode: One of 'rewriting', 'summarizing' or 'verbatim'.
+            bundle: Also pack the .tex file and its figures into a single .zip.
+            pages_per_shard: If set, split the document into chunks of this many
+                pages and process the chunks concurrently.
+            max_shard_workers: Maximum number of chunks processed at the same
+                time in each branch when sharding.
+            llm: The LLM backend to use. Defaults to the one selected by
+                TEXIFY_LLM_BACKEND (Gemini unless configured otherwise).
+            renderer: The Asymptote renderer to use.
+            job_id: Identifier attached to every trace span of this run.
+                Defaults to the input file name.
+            raster_options: Resolution and encoding of the page images sent
+                for figure detection.
+            raster_workers: Render pages in a process pool of this size (0: in-process).
+            prefilter: Decides locally which pages may hold figures; only those
+                are rendered and sent for figure detection. Defaults to a
+                PagePrefilter unless TEXIFY_PREFILTER=0.
+            incremental: Convert page by page and remember each page's result
+                by its rendered content, so a revised document only sends its
+                changed pages to the LLM and asy. Takes precedence over
+                `pages_per_shard`; does not apply to images. Defaults to TEXIFY_INCREMENTAL.
+            compile_pdf: Also build the PDF next to the .tex file. A failed
+                build is reported but does not fail the job. Defaults to TEXIFY_COMPILE_PDF.
+            builder: Builds the PDF. Defaults to the process-wide LatexBuilder.
+            on_event: Called as on_event(kind, data) with progress events, from
+                whichever thread produced them:
+                  stage    {stage, state, seconds, error} when a stage starts and ends
+                  text     {latex} the document text with figure placeholders,
+                           as soon as the text branch is done
+                  figures  {count} the number of figures about to be rendered
+                  figure   {index, total, success} when a figure finishes
+                  pdf      {success, error} when the PDF build finishes
+        """
+        input_paths = [input_path] if isinstance(input_path, str) else list(input_path)
+        if not input_paths:
+            raise ValueError("No input files given.")
+        for path in input_paths:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Input file not found: {path}")
+        # Trust the file contents over the extension.
+        self.photos = all(sniff_path(path) in IMAGE_TYPES for path in input_paths)
+        if len(input_paths) > 1 and not self.photos:
+            raise ValueError("Only PNG and JPEG images can be combined into one document.")
+
+        self.input_path = input_paths[0]
+        self.input_paths = input_paths
+        if len(input_paths) == 1:
+            self.name = os.path.splitext(os.path.basename(self.input_path))[0]
+        else:
+            # Pages usually share a folder, which names the document.
+            folders = [os.path.dirname(os.path.abspath(path)) for path in input_paths]
+            self.name = os.path.basename(os.path.commonpath(folders)) or "document"
         self.output_dir = output_dir
         self.text_mode = text_mode
+        self.bundle = bundle
+        self.pages_per_shard = pages_per_shard
+        self.max_shard_workers = max_shard_workers
+        self.job_id = job_id or self.name
+        self.raster_options = raster_options or RasterOptions()
+        self.raster_workers = raster_workers
+        if prefilter is None and os.getenv("TEXIFY_PREFILTER", "1") not in ("0", "false", "no"):
+            from handlers.page_prefilter import PagePrefilter
+            prefilter = PagePrefilter()
+        self.prefilter = prefilter
+        self.incremental = incremental
+        self.compile_pdf = compile_pdf
+        self.on_event = on_event
         self.pdf_path = ""
+        self.timings = {}
         
         os.makedirs(self.output_dir, exist_ok=True)
         
-        self.llm = GeminiLLM()
-        self.renderer = LatexRenderer()
+        self.llm = llm if llm is not None else get_llm_backend()
+        self.renderer = renderer if renderer is not None else LatexRenderer()
+        if builder is None and compile_pdf:
+            builder = get_latex_builder()
+        self.builder = builder
+
+    def _emit(self, kind: str, **data) -> None:
+        if self.on_event is None:
+            return
+        try:
+            self.on_event(kind, data)
+        except Exception as e:
+            print(f"Progress event handler failed for '{kind}': {e}")
+
+    def _emit_stage(self, stage, state, seconds, error):
+        self._emit("stage", stage=stage, state=state, seconds=seconds, error=error)
+
+    def _publish_text(self, latex_template):
+        """Streams the text branch's result before the figures are ready."""
+        self._emit("text", latex=latex_template)
 
     def _prepare_pdf(self):
-        """Ensures the input is a PDF, converting from image if necessary."""
-        filename = os.path.basename(self.input_path)
-        name, ext = os.path.splitext(filename)
-        
-        if ext.lower() in ['.jpg', '.jpeg', '.png']:
-            print("Image file detected. Converting to PDF...")
-            self.pdf_path = os.path.join(self.output_dir, f"{name}.pdf")
-            PDFHandler.convert_image_to_pdf(self.input_path, self.pdf_path)
-        elif ext.lower() == '.pdf':
-            print("PDF file detected.")
-            self.pdf_path = self.input_path
-        else:
-            raise ValueError(f"Unsupported file type: {ext}")
+        """Checks that the input is a PDF and returns its path. Images take the photo graph instead."""
+        # Trust the file contents over the extension.
+        if sniff_path(self.input_path) != '.pdf':
+            raise ValueError(f"Unsupported file type: {os.path.splitext(self.input_path)[1]}")
+        print("PDF file detected.")
+        self.pdf_path = self.input_path
+        return self.pdf_path
 
     def _validate_output(self, s):
         s = s.strip(" \n")
@@ -50,41 +170,492 @@ class DocumentProcessor:
         # Otherwise, just return the string as-is
         return s
 
-    def process(self):
-        """Executes the full document processing workflow."""
-        print("--- Starting Document Processing ---")
-        self._prepare_pdf()
+    def _rasterize(self, pdf_path):
+        from handlers.pdf_handler import PDFHandler
+        page_numbers = None
+        if self.prefilter is not None:
+            page_numbers = self.prefilter.candidate_pages(pdf_path)
 
-        # --- Text Processing Path ---
-        # The LLM can process the PDF directly, which is more robust than text extraction.
-        latex_template = self.llm.extract_text_to_latex(self.pdf_path, self.text_mode)
-        
-        # --- Figure Processing Path ---
+        pages = list(PDFHandler.render_pages(
+            pdf_path, self.raster_options, self.raster_workers, page_numbers
+        ))
+        payload = sum(len(page.data) for page in pages)
+        print(f"Rendered {len(pages)} pages ({payload / 1024:.0f} KiB encoded).")
+        return pages
+
+    def _detect_figures(self, pdf_pages_as_images):
         print("\n--- Checking for Figures ---")
-        pdf_handler = PDFHandler(self.pdf_path)
-        pdf_pages_as_images = pdf_handler.get_pages_as_images()
-        figure_descriptions = self.llm.get_figure_descriptions(pdf_pages_as_images)
-        
-        generated_figure_files = []
-        if figure_descriptions:
-            print(f"\nFound {len(figure_descriptions)} potential figures. Starting parallel processing...")
-            fig_processor = FigureProcessor(self.llm, self.renderer, self.output_dir)
-            generated_figure_files = fig_processor.process_figures_in_parallel(figure_descriptions)
-        else:
+        if not pdf_pages_as_images:
+            print("No pages with graphical content. Skipping figure detection.")
+            return []
+        figures = self.llm.get_figure_descriptions(pdf_pages_as_images)
+        return self._crop_figures(figures, pdf_pages_as_images)
+
+    async def _detect_figures_async(self, pdf_pages_as_images):
+        print("\n--- Checking for Figures ---")
+        if not pdf_pages_as_images:
+            print("No pages with graphical content. Skipping figure detection.")
+            return []
+        figures = await self.llm.get_figure_descriptions_async(pdf_pages_as_images)
+        return await asyncio.to_thread(self._crop_figures, figures, pdf_pages_as_images)
+
+    def _crop_figures(self, figures, pdf_pages_as_images):
+        from handlers.pdf_handler import crop_page_image
+        # Crop each located figure out of its page so generation sees the original drawing.
+        pages_by_number = {page.page_number: page for page in pdf_pages_as_images}
+        cropped = []
+        for figure in figures:
+            page = pages_by_number.get(figure.page_number)
+            if page is not None and figure.bbox is not None:
+                try:
+                    figure = figure._replace(crop=crop_page_image(page, figure.bbox))
+                except Exception as e:
+                    print(f"Could not crop figure on page {figure.page_number + 1}: {e}")
+            cropped.append(figure)
+        return cropped
+
+    def _figure_callback(self, figure_descriptions):
+        total = len(figure_descriptions)
+        self._emit("figures", count=total)
+        return lambda index, path: self._emit("figure", index=index + 1, total=total, success=path is not None)
+
+    def _render_figures(self, figure_descriptions):
+        if not figure_descriptions:
+            self._emit("figures", count=0)
+            print("No figures found or described. Skipping figure generation.")
+            return []
+
+        print(f"\nFound {len(figure_descriptions)} potential figures. Starting parallel processing...")
+        fig_processor = FigureProcessor(
+            self.llm, self.renderer, self.output_dir, on_figure=self._figure_callback(figure_descriptions)
+        )
+        return fig_processor.process_figures_in_parallel(figure_descriptions)
+
+    async def _render_figures_async(self, figure_descriptions):
+        if not figure_descriptions:
+            self._emit("figures", count=0)
             print("No figures found or described. Skipping figure generation.")
+            return []
+
+        print(f"\nFound {len(figure_descriptions)} potential figures. Starting parallel processing...")
+        fig_processor = FigureProcessor(
+            self.llm, self.renderer, self.output_dir, on_figure=self._figure_callback(figure_descriptions)
+        )
+        return await fig_processor.process_figures_async(figure_descriptions)
 
-        # --- Merging Path ---
+    def _merge(self, latex_template, generated_figure_files):
         print("\n--- Finalizing LaTeX Document ---")
         final_latex_doc = self.llm.merge_latex_and_figures(latex_template, generated_figure_files)
 
         # --- validate output
         print("\n--- Validating LaTeX Document ---")
-        val_final_latex_doc = self._validate_output(final_latex_doc)
+        return self._validate_output(final_latex_doc)
 
-        # --- Output ---
-        output_filename = os.path.splitext(os.path.basename(self.pdf_path))[0] + ".tex"
-        output_filepath = os.path.join(self.output_dir, output_filename)
+    def _write_output(self, val_final_latex_doc):
+        output_filepath = os.path.join(self.output_dir, f"{self.name}.tex")
         with open(output_filepath, "w", encoding='utf-8') as f:
             f.write(val_final_latex_doc)
-            
+        return output_filepath
+
+    async def _write_output_async(self, val_final_latex_doc):
+        output_filepath = os.path.join(self.output_dir, f"{self.name}.tex")
+        async with aiofiles.open(output_filepath, "w", encoding='utf-8') as f:
+            await f.write(val_final_latex_doc)
+        return output_filepath
+
+    def _bundle_output(self, output_filepath, pdf_path=None):
+        """Packs the .tex file, its figures and the PDF, if built, into a zip next to the .tex file."""
+        bundle_path = os.path.splitext(output_filepath)[0] + ".zip"
+        tmp_path = bundle_path + ".tmp"
+        figures_dir = os.path.join(self.output_dir, "figures")
+
+        with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as bundle:
+            bundle.write(output_filepath, os.path.basename(output_filepath))
+            if pdf_path:
+                bundle.write(pdf_path, os.path.basename(pdf_path))
+            if os.path.isdir(figures_dir):
+                for name in sorted(os.listdir(figures_dir)):
+                    path = os.path.join(figures_dir, name)
+                    # Skip the scratch directories of in-flight compiles.
+                    if os.path.isfile(path) and not name.startswith("."):
+                        bundle.write(path, f"figures/{name}")
+        os.replace(tmp_path, bundle_path)
+        print(f"Bundled output into: {bundle_path}")
+        return bundle_path
+
+    def _compile_pdf(self, output_filepath):
+        print("\n--- Building PDF ---")
+        return self._report_build(self.builder.build(output_filepath))
+
+    async def _compile_pdf_async(self, output_filepath):
+        print("\n--- Building PDF ---")
+        return self._report_build(await self.builder.build_async(output_filepath))
+
+    def _report_build(self, result):
+        """Publishes the outcome of the PDF build and returns the PDF path, None if it failed."""
+        self._emit("pdf", success=result.success, error=result.diagnostic)
+        return result.pdf_path
+
+    def _add_output_stages(self, graph: StageGraph, write, asynchronous: bool) -> None:
+        """Adds writing the merged document and, as configured, building its PDF and bundling it."""
+        graph.add_stage("write", write, deps=("merge",))
+        finished = ("write",)
+        if self.compile_pdf:
+            build = self._compile_pdf_async if asynchronous else self._compile_pdf
+            graph.add_stage("compile", build, deps=("write",))
+            finished = ("write", "compile")
+        if self.bundle:
+            graph.add_stage("bundle", self._bundle_output, deps=finished)
+
+    def _report_cache(self):
+        stats = self.llm.cache.stats()
+        if not stats["namespaces"]:
+            return
+        print("\n--- Cache ---")
+        for namespace, counts in stats["namespaces"].items():
+            print(f"  {namespace:<20} {counts['hits']} hits, {counts['misses']} misses")
+
+    def _extract_text(self, pdf_path):
+        return self.llm.extract_text_to_latex(pdf_path, self.text_mode)
+
+    async def _extract_text_async(self, pdf_path):
+        return await self.llm.extract_text_to_latex_async(pdf_path, self.text_mode)
+
+    def _split_into_shards(self, pdf_path):
+        from handlers.pdf_handler import PDFHandler
+        shards_dir = os.path.join(self.output_dir, "shards")
+        return PDFHandler.split_pdf(pdf_path, shards_dir, self.pages_per_shard)
+
+    def _map_shards(self, fn, shard_paths):
+        with ThreadPoolExecutor(max_workers=self.max_shard_workers) as executor:
+            futures = [submit_with_context(executor, fn, path) for path in shard_paths]
+            return [future.result() for future in futures]
+
+    async def _map_shards_async(self, fn, shard_paths):
+        slots = asyncio.Semaphore(self.max_shard_workers)
+
+        async def run(path):
+            async with slots:
+                return await fn(path)
+
+        return await asyncio.gather(*(run(path) for path in shard_paths))
+
+    def _detect_shard_figures(self, shard_path):
+        return self._detect_figures(self._rasterize(shard_path))
+
+    async def _detect_shard_figures_async(self, shard_path):
+        pages = await asyncio.to_thread(self._rasterize, shard_path)
+        return await self._detect_figures_async(pages)
+
+    def _stitch_shards(self, shard_templates, shard_descriptions):
+        print(f"\n--- Stitching {len(shard_templates)} Shards ---")
+        return stitch_documents(shard_templates, [len(d) for d in shard_descriptions])
+
+    def _build_sharded_graph(self, asynchronous: bool = False) -> StageGraph:
+        """
+        Builds the stage graph for a document split into page chunks.
+
+        Each branch fans out over the chunks, so latency follows the chunk size
+        rather than the page count. Chunk texts are stitched under one preamble
+        with their figure placeholders renumbered to match the flattened figure list.
+        """
+        if asynchronous:
+            map_shards, extract = self._map_shards_async, self._extract_text_async
+            detect, render = self._detect_shard_figures_async, self._render_figures_async
+            write = self._write_output_async
+        else:
+            map_shards, extract = self._map_shards, self._extract_text
+            detect, render = self._detect_shard_figures, self._render_figures
+            write = self._write_output
+
+        graph = StageGraph(on_event=self._emit_stage)
+        graph.add_stage("prepare", self._prepare_pdf)
+        graph.add_stage("split", self._split_into_shards, deps=("prepare",))
+        graph.add_stage("text", lambda shards: map_shards(extract, shards), deps=("split",))
+        graph.add_stage("figure_detect", lambda shards: map_shards(detect, shards), deps=("split",))
+        graph.add_stage(
+            "figure_render",
+            lambda per_shard: render([d for shard in per_shard for d in shard]),
+            deps=("figure_detect",),
+        )
+        graph.add_stage("stitch", self._stitch_shards, deps=("text", "figure_detect"))
+        graph.add_stage("preview", self._publish_text, deps=("stitch",))
+        graph.add_stage("merge", self._merge, deps=("stitch", "figure_render"))
+        self._add_output_stages(graph, write, asynchronous)
+        return graph
+
+    def _fragment_key(self, fingerprint):
+        return ResultCache.make_key(fingerprint, self.text_mode, self.llm.MODEL_NAME)
+
+    def _plan_pages(self, pdf_path):
+        """
+        Fingerprints every page and looks up what was stored for it.
+
+        Returns one (fingerprint, fragment or None) pair per page; pages
+        without a fragment have changed or were never converted.
+        """
+        from handlers.pdf_handler import PDFHandler
+        plan = [
+            (fingerprint, self.llm.cache.get_json(PAGE_FRAGMENT_NAMESPACE, self._fragment_key(fingerprint)))
+            for fingerprint in PDFHandler.page_fingerprints(pdf_path)
+        ]
+        reused = sum(fragment is not None for _, fragment in plan)
+        print(f"{len(plan) - reused} of {len(plan)} pages need converting; {reused} reused from earlier runs.")
+        for result, count in (("reused", reused), ("converted", len(plan) - reused)):
+            metrics.inc(
+                "texify_incremental_pages_total",
+                count,
+                help_text="Pages of incremental runs, by whether a stored fragment was reused.",
+                result=result,
+            )
+        return plan
+
+    def _split_changed_pages(self, pdf_path, plan):
+        from handlers.pdf_handler import PDFHandler
+        changed = [page_number for page_number, (_, fragment) in enumerate(plan) if fragment is None]
+        if not changed:
+            return []
+        return PDFHandler.split_pages(pdf_path, os.path.join(self.output_dir, "pages"), changed)
+
+    @staticmethod
+    def _assemble_pages(plan, page_templates, page_figures):
+        """
+        Lines stored pages up with the freshly converted ones.
+
+        Returns:
+            (templates, figures), one entry per page in page order. Stored
+            figures carry their code, so rendering them needs no LLM call.
+        """
+        converted = iter(zip(page_templates, page_figures))
+        templates, figures = [], []
+        for page_number, (_, fragment) in enumerate(plan):
+            if fragment is None:
+                template, detected = next(converted)
+                # Detection numbered the pages of the single-page PDF.
+                detected = [figure._replace(page_number=page_number) for figure in detected]
+            else:
+                template = fragment["latex"]
+                detected = [
+                    DetectedFigure(figure["description"], page_number, code=figure["code"])
+                    for figure in fragment["figures"]
+                ]
+            templates.append(template)
+            figures.append(detected)
+        return templates, figures
+
+    def _store_fragments(self, plan, pages, figure_files):
+        """Remembers every newly converted page whose figures all rendered."""
+        templates, figures = pages
+        offset = 0
+        for (fingerprint, fragment), template, page_figures in zip(plan, templates, figures):
+            paths = figure_files[offset:offset + len(page_figures)]
+            offset += len(page_figures)
+            # Pages with a failed figure are converted again next time.
+            if fragment is not None or None in paths:
+                continue
+            stored_figures = []
+            for figure, path in zip(page_figures, paths):
+                # The renderer leaves the code that compiled next to each figure.
+                with open(os.path.join(self.output_dir, os.path.splitext(path)[0] + ".asy")) as f:
+                    stored_figures.append({"description": figure.description, "code": f.read()})
+            self.llm.cache.put_json(
+                PAGE_FRAGMENT_NAMESPACE,
+                self._fragment_key(fingerprint),
+                {"latex": template, "figures": stored_figures},
+            )
+
+    def _build_incremental_graph(self, asynchronous: bool = False) -> StageGraph:
+        """
+        Builds the stage graph for converting a document page by page.
+
+        Pages whose fingerprint has a stored fragment reuse its LaTeX and
+        figure code; only the other pages are split out and go through text
+        extraction and figure detection, like one-page shards. Stored figures
+        are recompiled from their code, which the renderer's cache usually
+        serves without running asy.
+        """
+        if asynchronous:
+            map_shards, extract = self._map_shards_async, self._extract_text_async
+            detect, render = self._detect_shard_figures_async, self._render_figures_async
+            write = self._write_output_async
+        else:
+            map_shards, extract = self._map_shards, self._extract_text
+            detect, render = self._detect_shard_figures, self._render_figures
+            write = self._write_output
+
+        graph = StageGraph(on_event=self._emit_stage)
+        graph.add_stage("prepare", self._prepare_pdf)
+        graph.add_stage("plan", self._plan_pages, deps=("prepare",))
+        graph.add_stage("split", self._split_changed_pages, deps=("prepare", "plan"))
+        graph.add_stage("text", lambda pages: map_shards(extract, pages), deps=("split",))
+        graph.add_stage("figure_detect", lambda pages: map_shards(detect, pages), deps=("split",))
+        graph.add_stage("assemble", self._assemble_pages, deps=("plan", "text", "figure_detect"))
+        graph.add_stage("stitch", lambda pages: self._stitch_shards(*pages), deps=("assemble",))
+        graph.add_stage("preview", self._publish_text, deps=("stitch",))
+        graph.add_stage(
+            "figure_render",
+            lambda pages: render([figure for page in pages[1] for figure in page]),
+            deps=("assemble",),
+        )
+        graph.add_stage("remember", self._store_fragments, deps=("plan", "assemble", "figure_render"))
+        graph.add_stage("merge", self._merge, deps=("stitch", "figure_render"))
+        self._add_output_stages(graph, write, asynchronous)
+        return graph
+
+    def _load_photos(self):
+        """Decodes, orients, downscales and re-encodes every photo, in parallel."""
+        from handlers.pdf_handler import load_photo
+        options = self.raster_options._replace(max_dimension=PHOTO_MAX_DIMENSION)
+        with ThreadPoolExecutor(max_workers=self.max_shard_workers) as executor:
+            futures = [
+                submit_with_context(executor, load_photo, path, page_number, options)
+                for page_number, path in enumerate(self.input_paths)
+            ]
+            pages = [future.result() for future in futures]
+        payload = sum(len(page.data) for page in pages)
+        print(f"Prepared {len(pages)} page images ({payload / 1024:.0f} KiB encoded).")
+        return pages
+
+    def _extract_page_text(self, page):
+        return self.llm.extract_text_from_images([page], self.text_mode)
+
+    async def _extract_page_text_async(self, page):
+        return await self.llm.extract_text_from_images_async([page], self.text_mode)
+
+    def _build_photo_graph(self, asynchronous: bool = False) -> StageGraph:
+        """
+        Builds the stage graph for a document made of photos or scanned images.
+
+        Each image is decoded once and goes straight to text extraction and
+        figure detection, with no PDF in between. Every image is a page of its
+        own; pages are converted in parallel like one-page shards and stitched
+        back together in order.
+        """
+        if asynchronous:
+            map_pages, extract = self._map_shards_async, self._extract_page_text_async
+            detect, render = self._detect_figures_async, self._render_figures_async
+            write = self._write_output_async
+        else:
+            map_pages, extract = self._map_shards, self._extract_page_text
+            detect, render = self._detect_figures, self._render_figures
+            write = self._write_output
+
+        graph = StageGraph(on_event=self._emit_stage)
+        graph.add_stage("load", self._load_photos)
+        graph.add_stage("text", lambda pages: map_pages(extract, pages), deps=("load",))
+        graph.add_stage(
+            "figure_detect", lambda pages: map_pages(detect, [[page] for page in pages]), deps=("load",)
+        )
+        graph.add_stage("stitch", self._stitch_shards, deps=("text", "figure_detect"))
+        graph.add_stage("preview", self._publish_text, deps=("stitch",))
+        graph.add_stage(
+            "figure_render",
+            lambda per_page: render([figure for page in per_page for figure in page]),
+            deps=("figure_detect",),
+        )
+        graph.add_stage("merge", self._merge, deps=("stitch", "figure_render"))
+        self._add_output_stages(graph, write, asynchronous)
+        return graph
+
+    def _build_graph(self, asynchronous: bool = False) -> StageGraph:
+        """
+        Builds the stage graph for one document.
+
+        The text branch and the figure branch only meet at the merge, so the
+        text LLM call runs while the pages are rasterized and scanned for figures.
+        With `asynchronous`, the LLM and figure stages are coroutines for `run_async`.
+        """
+        if asynchronous:
+            extract, detect = self._extract_text_async, self._detect_figures_async
+            render, write = self._render_figures_async, self._write_output_async
+        else:
+            extract, detect = self._extract_text, self._detect_figures
+            render, write = self._render_figures, self._write_output
+
+        graph = StageGraph(on_event=self._emit_stage)
+        graph.add_stage("prepare", self._prepare_pdf)
+        # The LLM can process the PDF directly, which is more robust than text extraction.
+        graph.add_stage("text", extract, deps=("prepare",))
+        graph.add_stage("preview", self._publish_text, deps=("text",))
+        graph.add_stage("rasterize", self._rasterize, deps=("prepare",))
+        graph.add_stage("figure_detect", detect, deps=("rasterize",))
+        graph.add_stage("figure_render", render, deps=("figure_detect",))
+        graph.add_stage("merge", self._merge, deps=("text", "figure_render"))
+        self._add_output_stages(graph, write, asynchronous)
+        return graph
+
+    def _select_graph(self, asynchronous: bool = False) -> StageGraph:
+        if self.photos:
+            return self._build_photo_graph(asynchronous)
+        if self.incremental:
+            return self._build_incremental_graph(asynchronous)
+        if self.pages_per_shard:
+            return self._build_sharded_graph(asynchronous)
+        return self._build_graph(asynchronous)
+
+    def _finish_run(self, graph: StageGraph, start: float, outcome: str) -> None:
+        """Records timings and metrics for a run, whether it succeeded or not."""
+        self.timings = dict(graph.timings)
+        self.timings["total"] = time.perf_counter() - start
+        metrics.observe(
+            "texify_job_duration_seconds",
+            self.timings["total"],
+            help_text="End-to-end document processing time.",
+            status=outcome,
+        )
+        graph.report()
+        print(f"  {'total':<15} {self.timings['total']:7.2f}s")
+        self._report_cache()
+
+    def process(self) -> str:
+        """
+        Executes the full document processing workflow.
+
+        Returns:
+            The path of the written .tex file.
+        """
+        print("--- Starting Document Processing ---")
+        start = time.perf_counter()
+        job_token = current_job_id.set(self.job_id)
+
+        graph = self._select_graph()
+        outcome = "failed"
+        try:
+            results = graph.run()
+            outcome = "done"
+        finally:
+            current_job_id.reset(job_token)
+            self._finish_run(graph, start, outcome)
+
+        output_filepath = results["write"]
+        print(f"\n✅ Success! Final document saved to: {output_filepath}")
+        return output_filepath
+
+    async def process_async(self) -> str:
+        """
+        Runs the same workflow as `process` on the current event loop.
+
+        LLM calls, figure generation and `asy` compiles are awaited rather than
+        run on threads, so one loop can keep many jobs in flight. Rasterizing,
+        cropping, splitting and bundling are CPU-bound and run in the loop's
+        default executor.
+
+        Returns:
+            The path of the written .tex file.
+        """
+        print("--- Starting Document Processing ---")
+        start = time.perf_counter()
+        job_token = current_job_id.set(self.job_id)
+
+        graph = self._select_graph(asynchronous=True)
+        outcome = "failed"
+        try:
+            results = await graph.run_async()
+            outcome = "done"
+        finally:
+            current_job_id.reset(job_token)
+            self._finish_run(graph, start, outcome)
+
+        output_filepath = results["write"]
         print(f"\n✅ Success! Final document saved to: {output_filepath}")
+        return output_filepath
@@ -10,21 +10,44 @@ export default function Home() {
   const [message, setMessage] = useState<string | null>(null);
   const [task, setTask] = useState<string | null>(null);
   const [done, setDone] = useState(false);
+  const [preview, setPreview] = useState<string | null>(null);
 
   useEffect(() => {
-    const interval = setInterval(async () => {
-      if (!task) {
-        return;
-      }
-      const { status } = await fetch(`/api/status/${task}`).then((r) =>
-        r.json()
+    if (!task) {
+      return;
+    }
+    // The server pushes progress, so there is nothing to poll.
+    const events = new EventSource(`/api/events/${task}`);
+    const on = (kind: string, handler: (data: any) => void) =>
+      events.addEventListener(kind, (e) =>
+        handler(JSON.parse((e as MessageEvent).data))
       );
-      setMessage(`status: ${status}`);
-      if (status === "done") {
-        setDone(true);
+
+    on("state", ({ state }) => setMessage(`status: ${state}`));
+    on("stage", ({ stage, state }) => {
+      if (state !== "running") {
+        setMessage(`${stage}: ${state}`);
       }
-    }, 3000);
-    return () => clearInterval(interval);
+    });
+    on("text", ({ latex }) => {
+      setPreview(latex);
+      setMessage("text ready, rendering figures...");
+    });
+    on("figures", ({ count }) => setMessage(`found ${count} figures`));
+    on("figure", ({ index, total, success }) =>
+      setMessage(`figure ${index}/${total} ${success ? "rendered" : "failed"}`)
+    );
+    on("done", () => {
+      setMessage("status: done");
+      setDone(true);
+      events.close();
+    });
+    on("failed", ({ error }) => {
+      setMessage(`failed: ${error}`);
+      setTask(null);
+      events.close();
+    });
+    return () => events.close();
   }, [task]);
 
   const handleUpload = async () => {
@@ -40,12 +63,13 @@ export default function Home() {
     }).then((r) => r.json());
 
     setDone(false);
+    setPreview(null);
     setTask(tid);
     setMessage(`task ${tid} is ready to go!`);
   };
 
-  const dl = async () => {
-    fetch(`/api/dl/${task}`)
+  const dl = async (fmt: "tex" | "zip") => {
+    fetch(`/api/dl/${task}?fmt=${fmt}`)
       .then((response) => {
         if (!response.ok) {
           throw new Error("File not found or failed to fetch");
@@ -57,7 +81,7 @@ export default function Home() {
         const url = window.URL.createObjectURL(blob);
         const name = file!.name.replace(/\.[^/.]+$/, "");
         link.href = url;
-        link.download = `${name}.tex`;
+        link.download = `${name}.${fmt}`;
         link.click();
         window.URL.revokeObjectURL(url);
       });
@@ -99,11 +123,19 @@ export default function Home() {
           <Button onClick={handleUpload} disabled={!file || (file && !!task && !done)}>
             Upload
           </Button>
-          <Button onClick={dl} disabled={!done}>
+          <Button onClick={() => dl("tex")} disabled={!done}>
             Download
           </Button>
+          <Button onClick={() => dl("zip")} disabled={!done}>
+            Download with figures
+          </Button>
         </div>
         {message && <p className="mt-4 text-sm text-gray-700">{message}</p>}
+        {preview && (
+          <pre className="mt-4 max-h-64 overflow-auto rounded bg-gray-50 p-2 text-xs">
+            {preview}
+          </pre>
+        )}
       </div>
     </main>
   );
@@ -0,0 +1,168 @@
+# handlers/fake_llm.py
+
+import asyncio
+import hashlib
+import random
+import threading
+import time
+
+from .llm_backend import DetectedFigure, LLMBackend
+from .page_image import PageImage
+from utils.result_cache import NullCache, ResultCache
+
+
+class FakeLLMError(RuntimeError):
+    """Raised by FakeLLM when a call is chosen to fail."""
+
+
+class FakeLLM(LLMBackend):
+    """
+    A local, deterministic stand-in for GeminiLLM.
+
+    Responses are derived from the input only, so runs are reproducible and
+    need no API key. Latency and failures can be injected to exercise the
+    orchestration, thread pools and renderer under realistic conditions.
+    """
+
+    MODEL_NAME = "fake"
+
+    def __init__(
+        self,
+        latency=0.0,
+        failure_rate: float = 0.0,
+        figures_per_page: int = 1,
+        seed: int | None = 0,
+        cache: ResultCache | None = None,
+    ):
+        """
+        Args:
+            latency: Seconds each call sleeps. Either a number or a callable
+                taking the method name and returning seconds, e.g. to sample
+                from a distribution.
+            failure_rate: Probability in [0, 1] that a call raises FakeLLMError.
+            figures_per_page: Number of figures reported for every page.
+            seed: Seed for failure injection and sampled latencies.
+            cache: Response cache. Defaults to no caching so every call is paid.
+        """
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.figures_per_page = figures_per_page
+        self.cache = cache if cache is not None else NullCache()
+        self.calls = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self, method: str) -> tuple[float, bool]:
+        """Records the call and returns its (latency, should_fail)."""
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            fail = self._random.random() < self.failure_rate
+        delay = self.latency(method) if callable(self.latency) else self.latency
+        return delay, fail
+
+    def _call(self, method: str) -> None:
+        """Records the call, then applies the configured latency and failure injection."""
+        delay, fail = self._draw(method)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            raise FakeLLMError(f"Injected failure in {method}")
+
+    async def _call_async(self, method: str) -> None:
+        """Like `_call`, but waits on the event loop the way a real async client would."""
+        delay, fail = self._draw(method)
+        if delay:
+            await asyncio.sleep(delay)
+        if fail:
+            raise FakeLLMError(f"Injected failure in {method}")
+
+    def extract_text_to_latex(self, pdf_path: str, mode: str) -> str:
+        self._call("extract_text_to_latex")
+        return self._latex_for(pdf_path, mode)
+
+    async def extract_text_to_latex_async(self, pdf_path: str, mode: str) -> str:
+        await self._call_async("extract_text_to_latex")
+        return self._latex_for(pdf_path, mode)
+
+    def extract_text_from_images(self, pages: list[PageImage], mode: str) -> str:
+        self._call("extract_text_from_images")
+        return self._latex_for_pages(len(pages), mode)
+
+    async def extract_text_from_images_async(self, pages: list[PageImage], mode: str) -> str:
+        await self._call_async("extract_text_from_images")
+        return self._latex_for_pages(len(pages), mode)
+
+    def _latex_for(self, pdf_path: str, mode: str) -> str:
+        import fitz
+
+        with fitz.open(pdf_path) as doc:
+            return self._latex_for_pages(len(doc), mode)
+
+    def _latex_for_pages(self, page_count: int, mode: str) -> str:
+        lines = [
+            "\\documentclass{article}",
+            "\\usepackage{amsmath}",
+            "\\usepackage{amssymb}",
+            "\\usepackage{amsfonts}",
+            "\\usepackage{xcolor}",
+            "\\usepackage{graphics}",
+            "\\begin{document}",
+        ]
+        figure = 0
+        for page in range(page_count):
+            lines.append(f"\\section*{{Page {page + 1} ({mode})}}")
+            lines.append("Let $f(x) = x^2$. Then $f'(x) = 2x$.")
+            for _ in range(self.figures_per_page):
+                figure += 1
+                lines.append(f"%%FIGURE_PLACEHOLDER_{figure}%%")
+        lines.append("\\end{document}")
+        return "\n".join(lines)
+
+    def get_figure_descriptions(self, pdf_images: list[PageImage]) -> list[DetectedFigure]:
+        self._call("get_figure_descriptions")
+        return self._figures_for(pdf_images)
+
+    async def get_figure_descriptions_async(self, pdf_images: list[PageImage]) -> list[DetectedFigure]:
+        await self._call_async("get_figure_descriptions")
+        return self._figures_for(pdf_images)
+
+    def _figures_for(self, pdf_images: list[PageImage]) -> list[DetectedFigure]:
+        figures = []
+        for image in pdf_images:
+            band = 1 / self.figures_per_page if self.figures_per_page else 1
+            for n in range(self.figures_per_page):
+                figures.append(DetectedFigure(
+                    f"A diagram on page {image.page_number + 1}, number {n + 1}.",
+                    image.page_number,
+                    (0.2, n * band + 0.1 * band, 0.8, (n + 1) * band - 0.1 * band),
+                ))
+        return figures
+
+    def generate_figure_code(
+        self, description: str, image: PageImage | None = None
+    ) -> str:
+        self._call("generate_figure_code")
+        return self._code_for(description)
+
+    async def generate_figure_code_async(
+        self, description: str, image: PageImage | None = None
+    ) -> str:
+        await self._call_async("generate_figure_code")
+        return self._code_for(description)
+
+    @staticmethod
+    def _code_for(description: str) -> str:
+        label = hashlib.sha256(description.encode("utf-8")).hexdigest()[:8]
+        return f'size(100);\ndraw(unitcircle);\nlabel("{label}", (0,0));'
+
+    def repair_figure_code(
+        self, description: str, code: str, diagnostic: str, image: PageImage | None = None
+    ) -> str:
+        self._call("repair_figure_code")
+        return self._code_for(description)
+
+    async def repair_figure_code_async(
+        self, description: str, code: str, diagnostic: str, image: PageImage | None = None
+    ) -> str:
+        await self._call_async("repair_figure_code")
+        return self._code_for(description)
@@ -1,89 +1,249 @@
 # handlers/figure_processor.py
 
+import asyncio
 import os
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from .llm_handler import GeminiLLM
+from .llm_backend import DetectedFigure, LLMBackend
+from utils.asy_diagnostics import check_asymptote
 from utils.latex_renderer import LatexRenderer
+from utils.limits import MAX_FIGURE_WORKERS
+from utils.result_cache import ResultCache
+from utils.tracing import metrics, submit_with_context, tracer
+
+# Cache namespace for Asymptote code that compiled, keyed by figure. This is the
+# only figure code cached: a raw generation may not compile and must not be replayed.
+KNOWN_GOOD_NAMESPACE = "figure_code_good"
 
 class FigureProcessor:
-    """Processes figure descriptions in parallel to generate and render them."""
+    """Processes detected figures in parallel to generate and render them."""
     
     MAX_RENDER_ATTEMPTS = 3 # Reduced for quicker failure
+    # Wall-clock seconds one figure may spend on generating, repairing and compiling.
+    FIGURE_BUDGET = float(os.getenv("TEXIFY_FIGURE_BUDGET", "180"))
 
-    def __init__(self, llm_handler: GeminiLLM, renderer: LatexRenderer, output_dir: str):
+    def __init__(self, llm_handler: LLMBackend, renderer: LatexRenderer, output_dir: str, on_figure=None):
+        """
+        Args:
+            on_figure: Optional callback, called as on_figure(index, path) as each
+                figure finishes; `path` is None if it could not be rendered.
+        """
         self.llm = llm_handler
+        self.on_figure = on_figure
         self.renderer = renderer
         self.figures_output_dir = os.path.join(output_dir, 'figures')
         os.makedirs(self.figures_output_dir, exist_ok=True)
 
-    def _process_single_figure(self, index: int, description: str) -> str | None:
+    def _process_single_figure(self, index: int, figure: DetectedFigure) -> str | None:
         """
         Generates and renders code for a single figure. Includes a retry loop.
         
         Returns:
             The relative path to the generated .tex file on success, otherwise None.
         """
+        with tracer.span("figure", figure=index + 1, cropped=figure.crop is not None) as span:
+            result, attempts = self._render_with_retries(index, figure)
+            return self._record_result(span, index, figure, result, attempts)
 
-        current_description = description
-        for attempt in range(self.MAX_RENDER_ATTEMPTS):
-            print(f"Processing figure {index+1}, attempt {attempt+1}...")
-            # Step 1: Generate Asymptote code from description
-            asy_code = self.llm.generate_figure_code(current_description)
-            
-            if not asy_code:
-                print(f"LLM failed to generate code for figure {index+1}.")
-                continue
-
-            # Step 2: Render the generated code
-            filename_base = f"figure{index+1}"
-
-            try:
-                success = self.renderer.compile_asymptote(
-                    asy_code, self.figures_output_dir, filename_base
-                )
-
-                if success:
-                    # On success, save the source .asy file and return the path for the .tex file
-                    asy_filepath = os.path.join(self.figures_output_dir, f"{filename_base}.asy")
-                    with open(asy_filepath, "w") as f:
-                        f.write(asy_code) # Overwrite with the successful code
-                    
-                    # The path to be used in the \input command, with forward slashes for TeX
-                    relative_path = os.path.join('figures', f"{filename_base}.pdf")
-                    return relative_path.replace(os.sep, '/')
-
-            except Exception as e:
-                current_description = description + "\n" + asy_code + "\nError: " + str(e)
-            
-#            if success:
-#                # On success, save the source .asy file and return the path for the .tex file
-#                asy_filepath = os.path.join(self.figures_output_dir, f"{filename_base}.asy")
-#                with open(asy_filepath, "w") as f:
-#                    f.write(asy_code) # Overwrite with the successful code
-#                
-#                # The path to be used in the \input command, with forward slashes for TeX
-#                relative_path = os.path.join('figures', f"{filename_base}.pdf")
-#                return relative_path.replace(os.sep, '/')
-
-        print(f"Failed to generate and render figure {index+1} after {self.MAX_RENDER_ATTEMPTS} attempts.")
-        return None
-
-    def process_figures_in_parallel(self, descriptions: list[str]) -> list[str]:
+    async def _process_single_figure_async(self, index: int, figure: DetectedFigure) -> str | None:
+        """Async form of `_process_single_figure`."""
+        with tracer.span("figure", figure=index + 1, cropped=figure.crop is not None) as span:
+            result, attempts = await self._render_with_retries_async(index, figure)
+            return self._record_result(span, index, figure, result, attempts)
+
+    def _record_result(
+        self, span, index: int, figure: DetectedFigure, result: str | None, attempts: int
+    ) -> str | None:
+        """Reports the outcome to `on_figure`, the figure span and the attempts histogram."""
+        cropped = figure.crop is not None
+        if self.on_figure is not None:
+            self.on_figure(index, result)
+        span.set("attempts", attempts)
+        span.set("success", result is not None)
+        metrics.observe(
+            "texify_figure_attempts",
+            attempts,
+            help_text="Generate/compile attempts needed per figure.",
+            buckets=tuple(range(1, self.MAX_RENDER_ATTEMPTS + 1)),
+            success=str(result is not None).lower(),
+            cropped=str(cropped).lower(),
+        )
+        return result
+
+    def _known_good_key(self, figure: DetectedFigure) -> str:
+        """Cache key for code that is known to compile for this figure."""
+        return ResultCache.make_key(
+            self.llm.MODEL_NAME, figure.description, figure.crop.data if figure.crop is not None else b""
+        )
+
+    def _screen(self, index: int, code: str, failed: set[str]) -> tuple[str | None, bool]:
+        """
+        Checks a candidate before it is compiled. Returns (diagnostic, abort).
+
+        A diagnostic means the code is broken without running asy. Code that
+        already failed means repairs have stopped making progress, so the
+        remaining attempts would be wasted.
         """
-        Uses a thread pool to process all figure descriptions concurrently.
+        if code in failed:
+            print(f"Figure {index+1}: the model returned code that already failed; giving up.")
+            self._count_attempt("repeated")
+            return None, True
+        diagnostic = check_asymptote(code)
+        if diagnostic is not None:
+            print(f"Figure {index+1} failed the syntax check: {diagnostic}")
+            self._count_attempt("precheck_failed")
+        return diagnostic, False
+
+    def _finish(self, index: int, figure: DetectedFigure, code: str, filename_base: str) -> str:
+        """Remembers code that compiled and returns the figure's path for \\includegraphics."""
+        self.llm.cache.put_json(KNOWN_GOOD_NAMESPACE, self._known_good_key(figure), code)
+        self._count_attempt("compiled")
+        # The path to be used in the \includegraphics command, with forward slashes for TeX
+        relative_path = os.path.join('figures', f"{filename_base}.pdf")
+        return relative_path.replace(os.sep, '/')
+
+    @staticmethod
+    def _count_attempt(result: str) -> None:
+        metrics.inc(
+            "texify_figure_attempt_results_total",
+            help_text="Figure attempts by outcome; only 'compiled' and 'compile_failed' ran asy.",
+            result=result,
+        )
+
+    def _attempts(self, index: int, figure: DetectedFigure, asy_code: str | None):
+        """
+        The generate/compile retry loop, as a generator of the calls it needs.
+
+        It yields ("generate",), ("repair", code, diagnostic) or
+        ("compile", code, timeout), is sent each call's result and returns
+        (relative path or None, attempts used). `_render_with_retries` and its
+        async form make the calls, so the retry policy exists once.
+
+        The first attempt uses `asy_code`, the figure's own code or code that
+        compiled for it before, if any. After a failure the model gets the
+        failed code and a short diagnostic to repair, rather than starting
+        over. Code is screened locally before it is compiled, and the loop stops
+        early once FIGURE_BUDGET seconds are spent or a retry cannot help.
+        """
+        filename_base = f"figure{index+1}"
+        deadline = time.monotonic() + self.FIGURE_BUDGET
+        diagnostic = None
+        previous_code = None
+        failed = set()
+        attempt = 0
+        while attempt < self.MAX_RENDER_ATTEMPTS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"Figure {index+1} ran out of its {self.FIGURE_BUDGET:.0f}s budget.")
+                break
+            attempt += 1
+            print(f"Processing figure {index+1}, attempt {attempt}...")
+            with tracer.span("figure.attempt", figure=index + 1, attempt=attempt) as span:
+                if asy_code is not None:
+                    span.set("source", "known_good")
+                elif diagnostic is None:
+                    span.set("source", "generate")
+                    asy_code = yield ("generate",)
+                else:
+                    span.set("source", "repair")
+                    asy_code = yield ("repair", previous_code, diagnostic)
+
+                if not asy_code:
+                    print(f"LLM failed to generate code for figure {index+1}.")
+                    self._count_attempt("empty")
+                    asy_code, diagnostic = None, None
+                    continue
+
+                diagnostic, abort = self._screen(index, asy_code, failed)
+                if abort:
+                    break
+                if diagnostic is None:
+                    result = yield ("compile", asy_code, min(self.renderer.COMPILE_TIMEOUT, remaining))
+                    span.set("success", result.success)
+                    if result:
+                        # compile_asymptote has already left this code next to the PDF.
+                        return self._finish(index, figure, asy_code, filename_base), attempt
+                    self._count_attempt("compile_failed")
+                    if not result.retryable:
+                        break
+                    diagnostic = result.diagnostic
+
+            failed.add(asy_code)
+            previous_code, asy_code = asy_code, None
+
+        print(f"Failed to generate and render figure {index+1} after {attempt} attempts.")
+        return None, attempt
+
+    def _render_with_retries(self, index: int, figure: DetectedFigure) -> tuple[str | None, int]:
+        """Runs `_attempts` on this thread. Returns (relative path or None, attempts used)."""
+        known_good = figure.code or self.llm.cache.get_json(KNOWN_GOOD_NAMESPACE, self._known_good_key(figure))
+        attempts = self._attempts(index, figure, known_good)
+        try:
+            request = next(attempts)
+            while True:
+                kind, *args = request
+                try:
+                    if kind == "generate":
+                        result = self.llm.generate_figure_code(figure.description, image=figure.crop)
+                    elif kind == "repair":
+                        result = self.llm.repair_figure_code(figure.description, *args, image=figure.crop)
+                    else:
+                        result = self.renderer.compile_asymptote(
+                            args[0], self.figures_output_dir, f"figure{index+1}", timeout=args[1]
+                        )
+                except Exception as e:
+                    # Raised inside the loop too, so the attempt's span records it.
+                    attempts.throw(e)
+                    raise
+                request = attempts.send(result)
+        except StopIteration as done:
+            return done.value
+
+    async def _render_with_retries_async(self, index: int, figure: DetectedFigure) -> tuple[str | None, int]:
+        """Async form of `_render_with_retries`."""
+        known_good = figure.code or await asyncio.to_thread(
+            self.llm.cache.get_json, KNOWN_GOOD_NAMESPACE, self._known_good_key(figure)
+        )
+        attempts = self._attempts(index, figure, known_good)
+        try:
+            request = next(attempts)
+            while True:
+                kind, *args = request
+                try:
+                    if kind == "generate":
+                        result = await self.llm.generate_figure_code_async(figure.description, image=figure.crop)
+                    elif kind == "repair":
+                        result = await self.llm.repair_figure_code_async(figure.description, *args, image=figure.crop)
+                    else:
+                        result = await self.renderer.compile_asymptote_async(
+                            args[0], self.figures_output_dir, f"figure{index+1}", timeout=args[1]
+                        )
+                except Exception as e:
+                    attempts.throw(e)
+                    raise
+                request = attempts.send(result)
+        except StopIteration as done:
+            return done.value
+
+    def process_figures_in_parallel(self, figures: list[DetectedFigure]) -> list[str | None]:
+        """
+        Uses a thread pool to process all detected figures concurrently.
         
         Args:
-            descriptions: A list of figure descriptions.
+            figures: The detected figures, each with its description and, when
+                it could be located, a crop of the original drawing.
         
         Returns:
-            A list of file paths for successfully generated figures.
+            One file path per figure, in input order; None for figures that
+            could not be rendered, so the rest keep their placeholder numbers.
         """
-        successful_figures = [None] * len(descriptions)
+        successful_figures = [None] * len(figures)
         
-        with ThreadPoolExecutor() as executor:
+        # Bounded per job; LLM calls and asy processes are also capped globally in utils.limits.
+        with ThreadPoolExecutor(max_workers=MAX_FIGURE_WORKERS) as executor:
             future_to_index = {
-                executor.submit(self._process_single_figure, i, desc): i
-                for i, desc in enumerate(descriptions)
+                submit_with_context(executor, self._process_single_figure, i, figure): i
+                for i, figure in enumerate(figures)
             }
             
             for future in as_completed(future_to_index):
@@ -99,5 +259,28 @@ class FigureProcessor:
                 except Exception as e:
                     print(f"Error processing figure {index+1}: {e}")
 
-        # Filter out None values from failed processes and maintain order
-        return [path for path in successful_figures if path is not None]
+        return successful_figures
+
+    async def process_figures_async(self, figures: list[DetectedFigure]) -> list[str | None]:
+        """
+        Async form of `process_figures_in_parallel`.
+
+        Figures are coroutines on the caller's event loop rather than threads;
+        at most MAX_FIGURE_WORKERS of them are in flight per job.
+        """
+        slots = asyncio.Semaphore(MAX_FIGURE_WORKERS)
+
+        async def process(index: int, figure: DetectedFigure) -> str | None:
+            async with slots:
+                try:
+                    result_path = await self._process_single_figure_async(index, figure)
+                except Exception as e:
+                    print(f"Error processing figure {index+1}: {e}")
+                    return None
+            if result_path:
+                print(f"Successfully processed figure {index + 1}.")
+            else:
+                print(f"Error processing figure {index+1}")
+            return result_path
+
+        return list(await asyncio.gather(*(process(i, figure) for i, figure in enumerate(figures))))
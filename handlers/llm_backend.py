@@ -0,0 +1,152 @@
+# handlers/llm_backend.py
+
+import asyncio
+import os
+from abc import ABC, abstractmethod
+from typing import NamedTuple
+from .page_image import PageImage
+from utils.result_cache import ResultCache
+
+
+class DetectedFigure(NamedTuple):
+    """A figure found by the vision model."""
+    description: str
+    page_number: int | None = None
+    # (x0, y0, x1, y1) as fractions of the page width/height.
+    bbox: tuple[float, float, float, float] | None = None
+    # The figure region cut out of the rendered page, if a bbox was given.
+    crop: PageImage | None = None
+    # Asymptote code known to draw this figure, e.g. from an earlier revision of the document.
+    code: str | None = None
+
+
+class LLMBackend(ABC):
+    """
+    The interface the pipeline uses to talk to a language model.
+
+    DocumentProcessor and FigureProcessor only depend on this class, so a
+    backend can be swapped for load tests or offline runs without touching them.
+
+    The `*_async` methods are used by the asyncio pipeline. By default they run
+    the blocking method in a worker thread; backends with a native async
+    client should override them so no thread is held while waiting on the API.
+    """
+
+    MODEL_NAME = ""
+
+    cache: ResultCache
+
+    @abstractmethod
+    def extract_text_to_latex(self, pdf_path: str, mode: str) -> str:
+        """Converts the PDF at `pdf_path` to a LaTeX document with %%FIGURE_PLACEHOLDER_n%% comments."""
+
+    @abstractmethod
+    def extract_text_from_images(self, pages: list[PageImage], mode: str) -> str:
+        """Like `extract_text_to_latex`, for a document given as page images, e.g. photos."""
+
+    @abstractmethod
+    def get_figure_descriptions(self, pdf_images: list[PageImage]) -> list[DetectedFigure]:
+        """Returns one DetectedFigure (description, page and bounding box) per figure found."""
+
+    @abstractmethod
+    def generate_figure_code(
+        self, description: str, image: PageImage | None = None
+    ) -> str:
+        """Returns Asymptote code drawing the described figure, optionally guided by its cropped image."""
+
+    def repair_figure_code(
+        self, description: str, code: str, diagnostic: str, image: PageImage | None = None
+    ) -> str:
+        """
+        Returns a corrected version of `code`, which failed with `diagnostic`.
+
+        The default regenerates with the failed code and the error appended to
+        the description; backends should override it with a dedicated prompt.
+        """
+        return self.generate_figure_code(
+            f"{description}\n\nThis attempt failed:\n{code}\n\nError:\n{diagnostic}",
+            image=image,
+        )
+
+    async def extract_text_to_latex_async(self, pdf_path: str, mode: str) -> str:
+        return await asyncio.to_thread(self.extract_text_to_latex, pdf_path, mode)
+
+    async def extract_text_from_images_async(self, pages: list[PageImage], mode: str) -> str:
+        return await asyncio.to_thread(self.extract_text_from_images, pages, mode)
+
+    async def get_figure_descriptions_async(self, pdf_images: list[PageImage]) -> list[DetectedFigure]:
+        return await asyncio.to_thread(self.get_figure_descriptions, pdf_images)
+
+    async def generate_figure_code_async(
+        self, description: str, image: PageImage | None = None
+    ) -> str:
+        return await asyncio.to_thread(self.generate_figure_code, description, image)
+
+    async def repair_figure_code_async(
+        self, description: str, code: str, diagnostic: str, image: PageImage | None = None
+    ) -> str:
+        return await asyncio.to_thread(self.repair_figure_code, description, code, diagnostic, image)
+
+    def merge_latex_and_figures(
+        self, latex_template: str, figure_files: list[str]
+    ) -> str:
+        """
+        Merges the LaTeX template with generated figure files by replacing placeholders.
+
+        Args:
+            latex_template: The LaTeX document with %%FIGURE_PLACEHOLDER_n%% comments.
+            figure_files: One file path per figure, in placeholder order; None
+                for figures that could not be rendered, whose placeholders are left as comments.
+
+        Returns:
+            The final, complete LaTeX document as a string.
+        """
+        print("Merging generated text with figures...")
+        final_latex = latex_template
+        for i, fig_path in enumerate(figure_files):
+            if fig_path is None:
+                continue
+            placeholder = f"%%FIGURE_PLACEHOLDER_{i+1}%%"
+
+            # Asymptote generates a .tex file that can be included
+            figure_include_code = f"""
+\\begin{{figure}}[htbp]
+    \\centering
+    \\includegraphics{{{fig_path}}}
+    \\caption{{Generated Figure {i+1}.}}
+    \\label{{fig:gen{i+1}}}
+\\end{{figure}}
+"""
+            final_latex = final_latex.replace(placeholder, figure_include_code.strip())
+
+        # # Add asymptote package to preamble if not already there
+        # if "\\usepackage{asymptote}" not in final_latex and figure_files:
+        #     # More robustly add the package after the documentclass line
+        #     doc_class_line = final_latex.split('\n')[0]
+        #     final_latex = final_latex.replace(
+        #         doc_class_line, 
+        #         f"{doc_class_line}\n\\usepackage[inline]{{asymptote}}"
+        #     )
+
+        print("Merging complete.")
+        return final_latex
+
+
+def get_llm_backend(name: str | None = None) -> LLMBackend:
+    """
+    Creates the LLM backend selected by `name` or the TEXIFY_LLM_BACKEND variable.
+
+    Args:
+        name: 'gemini' (default) or 'fake'.
+    """
+    name = name or os.getenv("TEXIFY_LLM_BACKEND", "gemini")
+    if name == "gemini":
+        from .llm_handler import GeminiLLM
+        return GeminiLLM()
+    if name == "fake":
+        from .fake_llm import FakeLLM
+        return FakeLLM(
+            latency=float(os.getenv("TEXIFY_FAKE_LATENCY", "0")),
+            failure_rate=float(os.getenv("TEXIFY_FAKE_FAILURE_RATE", "0")),
+        )
+    raise ValueError(f"Unknown LLM backend: {name}")
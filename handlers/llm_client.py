@@ -0,0 +1,251 @@
+# handlers/llm_client.py
+"""
+The process-wide gateway for Gemini API calls.
+
+Every call from every job goes through one LLMClient, which
+    - paces requests and tokens per minute with token buckets,
+    - caps concurrency with the priority-aware `llm_slots`, so interactive
+      jobs are served ahead of batch work (see utils.rate_limit.llm_priority),
+    - retries transient errors (rate limits, overload, timeouts) with
+      jittered exponential backoff, draining the request bucket on a 429 so
+      all callers slow down together,
+    - bounds every attempt with a timeout, and
+    - lets identical in-flight requests share a single call.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from utils.limits import llm_slots
+from utils.rate_limit import TokenBucket
+from utils.tracing import metrics, tracer
+
+# Errors worth retrying, by class name, so the SDK need not be imported here.
+# google.api_core maps HTTP 429/500/503/504 to these.
+TRANSIENT_ERRORS = {
+    "ResourceExhausted",
+    "TooManyRequests",
+    "InternalServerError",
+    "ServiceUnavailable",
+    "DeadlineExceeded",
+    "GatewayTimeout",
+    "TimeoutError",
+    "ConnectionError",
+    "ConnectionResetError",
+}
+RATE_LIMIT_ERRORS = {"ResourceExhausted", "TooManyRequests"}
+
+
+class _LeaderCancelled(Exception):
+    """Tells coalesced waiters that the call they were sharing was cancelled."""
+
+
+class LLMClient:
+    """Rate-limited, retrying and coalescing wrapper around Gemini API calls."""
+
+    def __init__(
+        self,
+        requests_per_minute: float = float(os.getenv("TEXIFY_LLM_RPM", "0")),
+        tokens_per_minute: float = float(os.getenv("TEXIFY_LLM_TPM", "0")),
+        timeout: float = float(os.getenv("TEXIFY_LLM_TIMEOUT", "300")),
+        max_retries: int = int(os.getenv("TEXIFY_LLM_RETRIES", "5")),
+        backoff_base: float = 1.0,
+        backoff_cap: float = 60.0,
+    ):
+        """
+        Args:
+            requests_per_minute: Request budget shared by all jobs. 0: unlimited.
+            tokens_per_minute: Token budget shared by all jobs. 0: unlimited.
+            timeout: Seconds one attempt may take before it counts as a transient failure.
+            max_retries: Retries after the first attempt before an error is raised.
+            backoff_base: Upper bound of the first retry delay; it doubles per retry.
+            backoff_cap: Upper bound of any retry delay.
+        """
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._lock = threading.Lock()
+        # request key -> Future of the call in flight
+        self._in_flight = {}
+
+    @staticmethod
+    def estimate_tokens(contents) -> int:
+        """A rough, cheap input token count for reserving budget; corrected once the response arrives."""
+        if isinstance(contents, str):
+            return len(contents) // 4 + 1
+        if isinstance(contents, (list, tuple)):
+            return sum(LLMClient.estimate_tokens(part) for part in contents)
+        # Inline images and uploaded files; Gemini bills an image at 258 tokens.
+        return 258
+
+    def _backoff(self, attempt: int) -> float:
+        """Full jitter: a uniform delay up to the exponential bound, so retries spread out."""
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    def _should_retry(self, error: BaseException, attempt: int, span) -> bool:
+        name = type(error).__name__
+        if name not in TRANSIENT_ERRORS and not isinstance(error, (TimeoutError, ConnectionError)):
+            return False
+        if name in RATE_LIMIT_ERRORS:
+            # Everyone else is about to hit the same limit; make them wait too.
+            self.requests.drain()
+        metrics.inc(
+            "texify_llm_retries_total",
+            help_text="LLM calls retried after a transient error.",
+            error=name,
+        )
+        span.set("retries", attempt + 1)
+        return attempt < self.max_retries
+
+    def _settle(self, span, reserved: int, response) -> None:
+        """Records the tokens used and corrects the token reservation."""
+        tracer.record_tokens(span, response)
+        usage = getattr(response, "usage_metadata", None)
+        used = getattr(usage, "total_token_count", None)
+        if used:
+            self.tokens.adjust(used - reserved)
+
+    def _join(self, key: str | None) -> tuple[Future | None, bool]:
+        """Returns (future, is_leader) for `key`; the leader makes the call, the rest wait on it."""
+        if key is None:
+            return None, True
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                return future, False
+            future = self._in_flight[key] = Future()
+            return future, True
+
+    def _publish(self, key: str | None, future: Future | None, result=None, error=None) -> None:
+        if future is None:
+            return
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    @staticmethod
+    def _count_coalesced(span) -> None:
+        span.set("coalesced", True)
+        metrics.inc(
+            "texify_llm_coalesced_total",
+            help_text="LLM calls answered by an identical request already in flight.",
+        )
+
+    def call(self, fn, span, key: str | None = None, tokens: int = 0):
+        """
+        Calls `fn()` under the rate limits and retries it on transient errors.
+
+        Args:
+            fn: Makes the API call. It should apply `self.timeout` itself,
+                since a blocking call cannot be interrupted from outside.
+            span: The caller's trace span; retries, coalescing and token
+                usage are recorded on it.
+            key: Identifies the request. A call with the same key already in
+                flight is waited on instead of made again. None: never shared.
+            tokens: Estimated input tokens, reserved from the token budget.
+        """
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                response = future.result()
+            except _LeaderCancelled:
+                continue
+            self._count_coalesced(span)
+            return response
+
+        try:
+            response = self._call_with_retries(fn, span, tokens)
+        except BaseException as e:
+            self._publish(key, future, error=e if isinstance(e, Exception) else _LeaderCancelled())
+            raise
+        self._publish(key, future, result=response)
+        return response
+
+    def _call_with_retries(self, fn, span, tokens: int):
+        for attempt in range(self.max_retries + 1):
+            # Pace before taking a slot, so waiting for budget doesn't hold one.
+            time.sleep(max(self.requests.reserve(), self.tokens.reserve(tokens)))
+            with llm_slots.slot():
+                try:
+                    response = fn()
+                except Exception as e:
+                    if not self._should_retry(e, attempt, span):
+                        self.tokens.adjust(-tokens)
+                        raise
+                    error = e
+                else:
+                    self._settle(span, tokens, response)
+                    return response
+            # Back off without holding a slot, so other requests can use it.
+            delay = self._backoff(attempt)
+            print(f"LLM call failed ({type(error).__name__}: {error}); retrying in {delay:.1f}s.")
+            time.sleep(delay)
+
+    async def call_async(self, fn, span, key: str | None = None, tokens: int = 0):
+        """
+        Async form of `call`; `fn()` returns an awaitable.
+
+        Each attempt is cancelled after `self.timeout` seconds. Waiting for
+        budget, slots or a coalesced call holds no thread.
+        """
+        while True:
+            future, leader = self._join(key)
+            if leader:
+                break
+            try:
+                # Shielded: a waiter being cancelled must not cancel the shared call.
+                response = await asyncio.shield(asyncio.wrap_future(future))
+            except _LeaderCancelled:
+                continue
+            self._count_coalesced(span)
+            return response
+
+        try:
+            response = await self._call_with_retries_async(fn, span, tokens)
+        except BaseException as e:
+            self._publish(key, future, error=e if isinstance(e, Exception) else _LeaderCancelled())
+            raise
+        self._publish(key, future, result=response)
+        return response
+
+    async def _call_with_retries_async(self, fn, span, tokens: int):
+        for attempt in range(self.max_retries + 1):
+            await asyncio.sleep(max(self.requests.reserve(), self.tokens.reserve(tokens)))
+            async with llm_slots.slot_async():
+                try:
+                    response = await asyncio.wait_for(fn(), self.timeout)
+                except Exception as e:
+                    if not self._should_retry(e, attempt, span):
+                        self.tokens.adjust(-tokens)
+                        raise
+                    error = e
+                else:
+                    self._settle(span, tokens, response)
+                    return response
+            delay = self._backoff(attempt)
+            print(f"LLM call failed ({type(error).__name__}: {error}); retrying in {delay:.1f}s.")
+            await asyncio.sleep(delay)
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_llm_client() -> LLMClient:
+    """Returns the process-wide client, so every job shares one rate budget."""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = LLMClient()
+        return _default_client
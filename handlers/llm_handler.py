@@ -1,36 +1,113 @@
+import asyncio
+import json
 import os
-from PIL import Image
-import google.generativeai as genai
+import threading
 
+from .llm_backend import DetectedFigure, LLMBackend
+from .llm_client import LLMClient, get_llm_client
+from .page_image import PageImage
+from .remote_files import RemoteFileManager, get_remote_file_manager
+from utils.result_cache import ResultCache, get_default_cache
+from utils.tracing import tracer
 
-class GeminiLLM:
+
+class GeminiLLM(LLMBackend):
     """A handler for all interactions with the Google Gemini LLM."""
 
-    def __init__(self):
-        """Initializes the Gemini model."""
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            raise ValueError("GOOGLE_API_KEY not found in environment variables.")
-        genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-2.5-pro')
+    MODEL_NAME = 'gemini-2.5-pro'
 
-    def extract_text_to_latex(self, pdf_path: str, mode: str) -> str:
+    def __init__(
+        self,
+        cache: ResultCache | None = None,
+        remote_files: RemoteFileManager | None = None,
+        client: LLMClient | None = None,
+    ):
         """
-        Uses an LLM to convert raw text into a LaTeX format.
+        Initializes the Gemini model.
 
         Args:
-            pdf_path: The path to the PDF file.
-            mode: Processing mode ('rewriting', 'summarizing', 'verbatim').
+            cache: Cache for LLM responses. Defaults to the process-wide cache.
+            remote_files: Manager for uploaded documents. Defaults to the
+                process-wide manager, so uploads are shared across jobs.
+            client: Rate limiting, retries and request sharing for API calls.
+                Defaults to the process-wide client, so all jobs share one budget.
+        """
+        self._api_key = os.getenv("GOOGLE_API_KEY")
+        if not self._api_key:
+            raise ValueError("GOOGLE_API_KEY not found in environment variables.")
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.cache = cache if cache is not None else get_default_cache()
+        self.remote_files = remote_files if remote_files is not None else get_remote_file_manager()
+        self.client = client if client is not None else get_llm_client()
 
-        Returns:
-            A string containing the document in LaTeX format, with placeholders for figures.
+    @property
+    def model(self):
         """
-        print(f"Processing text in '{mode}' mode...")
+        The Gemini model, created on first use.
+
+        Importing and configuring the SDK takes about a second, which runs
+        that are fully served from the cache never need to pay. Uploads use
+        the SDK's global configuration, so access this before uploading.
+        """
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None:
+                    import google.generativeai as genai
+
+                    genai.configure(api_key=self._api_key)
+                    self._model = genai.GenerativeModel(self.MODEL_NAME)
+        return self._model
 
+    @staticmethod
+    def _strip_code_fence(text: str, language: str) -> str:
+        """Returns the code inside a ```language fence, or the stripped text if there is none."""
+        code = text.strip()
+        if code.startswith(f"```{language}"):
+            code = code[len(f"```{language}"):].strip()
+        elif code.startswith("```"):
+            code = code[len("```"):].strip()
+        if code.endswith("```"):
+            code = code[:-len("```")].strip()
+        return code
+
+    def _generate(self, span_name: str, contents, key: str | None = None, **attributes):
+        """
+        Calls the model inside a span, through the shared client.
+
+        Args:
+            key: Identifies the request, e.g. its cache key; identical
+                requests in flight at the same time share one call.
+        """
+        model = self.model
+        options = {"timeout": self.client.timeout}
+        with tracer.span(span_name, **attributes) as span:
+            return self.client.call(
+                lambda: model.generate_content(contents, request_options=options),
+                span,
+                key=f"{span_name}:{key}" if key else None,
+                tokens=self.client.estimate_tokens(contents),
+            )
+
+    async def _generate_async(self, span_name: str, contents, key: str | None = None, **attributes):
+        """Async form of `_generate`; waiting for budget or a slot holds no thread."""
+        model = self.model
+        options = {"timeout": self.client.timeout}
+        with tracer.span(span_name, **attributes) as span:
+            return await self.client.call_async(
+                lambda: model.generate_content_async(contents, request_options=options),
+                span,
+                key=f"{span_name}:{key}" if key else None,
+                tokens=self.client.estimate_tokens(contents),
+            )
+
+    @staticmethod
+    def _text_prompt(mode: str, source: str = "PDF") -> str:
+        """Returns the text conversion prompt; `source` names what is attached."""
         action_prompt = {
-            "rewriting": "Rewrite the text from the attached PDF to improve clarity and flow.",
-            "summarizing": "Summarize the text from the attached PDF concisely.",
-            "verbatim": "Format the text from the attached PDF as-is.",
+            "rewriting": f"Rewrite the text from the attached {source} to improve clarity and flow.",
+            "summarizing": f"Summarize the text from the attached {source} concisely.",
+            "verbatim": f"Format the text from the attached {source} as-is.",
         }[mode]
 
         prompt = f"""
@@ -49,76 +126,241 @@ class GeminiLLM:
         \\usepackage{{graphics}}
 
         Do not include any other explanations or preamble.
-        If any extraneous text appears on the PDF that doesn't
+        If any extraneous text appears on the {source} that doesn't
         relate directly to the main text, do not include it.
         """
-        
-        pdf_file = genai.upload_file(path=pdf_path, display_name=os.path.basename(pdf_path))
-        print(f"Uploaded '{pdf_file.display_name}' to Gemini.")
-
-        try:
-            response = self.model.generate_content([prompt, pdf_file])
-            # Clean response to get only the code
-            code = response.text.strip()
-            if code.startswith("```latex"):
-                code = code[len("```latex"):].strip()
-            elif code.startswith("```"):
-                code = code[len("```"):].strip()
-            if code.endswith("```"):
-                code = code[:-len("```")].strip()
-
-            print("Text to LaTeX conversion complete.")
-            return code
-        finally:
-            # Clean up the uploaded file
-            genai.delete_file(pdf_file.name)
-            print(f"Cleaned up uploaded file: {pdf_file.display_name}")
+        return prompt
 
+    def _text_request(self, pdf_path: str, mode: str) -> tuple[str, str]:
+        """Returns the prompt and cache key for converting the PDF at `pdf_path`."""
+        prompt = self._text_prompt(mode)
+        with open(pdf_path, "rb") as f:
+            cache_key = ResultCache.make_key(f.read(), mode, prompt, self.MODEL_NAME)
+        return prompt, cache_key
 
-    def get_figure_descriptions(self, pdf_images: list[Image.Image]) -> list[str]:
+    def extract_text_to_latex(self, pdf_path: str, mode: str) -> str:
         """
-        Uses a vision model to find and describe figures on PDF pages.
+        Uses an LLM to convert raw text into a LaTeX format.
 
         Args:
-            pdf_images: A list of PIL Images, one for each page of the PDF.
+            pdf_path: The path to the PDF file.
+            mode: Processing mode ('rewriting', 'summarizing', 'verbatim').
 
         Returns:
-            A numbered list of descriptions for each figure found.
+            A string containing the document in LaTeX format, with placeholders for figures.
         """
-        print("Generating figure descriptions from PDF pages...")
+        print(f"Processing text in '{mode}' mode...")
+        prompt, cache_key = self._text_request(pdf_path, mode)
+        cached = self.cache.get_json("text", cache_key)
+        if cached is not None:
+            print("Text to LaTeX conversion served from cache.")
+            return cached
+
+        self.model  # configures the SDK for the upload
+        with self.remote_files.uploaded(pdf_path) as pdf_file:
+            response = self._generate("llm.text", [prompt, pdf_file], key=cache_key, mode=mode)
+
+        # Clean response to get only the code
+        code = self._strip_code_fence(response.text, "latex")
+        print("Text to LaTeX conversion complete.")
+        self.cache.put_json("text", cache_key, code)
+        return code
+
+    async def extract_text_to_latex_async(self, pdf_path: str, mode: str) -> str:
+        print(f"Processing text in '{mode}' mode...")
+        # Hashing the document for the cache key reads the whole file.
+        prompt, cache_key = await asyncio.to_thread(self._text_request, pdf_path, mode)
+        cached = self.cache.get_json("text", cache_key)
+        if cached is not None:
+            print("Text to LaTeX conversion served from cache.")
+            return cached
+
+        self.model  # configures the SDK for the upload
+        async with self.remote_files.uploaded_async(pdf_path) as pdf_file:
+            response = await self._generate_async("llm.text", [prompt, pdf_file], key=cache_key, mode=mode)
+
+        code = self._strip_code_fence(response.text, "latex")
+        print("Text to LaTeX conversion complete.")
+        self.cache.put_json("text", cache_key, code)
+        return code
+
+    def _image_text_request(self, pages: list[PageImage], mode: str) -> tuple[list, str]:
+        """Returns the request contents and cache key for converting page images."""
+        prompt = self._text_prompt(mode, "page images")
+        contents = [prompt] + [{"mime_type": page.mime_type, "data": page.data} for page in pages]
+        cache_key = ResultCache.make_key(mode, prompt, self.MODEL_NAME, *(page.data for page in pages))
+        return contents, cache_key
+
+    def extract_text_from_images(self, pages: list[PageImage], mode: str) -> str:
+        """
+        Converts a document given as page images, e.g. photos, to LaTeX.
+
+        The images are sent inline, so unlike PDFs nothing is uploaded first.
+        """
+        print(f"Processing text of {len(pages)} page images in '{mode}' mode...")
+        contents, cache_key = self._image_text_request(pages, mode)
+        cached = self.cache.get_json("text", cache_key)
+        if cached is not None:
+            print("Text to LaTeX conversion served from cache.")
+            return cached
+
+        response = self._generate("llm.text", contents, key=cache_key, mode=mode, pages=len(pages))
+        code = self._strip_code_fence(response.text, "latex")
+        self.cache.put_json("text", cache_key, code)
+        return code
+
+    async def extract_text_from_images_async(self, pages: list[PageImage], mode: str) -> str:
+        print(f"Processing text of {len(pages)} page images in '{mode}' mode...")
+        contents, cache_key = self._image_text_request(pages, mode)
+        cached = self.cache.get_json("text", cache_key)
+        if cached is not None:
+            print("Text to LaTeX conversion served from cache.")
+            return cached
+
+        response = await self._generate_async("llm.text", contents, key=cache_key, mode=mode, pages=len(pages))
+        code = self._strip_code_fence(response.text, "latex")
+        self.cache.put_json("text", cache_key, code)
+        return code
+
+    def extract_full_text(self, pdf_path: str) -> str:
+        """Extracts the plain text of a (handwritten) PDF without any LaTeX markup."""
+        self.model  # configures the SDK for the upload
+        with self.remote_files.uploaded(pdf_path) as pdf_file:
+            response = self._generate("llm.full_text", [
+                "Extract the text from this PDF of handwritten text"
+                "without any markup or additional commentary."
+                "If the text looks incoherent, try to fill in the blanks yourself to make"
+                "it make sense in the context of a mathematical proof."
+                "Again: DO NOT ADD ANY COMMENTARY TO THE PROOFS GIVEN."
+                "Simply recite the text as it is on the PDF.",
+                pdf_file
+            ])
+        return response.text
+
+
+    @staticmethod
+    def _parse_figures(text: str, pdf_images: list[PageImage]) -> list[DetectedFigure]:
+        """
+        Parses the JSON figure list returned by the vision model.
+
+        Falls back to the old numbered-list format, without boxes, if the
+        response is not valid JSON.
+        """
+        cleaned = text.strip()
+        if cleaned.startswith("```json"):
+            cleaned = cleaned[len("```json"):]
+        elif cleaned.startswith("```"):
+            cleaned = cleaned[len("```"):]
+        if cleaned.endswith("```"):
+            cleaned = cleaned[:-len("```")]
+
+        try:
+            items = json.loads(cleaned)
+        except ValueError:
+            return [
+                DetectedFigure(line.strip().split('. ', 1)[1])
+                for line in text.split('\n')
+                if line.strip() and '. ' in line and line.strip()[0].isdigit()
+            ]
+
+        figures = []
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict) or not item.get("description"):
+                continue
+            page_number = None
+            index = item.get("page")
+            if isinstance(index, int) and 1 <= index <= len(pdf_images):
+                page_number = pdf_images[index - 1].page_number
+
+            bbox = None
+            box = item.get("box_2d")
+            if page_number is not None and isinstance(box, list) and len(box) == 4:
+                try:
+                    ymin, xmin, ymax, xmax = (min(max(float(v) / 1000, 0.0), 1.0) for v in box)
+                except (TypeError, ValueError):
+                    ymin = xmin = ymax = xmax = 0.0
+                if xmax > xmin and ymax > ymin:
+                    bbox = (xmin, ymin, xmax, ymax)
+
+            figures.append(DetectedFigure(str(item["description"]), page_number, bbox))
+        return figures
+
+    def _detection_request(self, pdf_images: list[PageImage]) -> tuple[list, str]:
+        """Returns the request contents and cache key for detecting figures on `pdf_images`."""
         prompt = """
         Analyze the following page images. Identify each distinct figure, chart, or diagram.
-        For each one you find, provide a detailed, one-sentence description.
-        
-        Format your response as a numbered list. For example:
-        1. A bar chart showing quarterly profits.
-        2. A diagram of the system architecture.
-        
-        If no figures are found, respond with "No figures found.".
+        For each one you find, provide a detailed, one-sentence description, the 1-based
+        index of the image it appears on, and its bounding box as [ymin, xmin, ymax, xmax]
+        normalized to 0-1000.
+
+        Respond with only a JSON list. For example:
+        [{"description": "A bar chart showing quarterly profits.", "page": 1, "box_2d": [100, 150, 480, 850]},
+         {"description": "A diagram of the system architecture.", "page": 2, "box_2d": [520, 90, 900, 910]}]
+
+        If no figures are found, respond with [].
         """
-        
-        response = self.model.generate_content([prompt] + pdf_images)
-        print(f"Found descriptions: \n{response.text}")
 
-        # Simple parsing of the numbered list response
-        descriptions = [
-            line.strip().split('. ', 1)[1] 
-            for line in response.text.split('\n') 
-            if line.strip() and '. ' in line and line.strip()[0].isdigit()
+        cache_key = ResultCache.make_key(
+            prompt,
+            self.MODEL_NAME,
+            *[img.data for img in pdf_images],
+        )
+        contents = [prompt] + [{"mime_type": img.mime_type, "data": img.data} for img in pdf_images]
+        return contents, cache_key
+
+    def _cached_figures(self, cache_key: str) -> list[DetectedFigure] | None:
+        cached = self.cache.get_json("figure_descriptions", cache_key)
+        if cached is None:
+            return None
+        print(f"Figure descriptions served from cache ({len(cached)} found).")
+        return [
+            DetectedFigure(description, page, tuple(bbox) if bbox else None)
+            for description, page, bbox in cached
         ]
-        return descriptions
 
-    def generate_figure_code(self, description: str) -> str:
+    def _store_figures(self, cache_key: str, response, pdf_images: list[PageImage]) -> list[DetectedFigure]:
+        print(f"Found descriptions: \n{response.text}")
+        figures = self._parse_figures(response.text, pdf_images)
+        self.cache.put_json(
+            "figure_descriptions",
+            cache_key,
+            [[f.description, f.page_number, f.bbox] for f in figures],
+        )
+        return figures
+
+    def get_figure_descriptions(self, pdf_images: list[PageImage]) -> list[DetectedFigure]:
         """
-        Generates Asymptote code for a figure based on its description.
+        Uses a vision model to find, describe and locate figures on PDF pages.
 
         Args:
-            description: The text description of the figure.
+            pdf_images: Encoded page images, one for each page of the PDF.
 
         Returns:
-            A string containing Asymptote code.
+            One DetectedFigure per figure found, with its page and bounding box when available.
         """
-        print(f"Generating Asymptote code for: '{description}'")
+        print("Generating figure descriptions from PDF pages...")
+        contents, cache_key = self._detection_request(pdf_images)
+        cached = self._cached_figures(cache_key)
+        if cached is not None:
+            return cached
+
+        response = self._generate("llm.figure_detection", contents, key=cache_key, pages=len(pdf_images))
+        return self._store_figures(cache_key, response, pdf_images)
+
+    async def get_figure_descriptions_async(self, pdf_images: list[PageImage]) -> list[DetectedFigure]:
+        print("Generating figure descriptions from PDF pages...")
+        contents, cache_key = self._detection_request(pdf_images)
+        cached = self._cached_figures(cache_key)
+        if cached is not None:
+            return cached
+
+        response = await self._generate_async(
+            "llm.figure_detection", contents, key=cache_key, pages=len(pdf_images)
+        )
+        return self._store_figures(cache_key, response, pdf_images)
+
+    def _figure_code_request(self, description: str, image: PageImage | None) -> tuple[list, str]:
+        """Returns the request contents and key for generating a figure's code."""
         prompt = f"""
         Generate Asymptote code to create a vector graphic for the following description.
         The code should be self-contained and ready to compile with 'asy'.
@@ -126,57 +368,86 @@ class GeminiLLM:
 
         Description: "{description}"
         """
-        response = self.model.generate_content(prompt)
+        contents = [prompt]
+        if image is not None:
+            contents.append(
+                "The attached image is the original figure. Reproduce its layout, labels and proportions."
+            )
+            contents.append({"mime_type": image.mime_type, "data": image.data})
 
-        # Clean response to get only the code
-        code = response.text.strip()
-        if code.startswith("```asy"):
-            code = code[len("```asy"):].strip()
-        elif code.startswith("```"):
-            code = code[len("```"):].strip()
-        if code.endswith("```"):
-            code = code[:-len("```")].strip()
-            
-        return code
+        key = ResultCache.make_key(prompt, self.MODEL_NAME, image.data if image is not None else b"")
+        return contents, key
+
+    def _figure_repair_request(
+        self, description: str, code: str, diagnostic: str, image: PageImage | None
+    ) -> tuple[list, str]:
+        """Returns the request contents and key for fixing code that failed to compile."""
+        prompt = f"""
+        The following Asymptote code was written for this figure: "{description}"
+        It fails with the error below. Fix the error with the smallest change that
+        makes the code compile; keep everything that is not related to the error.
+        The output must only be the complete corrected Asymptote code inside a code block.
 
+        Code:
+        ```asy
+        {code}
+        ```
 
-    def merge_latex_and_figures(
-        self, latex_template: str, figure_files: list[str]
+        Error:
+        {diagnostic}
+        """
+        contents = [prompt]
+        if image is not None:
+            contents.append("The attached image is the original figure.")
+            contents.append({"mime_type": image.mime_type, "data": image.data})
+        key = ResultCache.make_key(prompt, self.MODEL_NAME, image.data if image is not None else b"")
+        return contents, key
+
+    def generate_figure_code(
+        self, description: str, image: PageImage | None = None
     ) -> str:
         """
-        Merges the LaTeX template with generated figure files by replacing placeholders.
+        Generates Asymptote code for a figure based on its description.
 
         Args:
-            latex_template: The LaTeX document with %%FIGURE_PLACEHOLDER_n%% comments.
-            figure_files: A list of file paths for the generated Asymptote .tex files.
+            description: The text description of the figure.
+            image: The figure cropped from the original page. Seeing the
+                original makes the first attempt far more likely to be right.
 
         Returns:
-            The final, complete LaTeX document as a string.
-        """
-        print("Merging generated text with figures...")
-        final_latex = latex_template
-        for i, fig_path in enumerate(figure_files):
-            placeholder = f"%%FIGURE_PLACEHOLDER_{i+1}%%"
-
-            # Asymptote generates a .tex file that can be included
-            figure_include_code = f"""
-\\begin{{figure}}[htbp]
-    \\centering
-    \\includegraphics{{{fig_path}}}
-    \\caption{{Generated Figure {i+1}.}}
-    \\label{{fig:gen{i+1}}}
-\\end{{figure}}
-"""
-            final_latex = final_latex.replace(placeholder, figure_include_code.strip())
-
-        # # Add asymptote package to preamble if not already there
-        # if "\\usepackage{asymptote}" not in final_latex and figure_files:
-        #     # More robustly add the package after the documentclass line
-        #     doc_class_line = final_latex.split('\n')[0]
-        #     final_latex = final_latex.replace(
-        #         doc_class_line, 
-        #         f"{doc_class_line}\n\\usepackage[inline]{{asymptote}}"
-        #     )
-
-        print("Merging complete.")
-        return final_latex
+            A string containing Asymptote code.
+        """
+        print(f"Generating Asymptote code for: '{description}'")
+        contents, key = self._figure_code_request(description, image)
+        response = self._generate("llm.figure_generate", contents, key=key, cropped=image is not None)
+        return self._strip_code_fence(response.text, "asy")
+
+    async def generate_figure_code_async(
+        self, description: str, image: PageImage | None = None
+    ) -> str:
+        print(f"Generating Asymptote code for: '{description}'")
+        contents, key = self._figure_code_request(description, image)
+        response = await self._generate_async("llm.figure_generate", contents, key=key, cropped=image is not None)
+        return self._strip_code_fence(response.text, "asy")
+
+    def repair_figure_code(
+        self, description: str, code: str, diagnostic: str, image: PageImage | None = None
+    ) -> str:
+        """
+        Asks for a targeted fix of code that failed to compile.
+
+        Like generations, repairs are not cached: the same broken code may need
+        a different fix next time. FigureProcessor remembers code once it compiles.
+        """
+        print(f"Repairing Asymptote code for: '{description}'")
+        contents, key = self._figure_repair_request(description, code, diagnostic, image)
+        response = self._generate("llm.figure_repair", contents, key=key, cropped=image is not None)
+        return self._strip_code_fence(response.text, "asy")
+
+    async def repair_figure_code_async(
+        self, description: str, code: str, diagnostic: str, image: PageImage | None = None
+    ) -> str:
+        print(f"Repairing Asymptote code for: '{description}'")
+        contents, key = self._figure_repair_request(description, code, diagnostic, image)
+        response = await self._generate_async("llm.figure_repair", contents, key=key, cropped=image is not None)
+        return self._strip_code_fence(response.text, "asy")
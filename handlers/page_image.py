@@ -0,0 +1,32 @@
+# handlers/page_image.py
+"""
+Rendered-page value types.
+
+Kept free of fitz and PIL so modules that only pass pages around (the LLM
+backends, DocumentProcessor) can be imported without loading them.
+"""
+import os
+from typing import NamedTuple
+
+
+class PageImage(NamedTuple):
+    """A rendered page, encoded to compact bytes ready to send to a vision model."""
+    page_number: int
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+
+
+# Text extraction reads photos directly, so they keep more detail than the
+# pages rendered for figure detection.
+PHOTO_MAX_DIMENSION = int(os.getenv("TEXIFY_PHOTO_MAX_DIM", "2048"))
+
+
+class RasterOptions(NamedTuple):
+    """How pages are rendered for the vision model. Defaults come from the environment."""
+    dpi: int = int(os.getenv("TEXIFY_RASTER_DPI", "96"))
+    max_dimension: int | None = int(os.getenv("TEXIFY_RASTER_MAX_DIM", "1280")) or None
+    grayscale: bool = os.getenv("TEXIFY_RASTER_GRAYSCALE", "") in ("1", "true", "yes")
+    image_format: str = os.getenv("TEXIFY_RASTER_FORMAT", "JPEG")
+    quality: int = int(os.getenv("TEXIFY_RASTER_QUALITY", "75"))
@@ -0,0 +1,123 @@
+# handlers/page_prefilter.py
+
+import fitz
+
+from utils.tracing import metrics
+
+
+class PagePrefilter:
+    """
+    Cheaply decides which pages might contain a figure, using only local analysis.
+
+    Born-digital pages are judged by their embedded images and vector drawings.
+    Scanned pages (no text layer, or one image covering the page) are judged by
+    the ink on a low-resolution render: figures produce dense regions and long
+    straight strokes (axes, boxes, grids) that lines of text do not. When in
+    doubt a page is kept, since a missed figure costs more than a vision call.
+    """
+
+    def __init__(
+        self,
+        min_image_area: float = 0.02,
+        min_drawing_area: float = 0.03,
+        full_page_image_area: float = 0.85,
+        scan_dpi: int = 36,
+        ink_level: int = 128,
+        dense_tile_ink: float = 0.25,
+        min_long_run: float = 0.3,
+        grid: int = 8,
+    ):
+        """
+        Args:
+            min_image_area: Page fraction an embedded image must cover to count as a figure.
+            min_drawing_area: Page fraction the vector drawings' bounding box must cover.
+            full_page_image_area: Images covering more than this fraction are treated as scans.
+            scan_dpi: Resolution of the ink-density render for scanned pages.
+            ink_level: Gray levels below this count as ink.
+            dense_tile_ink: Ink fraction above which a grid tile counts as graphical.
+            min_long_run: Fraction of the page width/height a single straight
+                ink run must span to count as a drawn line.
+            grid: The page is split into grid x grid tiles for the density check.
+        """
+        self.min_image_area = min_image_area
+        self.min_drawing_area = min_drawing_area
+        self.full_page_image_area = full_page_image_area
+        self.scan_dpi = scan_dpi
+        self.ink_level = ink_level
+        self.dense_tile_ink = dense_tile_ink
+        self.min_long_run = min_long_run
+        self.grid = grid
+        # Maps every gray level to b"1" (ink) or b"0" (paper) for fast run/count checks.
+        self._ink_table = bytes(ord("1") if level < ink_level else ord("0") for level in range(256))
+
+    def classify_page(self, page: fitz.Page) -> tuple[bool, str]:
+        """
+        Returns (is_candidate, reason) for a single page.
+        """
+        page_area = abs(page.rect) or 1.0
+
+        is_scan = not page.get_text("text").strip()
+        for info in page.get_image_info():
+            fraction = abs(fitz.Rect(info["bbox"]) & page.rect) / page_area
+            if fraction >= self.full_page_image_area:
+                is_scan = True
+            elif fraction >= self.min_image_area:
+                return True, "embedded image"
+
+        drawings = [
+            d["rect"] for d in page.get_drawings()
+            # Ignore rules and underlines: a figure needs some extent in both directions.
+            if d["rect"].width > 2 or d["rect"].height > 2
+        ]
+        if len(drawings) >= 2:
+            bbox = fitz.Rect(drawings[0])
+            for rect in drawings[1:]:
+                bbox |= rect
+            is_rule = bbox.height <= 2 or bbox.width <= 2
+            if not is_rule and abs(bbox & page.rect) / page_area >= self.min_drawing_area:
+                return True, "vector drawing"
+
+        if is_scan:
+            return self._classify_scan(page)
+        return False, "text only"
+
+    def _classify_scan(self, page: fitz.Page) -> tuple[bool, str]:
+        pix = page.get_pixmap(dpi=self.scan_dpi, colorspace=fitz.csGRAY, alpha=False)
+        width, height = pix.width, pix.height
+        if not width or not height:
+            return False, "blank"
+        ink = bytes(pix.samples).translate(self._ink_table)
+        rows = [ink[y * pix.stride:y * pix.stride + width] for y in range(height)]
+
+        longest_row_run = max(max(map(len, row.split(b"0"))) for row in rows)
+        if longest_row_run >= self.min_long_run * width:
+            return True, "long horizontal stroke"
+        columns = [bytes(row[x] for row in rows) for x in range(width)]
+        longest_column_run = max(max(map(len, column.split(b"0"))) for column in columns)
+        if longest_column_run >= self.min_long_run * height:
+            return True, "long vertical stroke"
+
+        tile_w, tile_h = max(1, width // self.grid), max(1, height // self.grid)
+        for ty in range(0, height - tile_h + 1, tile_h):
+            for tx in range(0, width - tile_w + 1, tile_w):
+                tile_ink = sum(rows[y][tx:tx + tile_w].count(b"1") for y in range(ty, ty + tile_h))
+                if tile_ink / (tile_w * tile_h) >= self.dense_tile_ink:
+                    return True, "dense ink region"
+
+        return False, "scanned text"
+
+    def candidate_pages(self, pdf_path: str) -> list[int]:
+        """Returns the 0-based numbers of the pages that may contain figures."""
+        candidates = []
+        with fitz.open(pdf_path) as doc:
+            for page in doc:
+                is_candidate, reason = self.classify_page(page)
+                print(f"Page {page.number + 1}: {'figure candidate' if is_candidate else 'skipped'} ({reason}).")
+                if is_candidate:
+                    candidates.append(page.number)
+                metrics.inc(
+                    "texify_prefilter_pages_total",
+                    help_text="Pages classified by the local figure prefilter.",
+                    result="candidate" if is_candidate else "skipped",
+                )
+        return candidates
@@ -1,11 +1,110 @@
+import hashlib
+import io
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
 
 import fitz
-import google.generativeai as genai
-from PIL import Image
+from PIL import Image, ImageOps
+
+from .page_image import PageImage, RasterOptions
+
+
+def _render_page(page: fitz.Page, options: RasterOptions) -> PageImage:
+    """Renders one page at the requested resolution and encodes it."""
+    zoom = options.dpi / 72
+    if options.max_dimension:
+        longest = max(page.rect.width, page.rect.height) * zoom
+        if longest > options.max_dimension:
+            zoom *= options.max_dimension / longest
+
+    colorspace = fitz.csGRAY if options.grayscale else fitz.csRGB
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=False)
+    image = Image.frombytes("L" if options.grayscale else "RGB", [pix.width, pix.height], pix.samples)
+    del pix
+    return _encode_image(image, page.number, options)
+
+
+def _encode_image(image: Image.Image, page_number: int, options: RasterOptions) -> PageImage:
+    buffer = io.BytesIO()
+    if options.image_format.upper() == "PNG":
+        image.save(buffer, "PNG", optimize=True)
+        mime_type = "image/png"
+    else:
+        image.save(buffer, "JPEG", quality=options.quality, optimize=True)
+        mime_type = "image/jpeg"
+    return PageImage(page_number, buffer.getvalue(), mime_type, image.width, image.height)
+
+
+def load_photo(path: str, page_number: int = 0, options: RasterOptions | None = None) -> PageImage:
+    """
+    Prepares a photo or scanned image as a page for the vision model, without a PDF in between.
+
+    The image is turned upright according to its EXIF orientation, scaled
+    down to `options.max_dimension` and re-encoded. JPEGs are decoded at
+    reduced size to begin with, which is most of the saving for large phone photos.
+
+    Args:
+        path: The PNG or JPEG file.
+        page_number: 0-based page this image becomes in its document.
+        options: Size and encoding; `dpi` does not apply to photos.
+    """
+    options = options or RasterOptions()
+    mode = "L" if options.grayscale else "RGB"
+    with Image.open(path) as image:
+        if options.max_dimension:
+            # Only JPEG supports this; it picks the smallest DCT scale still at least this large.
+            image.draft(mode, (options.max_dimension, options.max_dimension))
+        image = ImageOps.exif_transpose(image)
+        if image.mode != mode:
+            image = image.convert(mode)
+        if options.max_dimension:
+            image.thumbnail((options.max_dimension, options.max_dimension), Image.LANCZOS)
+        return _encode_image(image, page_number, options)
+
+
+def _render_page_from_path(pdf_path: str, page_number: int, options: RasterOptions) -> PageImage:
+    """Process-pool entry point: each worker opens its own copy of the document."""
+    with fitz.open(pdf_path) as doc:
+        return _render_page(doc.load_page(page_number), options)
+
+
+def crop_page_image(
+    page: PageImage, bbox: tuple[float, float, float, float], padding: float = 0.02
+) -> PageImage:
+    """
+    Cuts a region out of a rendered page.
+
+    Args:
+        page: The rendered page.
+        bbox: (x0, y0, x1, y1) as fractions of the page width/height.
+        padding: Margin added on every side, as a fraction of the page size,
+            so strokes on the edge of the box are not clipped.
+    """
+    x0, y0, x1, y1 = bbox
+    with Image.open(io.BytesIO(page.data)) as image:
+        box = (
+            max(0, int((x0 - padding) * image.width)),
+            max(0, int((y0 - padding) * image.height)),
+            min(image.width, int((x1 + padding) * image.width) + 1),
+            min(image.height, int((y1 + padding) * image.height) + 1),
+        )
+        crop = image.crop(box)
+        buffer = io.BytesIO()
+        if page.mime_type == "image/png":
+            crop.save(buffer, "PNG", optimize=True)
+        else:
+            crop.save(buffer, "JPEG", quality=90)
+    return PageImage(page.page_number, buffer.getvalue(), page.mime_type, crop.width, crop.height)
+
 
 class PDFHandler:
-    """Handles PDF operations like text and image extraction."""
+    """
+    Handles local PDF operations like page rendering, splitting and conversion.
+
+    Nothing here talks to the LLM; uploads are handled by RemoteFileManager.
+    """
 
     def __init__(self, filepath: str):
         """
@@ -21,52 +120,150 @@ class PDFHandler:
             raise
         print(f"PDF '{filepath}' loaded successfully with {len(self.doc)} pages.")
 
-        genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-        self.pdf_model = genai.GenerativeModel("gemini-2.5-pro")
-        self.uploaded = genai.upload_file(filepath)
-        print("uploaded successfully, my goat")
-
-    def extract_full_text(self) -> str:
-        """Extracts concatenated text from all pages of the PDF."""
-
-        full_text = self.pdf_model.generate_content([
-            "Extract the text from this PDF of handwritten text"
-            "without any markup or additional commentary."
-            "If the text looks incoherent, try to fill in the blanks yourself to make"
-            "it make sense in the context of a mathematical proof."
-            "Again: DO NOT ADD ANY COMMENTARY TO THE PROOFS GIVEN."
-            "Simply recite the text as it is on the PDF.",
-            self.uploaded
-        ])
-        return full_text
-
-    def get_pages_as_images(self) -> list[Image.Image]:
-        """Converts each page of the PDF into a PIL Image."""
-        images = []
-        for page_num in range(len(self.doc)):
-            page = self.doc.load_page(page_num)
-            pix = page.get_pixmap()
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            images.append(img)
-        print("Converted all PDF pages to images.")
-        return images
+    def close(self) -> None:
+        self.doc.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def iter_pages(
+        self, options: RasterOptions | None = None, page_numbers: list[int] | None = None
+    ) -> Iterator[PageImage]:
+        """
+        Renders the pages one at a time and yields them as encoded images.
+
+        Only one full-resolution pixmap exists at any moment, so peak memory
+        does not grow with the page count.
+
+        Args:
+            options: Resolution and encoding options.
+            page_numbers: 0-based pages to render. Defaults to every page.
+        """
+        options = options or RasterOptions()
+        if page_numbers is None:
+            page_numbers = range(len(self.doc))
+        for page_num in page_numbers:
+            yield _render_page(self.doc.load_page(page_num), options)
 
     @staticmethod
-    def convert_image_to_pdf(image_path: str, output_pdf_path: str) -> None:
+    def render_pages(
+        pdf_path: str,
+        options: RasterOptions | None = None,
+        workers: int = 0,
+        page_numbers: list[int] | None = None,
+    ) -> Iterator[PageImage]:
         """
-        Converts a single image file to a single-page PDF.
+        Renders every page of `pdf_path` as encoded images, in page order.
 
         Args:
-            image_path: Path to the input image.
-            output_pdf_path: Path to save the output PDF.
+            pdf_path: Path to the PDF file.
+            options: Resolution and encoding options.
+            workers: Render pages in a process pool of this size. 0 renders
+                in-process, which is cheaper for short documents.
+            page_numbers: 0-based pages to render. Defaults to every page.
         """
-        try:
-            with Image.open(image_path) as image:
-                # Ensure image is in a format that can be saved as PDF
-                if image.mode == 'RGBA':
-                    image = image.convert('RGB')
-                image.save(output_pdf_path, "PDF", resolution=100.0)
-                print(f"Image '{image_path}' converted to PDF '{output_pdf_path}'.")
-        except Exception as e:
-            print(f"Failed to convert image to PDF: {e}")
-            raise
+        options = options or RasterOptions()
+        if workers <= 0:
+            with PDFHandler(pdf_path) as pdf_handler:
+                yield from pdf_handler.iter_pages(options, page_numbers)
+            return
+
+        if page_numbers is None:
+            with fitz.open(pdf_path) as doc:
+                page_numbers = range(len(doc))
+        page_count = len(page_numbers)
+        # Spawn rather than fork: the caller is usually a worker thread of a threaded service.
+        spawn = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=spawn) as executor:
+            yield from executor.map(
+                _render_page_from_path,
+                [pdf_path] * page_count,
+                page_numbers,
+                [options] * page_count,
+            )
+
+    @staticmethod
+    def split_pdf(pdf_path: str, output_dir: str, pages_per_chunk: int) -> list[str]:
+        """
+        Splits a PDF into consecutive chunks of at most `pages_per_chunk` pages.
+
+        Chunks are saved without a fresh trailer ID, so splitting the same PDF
+        again gives byte-identical files and their cached results still apply.
+        A PDF that already fits in one chunk is returned as is.
+
+        Args:
+            pdf_path: Path to the PDF to split.
+            output_dir: Directory to save the chunk PDFs.
+            pages_per_chunk: Maximum number of pages per chunk.
+
+        Returns:
+            The chunk PDF paths in page order.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(pdf_path))[0]
+        chunk_paths = []
+        with fitz.open(pdf_path) as doc:
+            if len(doc) <= pages_per_chunk:
+                return [pdf_path]
+            for first in range(0, len(doc), pages_per_chunk):
+                last = min(first + pages_per_chunk, len(doc)) - 1
+                chunk_path = os.path.join(output_dir, f"{name}_pages{first+1}-{last+1}.pdf")
+                with fitz.open() as chunk:
+                    chunk.insert_pdf(doc, from_page=first, to_page=last)
+                    chunk.save(chunk_path, no_new_id=True)
+                chunk_paths.append(chunk_path)
+        print(f"Split '{pdf_path}' into {len(chunk_paths)} chunks of up to {pages_per_chunk} pages.")
+        return chunk_paths
+
+    @staticmethod
+    def split_pages(pdf_path: str, output_dir: str, page_numbers: list[int]) -> list[str]:
+        """
+        Copies the given pages into single-page PDFs.
+
+        Like `split_pdf`, the copies are byte-identical across runs, so a page
+        that is converted again reuses its cached text and uploaded file.
+
+        Args:
+            pdf_path: Path to the source PDF.
+            output_dir: Directory to save the page PDFs.
+            page_numbers: 0-based pages to copy.
+
+        Returns:
+            The page PDF paths, in the order of `page_numbers`.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(pdf_path))[0]
+        page_paths = []
+        with fitz.open(pdf_path) as doc:
+            for page_number in page_numbers:
+                page_path = os.path.join(output_dir, f"{name}_page{page_number+1}.pdf")
+                with fitz.open() as single:
+                    single.insert_pdf(doc, from_page=page_number, to_page=page_number)
+                    single.save(page_path, no_new_id=True)
+                page_paths.append(page_path)
+        return page_paths
+
+    @staticmethod
+    def page_fingerprints(pdf_path: str, dpi: int = 72) -> list[str]:
+        """
+        Returns a hash of each page's rendered content, in page order.
+
+        Hashing what the page looks like rather than its PDF objects keeps the
+        fingerprint stable when a document is re-exported after an edit
+        elsewhere, which renumbers objects and re-subsets fonts.
+
+        Args:
+            pdf_path: Path to the PDF file.
+            dpi: Render resolution; high enough that a changed symbol changes pixels.
+        """
+        fingerprints = []
+        with fitz.open(pdf_path) as doc:
+            for page in doc:
+                pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+                digest = hashlib.sha256(f"{pix.width}x{pix.height}:".encode("ascii"))
+                digest.update(pix.samples)
+                fingerprints.append(digest.hexdigest())
+        return fingerprints
@@ -0,0 +1,183 @@
+# handlers/remote_files.py
+
+import asyncio
+import atexit
+import hashlib
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from .llm_client import LLMClient, get_llm_client
+from utils.tracing import tracer
+
+
+class RemoteFileManager:
+    """
+    Uploads documents to Gemini once and shares the handles.
+
+    Files are keyed by the SHA-256 of their contents, so the same document is
+    uploaded once even when several stages, shards or jobs need it at the same
+    time. A handle is deleted remotely once nobody holds it and it has been
+    idle for `idle_ttl` seconds, and every remaining handle is deleted at exit.
+    """
+
+    def __init__(self, idle_ttl: float = 600.0, client: LLMClient | None = None):
+        """
+        Args:
+            idle_ttl: Seconds an unused upload is kept for reuse by later jobs.
+                0 deletes a file as soon as its last user releases it.
+            client: Rate limiting and retries for uploads. Defaults to the process-wide client.
+        """
+        self.idle_ttl = idle_ttl
+        self.client = client if client is not None else get_llm_client()
+        self._lock = threading.Lock()
+        # sha256 -> {"file": handle or None, "refs": int, "idle_since": float, "ready": Event}
+        self._entries = {}
+        self.uploads = 0
+        self.reuses = 0
+        atexit.register(self.delete_all)
+
+    @staticmethod
+    def _hash_file(path: str) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def acquire(self, path: str, display_name: str | None = None):
+        """
+        Returns a remote handle for the file at `path`, uploading it if needed.
+
+        Concurrent callers asking for the same content wait for a single upload.
+        Every acquire must be paired with a `release` of the returned handle.
+        """
+        self.sweep()
+        key = self._hash_file(path)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {
+                    "file": None, "refs": 0, "idle_since": None, "ready": threading.Event(),
+                }
+                uploader = True
+            else:
+                uploader = False
+            entry["refs"] += 1
+            entry["idle_since"] = None
+
+        if uploader:
+            import google.generativeai as genai
+
+            try:
+                with tracer.span("llm.upload") as span:
+                    entry["file"] = self.client.call(
+                        lambda: genai.upload_file(
+                            path=path, display_name=display_name or os.path.basename(path)
+                        ),
+                        span,
+                    )
+                with self._lock:
+                    self.uploads += 1
+                print(f"Uploaded '{entry['file'].display_name}' to Gemini.")
+            except Exception:
+                with self._lock:
+                    del self._entries[key]
+                raise
+            finally:
+                entry["ready"].set()
+        else:
+            entry["ready"].wait()
+            if entry["file"] is None:
+                # The upload we were waiting on failed; retry as the uploader.
+                with self._lock:
+                    entry["refs"] -= 1
+                return self.acquire(path, display_name)
+            with self._lock:
+                self.reuses += 1
+
+        return entry["file"]
+
+    def release(self, handle) -> None:
+        """Drops one reference to an upload returned by `acquire`."""
+        with self._lock:
+            entry = next(
+                (e for e in self._entries.values() if e["file"] is not None and e["file"].name == handle.name),
+                None,
+            )
+            if entry is None:
+                return
+            entry["refs"] -= 1
+            if entry["refs"] > 0:
+                return
+            entry["idle_since"] = time.monotonic()
+        if self.idle_ttl <= 0:
+            self.sweep()
+
+    @contextmanager
+    def uploaded(self, path: str, display_name: str | None = None):
+        """Context manager form of acquire/release."""
+        handle = self.acquire(path, display_name)
+        try:
+            yield handle
+        finally:
+            self.release(handle)
+
+    @asynccontextmanager
+    async def uploaded_async(self, path: str, display_name: str | None = None):
+        """
+        Async form of `uploaded`.
+
+        The Gemini SDK only uploads synchronously, so the upload (and any
+        deletion triggered by the release) runs in a worker thread.
+        """
+        handle = await asyncio.to_thread(self.acquire, path, display_name)
+        try:
+            yield handle
+        finally:
+            await asyncio.to_thread(self.release, handle)
+
+    def _delete(self, handle) -> None:
+        import google.generativeai as genai
+
+        try:
+            genai.delete_file(handle.name)
+            print(f"Cleaned up uploaded file: {handle.display_name}")
+        except Exception as e:
+            print(f"Failed to delete uploaded file {handle.name}: {e}")
+
+    def sweep(self) -> None:
+        """Deletes uploads that have been idle for longer than `idle_ttl`."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                key for key, entry in self._entries.items()
+                if entry["refs"] == 0 and entry["idle_since"] is not None
+                and now - entry["idle_since"] >= self.idle_ttl
+            ]
+            handles = [self._entries.pop(key)["file"] for key in expired]
+        for handle in handles:
+            self._delete(handle)
+
+    def delete_all(self) -> None:
+        """Deletes every tracked upload, regardless of references."""
+        with self._lock:
+            handles = [entry["file"] for entry in self._entries.values() if entry["file"] is not None]
+            self._entries.clear()
+        for handle in handles:
+            self._delete(handle)
+
+
+_default_manager = None
+_default_manager_lock = threading.Lock()
+
+
+def get_remote_file_manager() -> RemoteFileManager:
+    """Returns the process-wide manager. TEXIFY_REMOTE_FILE_TTL sets its idle TTL in seconds."""
+    global _default_manager
+    with _default_manager_lock:
+        if _default_manager is None:
+            _default_manager = RemoteFileManager(float(os.getenv("TEXIFY_REMOTE_FILE_TTL", "600")))
+        return _default_manager
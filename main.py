@@ -1,18 +1,70 @@
+import time
+
+_START = time.perf_counter()
+
 import argparse
-from dotenv import load_dotenv
-from document_processor import DocumentProcessor
+import importlib
+import os
+import sys
 
+# Only the standard library is imported up front, so argument parsing and
+# --help stay fast. The pipeline and its heavy dependencies (fitz, PIL,
+# google.generativeai) are imported once the arguments are known.
+
+# Modules reported by --profile-startup, roughly in the order a run loads them.
+PROFILED_MODULES = (
+    "dotenv",
+    "aiofiles",
+    "PIL.Image",
+    "fitz",
+    "google.generativeai",
+    "handlers.llm_backend",
+    "handlers.pdf_handler",
+    "handlers.llm_handler",
+    "document_processor",
+    "batch_processor",
+)
 
-def main():
-    # Load environment variables from .env file
-    load_dotenv(override=True)
 
+def profile_startup(parsed_at: float) -> None:
+    """
+    Prints the time to argument parsing and what each heavy module costs to import.
+
+    Modules are imported in order, so each one's time excludes the
+    dependencies an earlier line already loaded. For a full tree, run
+    `python -X importtime main.py ...`.
+    """
+    print(f"Startup to argument parsing: {(parsed_at - _START) * 1000:.1f} ms")
+    print("Import times:")
+    total = 0.0
+    for name in PROFILED_MODULES:
+        if name in sys.modules:
+            print(f"  {name:<24} already loaded")
+            continue
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f"  {name:<24} not available ({e})")
+            continue
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        print(f"  {name:<24} {elapsed * 1000:8.1f} ms")
+    print(f"  {'total':<24} {total * 1000:8.1f} ms")
+
+
+def main():
     parser = argparse.ArgumentParser(
         description="Convert an image or PDF file to a LaTeX document with generated figures.",
         formatter_class=argparse.RawTextHelpFormatter,
     )
     parser.add_argument(
-        "input_file", type=str, help="Path to the input image or PDF file."
+        "inputs",
+        type=str,
+        nargs="*",
+        help="Path to the input image or PDF file. Several files, directories,\n"
+        "globs (e.g. 'scans/**/*.pdf') or @manifest files (one path per line)\n"
+        "switch to batch mode: each document gets its own folder in the output directory.",
     )
     parser.add_argument(
         "-o",
@@ -32,13 +84,130 @@ def main():
         "  summarizing: Summarize the text.\n"
         "  verbatim:    Keep original text, but format it. (default)",
     )
+    parser.add_argument(
+        "--pages-per-shard",
+        type=int,
+        default=None,
+        help="Split long documents into chunks of this many pages and process\n"
+        "the chunks concurrently (default: process the whole document at once).",
+    )
+    parser.add_argument(
+        "--shard-workers",
+        type=int,
+        default=4,
+        help="Maximum number of chunks processed concurrently (default: 4).",
+    )
+    parser.add_argument(
+        "--as-document",
+        action="store_true",
+        help="Combine all input images (PNG/JPEG), in name order, into one\n"
+        "document with one page per image, instead of converting them separately.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Convert page by page and remember every page, so converting a\n"
+        "revised document again only redoes the pages that changed.",
+    )
+    parser.add_argument(
+        "--pdf",
+        action="store_true",
+        help="Also build the PDF with pdflatex; build errors are reported\n"
+        "without failing the conversion.",
+    )
+    parser.add_argument(
+        "--backend",
+        type=str,
+        choices=["gemini", "fake"],
+        default=None,
+        help="LLM backend to use (default: $TEXIFY_LLM_BACKEND or 'gemini').\n"
+        "  fake: local deterministic responses, for offline runs and benchmarks.",
+    )
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Run the pipeline on an asyncio event loop instead of worker threads.\n"
+        "Batch mode always does.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Batch mode: maximum number of documents converted at once (default: 8).",
+    )
+    parser.add_argument(
+        "--progress",
+        type=str,
+        default=None,
+        help="Batch mode: progress manifest used to resume an interrupted batch\n"
+        "(default: <output_dir>/batch-progress.jsonl).",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Batch mode: ignore the progress manifest and convert everything again.",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="Report the time to argument parsing and the import time of the\n"
+        "heavy dependencies, then exit. No input is needed.",
+    )
 
     args = parser.parse_args()
+    if args.profile_startup:
+        profile_startup(time.perf_counter())
+        return
+    if not args.inputs:
+        parser.error("the following arguments are required: inputs")
+
+    import asyncio
+
+    from dotenv import load_dotenv
+
+    from batch_processor import BatchProcessor, collect_inputs
+    from document_processor import DocumentProcessor
+    from handlers.llm_backend import get_llm_backend
+
+    # Load environment variables from .env file
+    load_dotenv(override=True)
+
+    single = args.inputs[0]
+    if args.as_document:
+        single = collect_inputs(args.inputs)
+    elif len(args.inputs) > 1 or not os.path.isfile(single):
+        batch = BatchProcessor(
+            collect_inputs(args.inputs),
+            output_dir=args.output_dir,
+            text_mode=args.mode,
+            concurrency=args.concurrency,
+            progress_path=args.progress,
+            resume=not args.restart,
+            pages_per_shard=args.pages_per_shard,
+            max_shard_workers=args.shard_workers,
+            incremental=args.incremental,
+            compile_pdf=args.pdf,
+            llm=get_llm_backend(args.backend),
+        )
+        batch.run()
+        batch.print_summary()
+        return
 
     processor = DocumentProcessor(
-        input_path=args.input_file, output_dir=args.output_dir, text_mode=args.mode
+        input_path=single,
+        output_dir=args.output_dir,
+        text_mode=args.mode,
+        pages_per_shard=args.pages_per_shard,
+        max_shard_workers=args.shard_workers,
+        incremental=args.incremental,
+        compile_pdf=args.pdf,
+        llm=get_llm_backend(args.backend),
     )
-    processor.process()
+    if args.use_async:
+        asyncio.run(processor.process_async())
+    else:
+        processor.process()
 
 
 if __name__ == "__main__":
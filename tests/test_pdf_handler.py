@@ -0,0 +1,21 @@
+import fitz
+
+from handlers.pdf_handler import PDFHandler
+
+
+def _make_pdf(path, page_count):
+    with fitz.open() as doc:
+        for number in range(page_count):
+            doc.new_page().insert_text((72, 72), f"Page {number + 1}")
+        doc.save(str(path))
+
+
+def test_split_pages_is_byte_identical_across_runs(tmp_path):
+    source = tmp_path / "source.pdf"
+    _make_pdf(source, 3)
+
+    first = PDFHandler.split_pages(str(source), str(tmp_path / "first"), [1])
+    second = PDFHandler.split_pages(str(source), str(tmp_path / "second"), [1])
+
+    with open(first[0], "rb") as a, open(second[0], "rb") as b:
+        assert a.read() == b.read()
@@ -0,0 +1,110 @@
+# utils/asy_diagnostics.py
+"""
+Short, model-readable diagnostics for generated Asymptote code.
+
+`check_asymptote` is a cheap local screen for the mistakes behind most failed
+compiles of model output: unbalanced brackets, unterminated strings or
+comments, and leftover markdown or LaTeX. It runs in microseconds, so such
+code goes straight back to the model instead of through a full `asy` run.
+Passing it says nothing about whether the code compiles.
+
+`summarize_asy_errors` condenses the output of a failed `asy` run into the
+few lines a repair prompt needs.
+"""
+import re
+
+CLOSERS = {")": "(", "]": "[", "}": "{"}
+
+# Upper bound on a diagnostic's length, so a flood of errors can't bloat the repair prompt.
+MAX_DIAGNOSTIC_CHARS = 800
+
+# e.g. "figure1.asy: 12.7: no matching function 'draw(pair)'"
+_ASY_ERROR = re.compile(r"\.asy: (\d+)\.(\d+): (.+)$")
+
+
+def _at_line(lines: list[str], number: int, message: str) -> str:
+    """Formats `message` with the offending source line, if it exists."""
+    if 1 <= number <= len(lines) and lines[number - 1].strip():
+        return f"line {number}: {message}\n    {lines[number - 1].strip()}"
+    return f"line {number}: {message}"
+
+
+def check_asymptote(code: str) -> str | None:
+    """
+    Returns a diagnostic for the first syntax problem found, or None if the code looks well-formed.
+    """
+    if not code.strip():
+        return "The code is empty."
+    if "```" in code:
+        return "The code contains a markdown fence (```). Return only the Asymptote code."
+
+    lines = code.splitlines()
+    stack = []  # (opening bracket, line number)
+    line = 1
+    i = 0
+    while i < len(code):
+        char = code[i]
+        if char == "\n":
+            line += 1
+        elif code.startswith("//", i):
+            end = code.find("\n", i)
+            i = len(code) if end == -1 else end
+            continue
+        elif code.startswith("/*", i):
+            end = code.find("*/", i + 2)
+            if end == -1:
+                return _at_line(lines, line, "'/*' comment is never closed.")
+            line += code.count("\n", i, end)
+            i = end + 2
+            continue
+        elif char in "\"'":
+            start_line = line
+            i += 1
+            while i < len(code) and code[i] != char:
+                if code[i] == "\\":
+                    i += 1
+                elif code[i] == "\n":
+                    line += 1
+                i += 1
+            if i >= len(code):
+                return _at_line(lines, start_line, f"string starting with {char} is never closed.")
+        elif char in "([{":
+            stack.append((char, line))
+        elif char in CLOSERS:
+            if not stack:
+                return _at_line(lines, line, f"'{char}' has no matching '{CLOSERS[char]}'.")
+            opener, opened_on = stack.pop()
+            if opener != CLOSERS[char]:
+                return _at_line(lines, line, f"'{char}' closes '{opener}' opened on line {opened_on}.")
+        elif char == "\\" and (code.startswith("\\documentclass", i) or code.startswith("\\begin{document}", i)):
+            return _at_line(lines, line, "LaTeX document markup outside a string. Return only Asymptote code.")
+        i += 1
+
+    if stack:
+        opener, opened_on = stack[-1]
+        return _at_line(lines, opened_on, f"'{opener}' is never closed.")
+    return None
+
+
+def summarize_asy_errors(output: str, code: str) -> str:
+    """
+    Condenses `asy` output into its first few errors, each with the offending source line.
+
+    Falls back to the last lines of the output when it has no located errors,
+    e.g. when LaTeX failed on a label.
+    """
+    lines = code.splitlines()
+    errors = []
+    for raw in output.splitlines():
+        match = _ASY_ERROR.search(raw)
+        if match:
+            number, column, message = int(match[1]), match[2], match[3].strip()
+            error = _at_line(lines, number, f"(column {column}) {message}")
+            if error not in errors:
+                errors.append(error)
+        if len(errors) == 3:
+            break
+    if not errors:
+        errors = [raw.strip() for raw in output.splitlines() if raw.strip()][-5:]
+    summary = "\n".join(errors) or "asy failed without any output."
+    return summary[:MAX_DIAGNOSTIC_CHARS]
@@ -0,0 +1,32 @@
+# utils/file_types.py
+"""Detects supported input types from their leading bytes instead of the file extension."""
+
+# The PDF spec allows junk before the header, so search the first KiB for it.
+SNIFF_BYTES = 1024
+
+IMAGE_TYPES = (".png", ".jpg")
+
+
+def sniff_file_type(header: bytes) -> str | None:
+    """
+    Identifies a supported file type from its first bytes.
+
+    Args:
+        header: At least the first SNIFF_BYTES bytes of the file (fewer for tiny files).
+
+    Returns:
+        The canonical extension ('.pdf', '.png' or '.jpg'), or None if unsupported.
+    """
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if b"%PDF-" in header[:SNIFF_BYTES]:
+        return ".pdf"
+    return None
+
+
+def sniff_path(path: str) -> str | None:
+    """Identifies the type of the file at `path`. See sniff_file_type."""
+    with open(path, "rb") as f:
+        return sniff_file_type(f.read(SNIFF_BYTES))
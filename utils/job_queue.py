@@ -0,0 +1,181 @@
+# utils/job_queue.py
+import asyncio
+import queue
+import threading
+import time
+
+from utils import tracing
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted to a queue that has no free slots."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Job queue is full, retry in {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class JobQueue:
+    """A bounded job queue drained by a fixed pool of worker threads."""
+
+    def __init__(self, workers: int = 2, max_queued: int = 32):
+        """
+        Args:
+            workers: Number of jobs processed concurrently.
+            max_queued: Number of jobs that may wait for a worker before
+                submissions are rejected.
+        """
+        self.workers = workers
+        self.max_queued = max_queued
+        self._queue = self._make_queue()
+        self._lock = threading.Lock()
+        self._active = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._total_run = 0.0
+        self._start_workers()
+
+    def _make_queue(self):
+        return queue.Queue(maxsize=self.max_queued)
+
+    def _start_workers(self) -> None:
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job_id, fn, *args) -> None:
+        """
+        Enqueues `fn(*args)` to be run by a worker.
+
+        Raises:
+            QueueFullError: If the queue is at capacity.
+        """
+        try:
+            self._queue.put_nowait((job_id, fn, args, time.monotonic()))
+        except (queue.Full, asyncio.QueueFull):
+            raise self._reject() from None
+
+    def check_capacity(self) -> None:
+        """
+        Rejects a job up front, e.g. before reading its upload, when the queue is full.
+
+        Raises:
+            QueueFullError: If the queue is at capacity.
+        """
+        if self._queue.full():
+            raise self._reject()
+
+    def _reject(self) -> QueueFullError:
+        """Counts a rejected job and returns the error to raise."""
+        with self._lock:
+            self._rejected += 1
+        tracing.metrics.inc("texify_jobs_rejected_total", help_text="Jobs rejected because the queue was full.")
+        return QueueFullError(self.retry_after())
+
+    def retry_after(self) -> int:
+        """Estimates how many seconds a rejected client should wait before retrying."""
+        with self._lock:
+            finished = self._completed + self._failed
+            avg_run = self._total_run / finished if finished else 30.0
+        return max(1, int(avg_run * (self._queue.qsize() + 1) / self.workers))
+
+    def _job_started(self, job_id, enqueued_at: float) -> float:
+        """Books a job as running. Returns its start time."""
+        wait = time.monotonic() - enqueued_at
+        with self._lock:
+            self._active += 1
+            self._total_wait += wait
+            self._max_wait = max(self._max_wait, wait)
+        tracing.metrics.observe(
+            "texify_queue_wait_seconds", wait, help_text="Time jobs spend queued before a worker picks them up."
+        )
+        return time.monotonic()
+
+    def _job_finished(self, job_id, state: str, start: float) -> None:
+        with self._lock:
+            self._active -= 1
+            self._total_run += time.monotonic() - start
+            if state == "done":
+                self._completed += 1
+            else:
+                self._failed += 1
+
+    def _worker(self) -> None:
+        while True:
+            job_id, fn, args, enqueued_at = self._queue.get()
+            start = self._job_started(job_id, enqueued_at)
+            try:
+                fn(*args)
+                state = "done"
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                state = "failed"
+            finally:
+                self._queue.task_done()
+            self._job_finished(job_id, state, start)
+
+    def metrics(self) -> dict:
+        """Returns queue depth, worker utilisation and wait-time statistics."""
+        with self._lock:
+            started = self._active + self._completed + self._failed
+            return {
+                "depth": self._queue.qsize(),
+                "max_queued": self.max_queued,
+                "workers": self.workers,
+                "active": self._active,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "avg_wait_seconds": self._total_wait / started if started else 0.0,
+                "max_wait_seconds": self._max_wait,
+            }
+
+
+class AsyncJobQueue(JobQueue):
+    """
+    A JobQueue whose jobs are coroutines, drained by worker tasks on one event loop.
+
+    A waiting job costs a queue entry rather than a thread, so `workers` can be
+    far larger than for JobQueue; the global limits in utils.limits still cap
+    LLM calls and `asy` processes. Workers start on the first `submit`, which
+    must be called from the event loop.
+    """
+
+    def _make_queue(self):
+        return asyncio.Queue(maxsize=self.max_queued)
+
+    def _start_workers(self) -> None:
+        self._tasks = []
+
+    def submit(self, job_id, fn, *args) -> None:
+        """
+        Enqueues the coroutine function `fn(*args)` to be awaited by a worker.
+
+        Raises:
+            QueueFullError: If the queue is at capacity.
+        """
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._worker(), name=f"job-worker-{i}") for i in range(self.workers)
+            ]
+        super().submit(job_id, fn, *args)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id, fn, args, enqueued_at = await self._queue.get()
+            start = self._job_started(job_id, enqueued_at)
+            try:
+                await fn(*args)
+                state = "done"
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                state = "failed"
+            finally:
+                self._queue.task_done()
+            self._job_finished(job_id, state, start)
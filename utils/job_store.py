@@ -0,0 +1,270 @@
+# utils/job_store.py
+"""
+Persistent job records for the API.
+
+Jobs, their state transitions, per-stage progress, errors and timings live in
+one SQLite database in WAL mode, so every uvicorn worker process sees the same
+jobs, status lookups are single indexed reads, and nothing is lost on restart.
+Progress events are appended to an ordered log per job, which event streams
+replay and follow.
+"""
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          TEXT PRIMARY KEY,
+    state       TEXT NOT NULL,
+    input_path  TEXT,
+    output_dir  TEXT,
+    sha256      TEXT,
+    owner       TEXT,
+    error       TEXT,
+    timings     TEXT,
+    created_at  REAL NOT NULL,
+    started_at  REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at);
+
+CREATE TABLE IF NOT EXISTS stages (
+    job_id      TEXT NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    name        TEXT NOT NULL,
+    state       TEXT NOT NULL,
+    started_at  REAL NOT NULL,
+    duration    REAL,
+    error       TEXT,
+    PRIMARY KEY (job_id, name)
+);
+
+CREATE TABLE IF NOT EXISTS events (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id      TEXT NOT NULL REFERENCES jobs (id) ON DELETE CASCADE,
+    kind        TEXT NOT NULL,
+    data        TEXT NOT NULL,
+    created_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_job ON events (job_id, id);
+"""
+
+# Job states, in order. 'done' and 'failed' are final.
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class JobStore:
+    """
+    SQLite-backed job records shared by every API worker process.
+
+    Each thread gets its own connection. Writes are short single statements,
+    so concurrent workers only wait on each other for a few milliseconds.
+    """
+
+    def __init__(self, path: str):
+        """
+        Args:
+            path: Database file. Created, with its directory, if missing.
+        """
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Identifies the process that owns a job, so a restart can tell its
+        # own abandoned jobs from ones another live worker is still running.
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._local = threading.local()
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            # WAL makes NORMAL durable against application crashes, which is all a job record needs.
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA foreign_keys=ON")
+            self._local.db = db
+        return db
+
+    def create(self, job_id: str, input_path: str, output_dir: str, sha256: str | None = None) -> None:
+        """Records a new job in the 'queued' state."""
+        self._connect().execute(
+            "INSERT INTO jobs (id, state, input_path, output_dir, sha256, owner, created_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, QUEUED, input_path, output_dir, sha256, self.owner, time.time()),
+        )
+
+    def delete(self, job_id: str) -> None:
+        """Forgets a job without touching its files, e.g. when it could not be queued."""
+        self._connect().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def mark_running(self, job_id: str) -> None:
+        self._connect().execute(
+            "UPDATE jobs SET state = ?, owner = ?, started_at = ? WHERE id = ?",
+            (RUNNING, self.owner, time.time(), job_id),
+        )
+
+    def mark_done(self, job_id: str, timings: dict | None = None) -> None:
+        self._finish(job_id, DONE, None, timings)
+
+    def mark_failed(self, job_id: str, error: str, timings: dict | None = None) -> None:
+        self._finish(job_id, FAILED, error, timings)
+
+    def _finish(self, job_id: str, state: str, error: str | None, timings: dict | None) -> None:
+        self._connect().execute(
+            "UPDATE jobs SET state = ?, error = ?, timings = ?, finished_at = ? WHERE id = ?",
+            (state, error, json.dumps(timings) if timings else None, time.time(), job_id),
+        )
+
+    def record_stage(
+        self, job_id: str, name: str, state: str, duration: float | None = None, error: str | None = None
+    ) -> None:
+        """
+        Records a stage event. Matches the StageGraph `on_event` signature once
+        bound to a job id.
+
+        Args:
+            state: 'running' when the stage starts, then 'done' or 'failed'.
+        """
+        db = self._connect()
+        if state == RUNNING:
+            db.execute(
+                "INSERT OR REPLACE INTO stages (job_id, name, state, started_at) VALUES (?, ?, ?, ?)",
+                (job_id, name, state, time.time()),
+            )
+        else:
+            db.execute(
+                "UPDATE stages SET state = ?, duration = ?, error = ? WHERE job_id = ? AND name = ?",
+                (state, duration, error, job_id, name),
+            )
+
+    def add_event(self, job_id: str, kind: str, data: dict) -> int:
+        """Appends a progress event to the job's log. Returns its id, which increases per job."""
+        cursor = self._connect().execute(
+            "INSERT INTO events (job_id, kind, data, created_at) VALUES (?, ?, ?, ?)",
+            (job_id, kind, json.dumps(data), time.time()),
+        )
+        return cursor.lastrowid
+
+    def events_since(self, job_id: str, after_id: int = 0) -> list[dict]:
+        """Returns the job's events with an id greater than `after_id`, oldest first."""
+        rows = self._connect().execute(
+            "SELECT id, kind, data, created_at FROM events WHERE job_id = ? AND id > ? ORDER BY id",
+            (job_id, after_id),
+        )
+        return [
+            {"id": row["id"], "kind": row["kind"], "data": json.loads(row["data"]), "created_at": row["created_at"]}
+            for row in rows
+        ]
+
+    def get(self, job_id: str) -> dict | None:
+        """Returns the job record with its stages in start order, or None for unknown jobs."""
+        db = self._connect()
+        row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["timings"] = json.loads(job["timings"]) if job["timings"] else None
+        job["stages"] = [
+            dict(stage) for stage in db.execute(
+                "SELECT name, state, started_at, duration, error FROM stages"
+                " WHERE job_id = ? ORDER BY started_at",
+                (job_id,),
+            )
+        ]
+        return job
+
+    def state(self, job_id: str) -> str | None:
+        """Returns just the job's state; cheaper than `get` for polling."""
+        row = self._connect().execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row["state"] if row else None
+
+    def counts(self) -> dict:
+        """Returns the number of jobs in each state."""
+        rows = self._connect().execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state")
+        return {row["state"]: row["n"] for row in rows}
+
+    def recover_orphans(self) -> int:
+        """
+        Fails unfinished jobs whose owning process on this host is gone.
+
+        Call at startup: without it, jobs interrupted by a restart would stay
+        'queued' or 'running' forever. Returns the number of jobs failed.
+        """
+        host = socket.gethostname()
+        db = self._connect()
+        rows = db.execute(
+            "SELECT id, owner FROM jobs WHERE state IN (?, ?)", (QUEUED, RUNNING)
+        ).fetchall()
+        orphans = []
+        for row in rows:
+            owner_host, _, pid = (row["owner"] or "").rpartition(":")
+            if owner_host == host and pid.isdigit() and not _process_alive(int(pid)):
+                orphans.append(row["id"])
+        error = "Interrupted by a server restart."
+        for job_id in orphans:
+            db.execute(
+                "UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE id = ? AND state IN (?, ?)",
+                (FAILED, error, time.time(), job_id, QUEUED, RUNNING),
+            )
+            # Event streams only end on a final event.
+            self.add_event(job_id, FAILED, {"error": error})
+        return len(orphans)
+
+    def sweep(self, ttl: float) -> int:
+        """
+        Deletes jobs that finished more than `ttl` seconds ago, with their input and output directory.
+
+        Safe to run from several workers at once: each expired job is claimed
+        by exactly one of them. Returns the number of jobs removed.
+        """
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            expired = db.execute(
+                "SELECT id, input_path, output_dir FROM jobs WHERE finished_at < ?",
+                (time.time() - ttl,),
+            ).fetchall()
+            db.executemany("DELETE FROM jobs WHERE id = ?", [(row["id"],) for row in expired])
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+        for row in expired:
+            if row["input_path"] and os.path.isfile(row["input_path"]):
+                os.remove(row["input_path"])
+            elif row["input_path"] and os.path.isdir(row["input_path"]):
+                # Multi-page submissions keep their images in a folder.
+                shutil.rmtree(row["input_path"], ignore_errors=True)
+            if row["output_dir"]:
+                shutil.rmtree(row["output_dir"], ignore_errors=True)
+        return len(expired)
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_job_store() -> JobStore:
+    """Returns the process-wide store at TEXIFY_JOB_DB (default: .texify/jobs.db)."""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = JobStore(os.getenv("TEXIFY_JOB_DB", os.path.join(".texify", "jobs.db")))
+        return _default_store
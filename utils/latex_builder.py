@@ -0,0 +1,400 @@
+# utils/latex_builder.py
+"""
+Builds the PDF of a finished document on the server.
+
+pdflatex runs as sandboxed, short-lived processes drawn from a process-wide
+pool (`latex_slots` in utils.limits), each with a deadline, so clients get a
+PDF, or an early compile error, instead of a .tex file to build themselves.
+
+Most of a cold pdflatex run is loading the document class and packages.
+Documents whose preamble is the one the text prompt mandates (article with
+amsmath, amssymb, amsfonts, xcolor and graphics) are built from a format file
+with that preamble already loaded, which is dumped once per process. Builds
+are cached by their source and the figures they include.
+
+The sandbox: no shell escape, kpathsea's paranoid mode for reads and writes
+(nothing outside the job directory, no dotfiles), and CPU, memory and output
+size limits on the process.
+"""
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import NamedTuple
+
+from utils.limits import latex_slots
+from utils.result_cache import ResultCache, get_default_cache
+from utils.tracing import metrics, tracer
+
+# Loaded into the precompiled format; must match the text prompt in handlers.llm_handler.
+PRELOADED_PACKAGES = ("amsmath", "amssymb", "amsfonts", "xcolor", "graphics")
+DOCUMENT_CLASS = "\\documentclass{article}"
+PREAMBLE = "\n".join([DOCUMENT_CLASS] + [f"\\usepackage{{{name}}}" for name in PRELOADED_PACKAGES])
+
+# Upper bound on a diagnostic's length, like utils.asy_diagnostics.
+MAX_DIAGNOSTIC_CHARS = 800
+MEMORY_LIMIT_BYTES = int(os.getenv("TEXIFY_LATEX_MEMORY_MB", "1024")) * 1024 * 1024
+OUTPUT_LIMIT_BYTES = 256 * 1024 * 1024
+
+_INCLUDE = re.compile(r"\\includegraphics\s*(?:\[[^\]]*\])?\s*\{([^}]+)\}")
+_OPTIONED_PACKAGE = re.compile(r"\\usepackage\s*\[[^\]]*\]\s*\{([^}]+)\}")
+_RERUN = re.compile(r"Rerun to get|Label\(s\) may have changed")
+_FORMAT_ERROR = re.compile(r"Fatal format file error|can't find the format file")
+
+
+class BuildResult(NamedTuple):
+    """The outcome of one PDF build. Truthy exactly when it succeeded."""
+    success: bool
+    pdf_path: str | None = None
+    # Why the build failed: the first LaTeX errors, condensed.
+    diagnostic: str | None = None
+
+    def __bool__(self):
+        return self.success
+
+
+def summarize_latex_log(log: str) -> str:
+    """Condenses a pdflatex log into its first few errors, each with the line TeX stopped at."""
+    lines = log.splitlines()
+    errors = []
+    for i, line in enumerate(lines):
+        if not line.startswith("! "):
+            continue
+        # TeX follows an error with its context; the "l.<n>" line locates it.
+        where = next((l.strip() for l in lines[i + 1:i + 12] if l.startswith("l.")), "")
+        errors.append(f"{line[2:].strip()} {where}".strip())
+        if len(errors) == 3:
+            break
+    if not errors:
+        errors = [line.strip() for line in lines if line.strip()][-5:]
+    summary = "\n".join(errors) or "pdflatex failed without any output."
+    return summary[:MAX_DIAGNOSTIC_CHARS]
+
+
+def strip_preloaded_preamble(source: str) -> str | None:
+    """
+    Returns `source` ready to build on the precompiled format, or None if it needs a cold build.
+
+    The format has already run \\documentclass{article}, so that line is
+    removed; repeated \\usepackage lines are no-ops. Documents with another
+    class, or options on a preloaded package, would clash with the format.
+    """
+    preamble, begin, _ = source.partition("\\begin{document}")
+    if not begin:
+        return None
+    code_lines = [line.strip() for line in preamble.splitlines() if line.strip() and not line.lstrip().startswith("%")]
+    if not code_lines or code_lines[0] != DOCUMENT_CLASS or preamble.count("\\documentclass") != 1:
+        return None
+    if any(name.strip() in PRELOADED_PACKAGES for match in _OPTIONED_PACKAGE.finditer(preamble)
+           for name in match[1].split(",")):
+        return None
+    # Keep the line count, so error line numbers still match the .tex file.
+    return source.replace(DOCUMENT_CLASS, "", 1)
+
+
+# Sets the limits and execs the command, in a fresh single-threaded interpreter.
+# preexec_fn would do the same in the forked child, but is unsafe with threads running.
+_EXEC_WITH_LIMITS = """\
+import os, resource, sys
+cpu, memory, output = map(int, sys.argv[1:4])
+resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+resource.setrlimit(resource.RLIMIT_FSIZE, (output, output))
+os.execvp(sys.argv[4], sys.argv[4:])
+"""
+
+
+def _with_limits(args: list[str], timeout: float) -> list[str]:
+    """Wraps `args` to run under CPU, memory and output size limits."""
+    # Checked here, since inside the wrapper a missing binary is only an exit status.
+    if shutil.which(args[0]) is None:
+        raise FileNotFoundError(f"'{args[0]}' not found")
+    limits = [str(int(timeout) + 1), str(MEMORY_LIMIT_BYTES), str(OUTPUT_LIMIT_BYTES)]
+    return [sys.executable, "-I", "-S", "-c", _EXEC_WITH_LIMITS, *limits, *args]
+
+
+class LatexBuilder:
+    """Compiles finished .tex files to PDF in sandboxed pdflatex processes."""
+
+    BUILD_TIMEOUT = float(os.getenv("TEXIFY_LATEX_TIMEOUT", "60"))
+
+    def __init__(self, cache: ResultCache | None = None, format_dir: str | None = None):
+        """
+        Args:
+            cache: Cache for built PDFs, keyed by source and figures.
+                Defaults to the process-wide cache.
+            format_dir: Where the precompiled preamble format is kept.
+                Defaults to TEXIFY_LATEX_FORMAT_DIR or '.cache/texify-formats'.
+        """
+        self.cache = cache if cache is not None else get_default_cache()
+        self.format_dir = os.path.abspath(
+            format_dir or os.getenv("TEXIFY_LATEX_FORMAT_DIR", os.path.join(".cache", "texify-formats"))
+        )
+        self._format_lock = threading.Lock()
+        # None: not tried yet; "": the format could not be built, so builds run cold.
+        self._format_name = None
+
+    def _sandbox_env(self) -> dict:
+        env = dict(os.environ)
+        env.update(
+            shell_escape="f",
+            openin_any="p",
+            openout_any="p",
+            # The trailing separator keeps the default format search path.
+            TEXFORMATS=self.format_dir + os.pathsep,
+        )
+        return env
+
+    def _popen_args(self, cwd: str) -> dict:
+        return dict(
+            cwd=cwd,
+            env=self._sandbox_env(),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+
+    def _run(self, args: list[str], cwd: str, timeout: float) -> subprocess.CompletedProcess:
+        """Runs pdflatex in `cwd`, killing its process group if it exceeds `timeout`."""
+        with latex_slots.slot():
+            process = subprocess.Popen(
+                _with_limits(args, timeout), text=True, errors="replace", **self._popen_args(cwd)
+            )
+            try:
+                stdout, _ = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.communicate()
+                raise
+        return subprocess.CompletedProcess(args, process.returncode, stdout)
+
+    async def _run_async(self, args: list[str], cwd: str, timeout: float) -> subprocess.CompletedProcess:
+        """Async form of `_run`, raising the same exceptions."""
+        async with latex_slots.slot_async():
+            process = await asyncio.create_subprocess_exec(*_with_limits(args, timeout), **self._popen_args(cwd))
+            try:
+                stdout, _ = await asyncio.wait_for(process.communicate(), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                os.killpg(process.pid, signal.SIGKILL)
+                if isinstance(e, asyncio.CancelledError):
+                    # Reap it even though this task is being cancelled, or it stays a zombie.
+                    await asyncio.shield(process.wait())
+                    raise
+                await process.wait()
+                raise subprocess.TimeoutExpired(args, timeout) from None
+        return subprocess.CompletedProcess(args, process.returncode, stdout.decode(errors="replace"))
+
+    def _format(self) -> str:
+        """
+        Returns the name of the precompiled preamble format, dumping it on first use.
+
+        The name includes the pdflatex version, so a TeX upgrade gets a fresh
+        format instead of failing on the old one. Returns "" if no format can be built.
+        """
+        with self._format_lock:
+            if self._format_name is not None:
+                return self._format_name
+            self._format_name = ""
+            try:
+                version = subprocess.run(
+                    ["pdflatex", "--version"], capture_output=True, text=True, timeout=30
+                ).stdout.split("\n", 1)[0]
+                name = "texify-" + hashlib.sha256(f"{version}\n{PREAMBLE}".encode("utf-8")).hexdigest()[:12]
+                if not os.path.exists(os.path.join(self.format_dir, f"{name}.fmt")):
+                    self._dump_format(name)
+                self._format_name = name
+            except (OSError, subprocess.SubprocessError) as e:
+                print(f"Could not build the LaTeX preamble format; building PDFs without it: {e}")
+            return self._format_name
+
+    def _dump_format(self, name: str) -> None:
+        os.makedirs(self.format_dir, exist_ok=True)
+        # Dumped in a scratch directory and renamed into place, so processes building it at once don't clash.
+        with tempfile.TemporaryDirectory(dir=self.format_dir, prefix="dump-") as work_dir:
+            with open(os.path.join(work_dir, f"{name}.tex"), "w", encoding="utf-8") as f:
+                f.write(PREAMBLE + "\n\\dump\n")
+            args = ["pdflatex", "-ini", "-interaction=nonstopmode", "-halt-on-error",
+                    f"-jobname={name}", "&pdflatex", f"{name}.tex"]
+            with tracer.span("latex.format"):
+                result = self._run(args, work_dir, self.BUILD_TIMEOUT)
+            if result.returncode != 0:
+                raise subprocess.CalledProcessError(result.returncode, args, result.stdout)
+            os.replace(os.path.join(work_dir, f"{name}.fmt"), os.path.join(self.format_dir, f"{name}.fmt"))
+        print(f"Built the LaTeX preamble format {name}.fmt.")
+
+    @staticmethod
+    def _cache_key(source: str, output_dir: str) -> str:
+        """Keys a build by its source and the contents of every figure it includes."""
+        parts = ["pdflatex", source]
+        for path in sorted(set(_INCLUDE.findall(source))):
+            parts.append(path)
+            try:
+                with open(os.path.join(output_dir, path), "rb") as f:
+                    parts.append(hashlib.sha256(f.read()).hexdigest())
+            except OSError:
+                parts.append("missing")
+        return ResultCache.make_key(*parts)
+
+    @staticmethod
+    def _pass_args(jobname: str, work_dir: str, fmt: str) -> list[str]:
+        args = ["pdflatex", "-interaction=nonstopmode", "-halt-on-error", "-no-shell-escape",
+                f"-jobname={jobname}", f"-output-directory={work_dir}"]
+        if fmt:
+            args.append(f"-fmt={fmt}")
+        return args + [os.path.join(work_dir, f"{jobname}.tex")]
+
+    def _plan(self, tex_path: str, fmt: str) -> tuple[str, str, str, str, str]:
+        """Returns (output_dir, jobname, pdf_path, source to compile, format) for a build of `tex_path`."""
+        output_dir = os.path.dirname(os.path.abspath(tex_path))
+        jobname = os.path.splitext(os.path.basename(tex_path))[0]
+        with open(tex_path, encoding="utf-8") as f:
+            source = f.read()
+        stripped = strip_preloaded_preamble(source) if fmt else None
+        if stripped is None:
+            return output_dir, jobname, os.path.join(output_dir, f"{jobname}.pdf"), source, ""
+        return output_dir, jobname, os.path.join(output_dir, f"{jobname}.pdf"), stripped, fmt
+
+    def _finish(self, result, work_dir: str, output_dir: str, jobname: str, pdf_path: str,
+                key: str, kind: str) -> BuildResult:
+        """Moves a successful build into place, or keeps the log of a failed one next to the .tex file."""
+        work_pdf = os.path.join(work_dir, f"{jobname}.pdf")
+        if result.returncode == 0 and os.path.exists(work_pdf):
+            self.cache.put_file("latex_pdf", key, work_pdf)
+            os.replace(work_pdf, pdf_path)
+            self._count(kind)
+            print(f"Built {os.path.basename(pdf_path)}.")
+            return BuildResult(True, pdf_path)
+
+        log_path = os.path.join(work_dir, f"{jobname}.log")
+        log = result.stdout
+        if os.path.exists(log_path):
+            with open(log_path, encoding="utf-8", errors="replace") as f:
+                log = f.read()
+            shutil.copyfile(log_path, os.path.join(output_dir, f"{jobname}.log"))
+        self._count("failed")
+        diagnostic = summarize_latex_log(log)
+        print(f"Failed to build {jobname}.pdf:\n{diagnostic}")
+        return BuildResult(False, diagnostic=diagnostic)
+
+    @staticmethod
+    def _count(result: str) -> None:
+        metrics.inc("texify_latex_builds_total", help_text="PDF builds, by how they were served.", result=result)
+
+    def _failure(self, error: Exception, timeout: float) -> BuildResult:
+        if isinstance(error, FileNotFoundError):
+            diagnostic = "The 'pdflatex' command was not found."
+        elif isinstance(error, subprocess.TimeoutExpired):
+            diagnostic = f"pdflatex did not finish within {timeout:.0f}s."
+        else:
+            diagnostic = f"pdflatex could not run: {error}"
+        print(diagnostic)
+        self._count("failed")
+        return BuildResult(False, diagnostic=diagnostic)
+
+    def _format_broken(self, fmt: str, result: subprocess.CompletedProcess) -> bool:
+        """Forgets a format pdflatex refused to load, e.g. one from another TeX build, so the build reruns cold."""
+        if not fmt or result.returncode == 0 or not _FORMAT_ERROR.search(result.stdout):
+            return False
+        with self._format_lock:
+            self._format_name = ""
+        try:
+            os.remove(os.path.join(self.format_dir, f"{fmt}.fmt"))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def build(self, tex_path: str, timeout: float | None = None) -> BuildResult:
+        """
+        Builds the PDF for `tex_path` next to it, e.g. doc.tex -> doc.pdf.
+
+        Figures are resolved relative to the .tex file's directory. A second
+        pass runs only if LaTeX asks for it to resolve references. On failure
+        the pdflatex log is kept as doc.log.
+
+        Args:
+            tex_path: The document to build.
+            timeout: Seconds for all passes together. Defaults to BUILD_TIMEOUT.
+        """
+        timeout = self.BUILD_TIMEOUT if timeout is None else timeout
+        output_dir, jobname, pdf_path, source, fmt = self._plan(tex_path, self._format())
+        key = self._cache_key(source, output_dir)
+        if self.cache.get_file("latex_pdf", key, pdf_path + ".tmp"):
+            os.replace(pdf_path + ".tmp", pdf_path)
+            self._count("cached")
+            print(f"Built {jobname}.pdf from cache.")
+            return BuildResult(True, pdf_path)
+
+        # Inside output_dir, so figures resolve and paranoid mode allows the writes.
+        with tempfile.TemporaryDirectory(dir=output_dir, prefix="build-") as work_dir:
+            with open(os.path.join(work_dir, f"{jobname}.tex"), "w", encoding="utf-8") as f:
+                f.write(source)
+            args = self._pass_args(jobname, os.path.relpath(work_dir, output_dir), fmt)
+            try:
+                with tracer.span("latex.build", document=jobname, precompiled=bool(fmt)) as span:
+                    deadline = time.monotonic() + timeout
+                    result = self._run(args, output_dir, timeout)
+                    remaining = deadline - time.monotonic()
+                    # Out of time, the first pass's PDF is kept; only its references may show '??'.
+                    if result.returncode == 0 and _RERUN.search(result.stdout) and remaining > 1:
+                        span.set("passes", 2)
+                        result = self._run(args, output_dir, remaining)
+            except (OSError, subprocess.SubprocessError) as e:
+                return self._failure(e, timeout)
+            if self._format_broken(fmt, result):
+                return self.build(tex_path, timeout)
+            return self._finish(result, work_dir, output_dir, jobname, pdf_path, key,
+                                "precompiled" if fmt else "cold")
+
+    async def build_async(self, tex_path: str, timeout: float | None = None) -> BuildResult:
+        """Async form of `build`; pdflatex runs as an asyncio subprocess."""
+        timeout = self.BUILD_TIMEOUT if timeout is None else timeout
+        fmt = await asyncio.to_thread(self._format)
+        output_dir, jobname, pdf_path, source, fmt = await asyncio.to_thread(self._plan, tex_path, fmt)
+        key = await asyncio.to_thread(self._cache_key, source, output_dir)
+        if await asyncio.to_thread(self.cache.get_file, "latex_pdf", key, pdf_path + ".tmp"):
+            os.replace(pdf_path + ".tmp", pdf_path)
+            self._count("cached")
+            print(f"Built {jobname}.pdf from cache.")
+            return BuildResult(True, pdf_path)
+
+        with tempfile.TemporaryDirectory(dir=output_dir, prefix="build-") as work_dir:
+            with open(os.path.join(work_dir, f"{jobname}.tex"), "w", encoding="utf-8") as f:
+                f.write(source)
+            args = self._pass_args(jobname, os.path.relpath(work_dir, output_dir), fmt)
+            try:
+                with tracer.span("latex.build", document=jobname, precompiled=bool(fmt)) as span:
+                    deadline = time.monotonic() + timeout
+                    result = await self._run_async(args, output_dir, timeout)
+                    remaining = deadline - time.monotonic()
+                    if result.returncode == 0 and _RERUN.search(result.stdout) and remaining > 1:
+                        span.set("passes", 2)
+                        result = await self._run_async(args, output_dir, remaining)
+            except (OSError, subprocess.SubprocessError) as e:
+                return self._failure(e, timeout)
+            if self._format_broken(fmt, result):
+                return await self.build_async(tex_path, timeout)
+            return await asyncio.to_thread(
+                self._finish, result, work_dir, output_dir, jobname, pdf_path, key,
+                "precompiled" if fmt else "cold",
+            )
+
+
+_default_builder = None
+_default_builder_lock = threading.Lock()
+
+
+def get_latex_builder() -> LatexBuilder:
+    """Returns the process-wide builder, so the preamble format is dumped once per process."""
+    global _default_builder
+    with _default_builder_lock:
+        if _default_builder is None:
+            _default_builder = LatexBuilder()
+        return _default_builder
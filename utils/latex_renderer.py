@@ -1,58 +1,211 @@
 # utils/latex_renderer.py
+import asyncio
 import subprocess
 import os
+import signal
 import tempfile
+from typing import NamedTuple
+
+import aiofiles
+
+from utils.asy_diagnostics import summarize_asy_errors
+from utils.limits import asy_slots
+from utils.result_cache import ResultCache, get_default_cache
+from utils.tracing import tracer
+
+class CompileResult(NamedTuple):
+    """The outcome of one Asymptote compile. Truthy exactly when it succeeded."""
+    success: bool
+    # Why the compile failed, condensed for a repair prompt.
+    diagnostic: str | None = None
+    # False when compiling again cannot help, e.g. because `asy` is not installed.
+    retryable: bool = True
+
+    def __bool__(self):
+        return self.success
+
 
 class LatexRenderer:
     """A utility to compile Asymptote code."""
 
+    COMPILE_TIMEOUT = float(os.getenv("TEXIFY_ASY_TIMEOUT", "60"))
+
+    def __init__(self, cache: ResultCache | None = None):
+        """
+        Args:
+            cache: Cache for compiled figures, keyed by the Asymptote source.
+                Defaults to the process-wide cache.
+        """
+        self.cache = cache if cache is not None else get_default_cache()
+
     @staticmethod
-    def compile_asymptote(asy_code: str, output_dir: str, filename_base: str) -> bool:
+    def _run_asy(args: list[str], cwd: str, timeout: float) -> subprocess.CompletedProcess:
         """
-        Compiles a string of Asymptote code into a TeX file.
-        
+        Runs `asy` in `cwd`, killing its whole process group if it exceeds `timeout`.
+
+        asy shells out to LaTeX and ghostscript, so killing only the direct
+        child could leave a hung grandchild holding the job.
+        """
+        with asy_slots.slot():
+            process = subprocess.Popen(
+                args,
+                cwd=cwd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+                start_new_session=True,
+            )
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.communicate()
+                raise
+
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args, stdout, stderr)
+        return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+    @staticmethod
+    async def _run_asy_async(args: list[str], cwd: str, timeout: float) -> subprocess.CompletedProcess:
+        """Async form of `_run_asy`, raising the same exceptions."""
+        async with asy_slots.slot_async():
+            process = await asyncio.create_subprocess_exec(
+                *args,
+                cwd=cwd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True,
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                # A cancelled job must not leave its compile running either.
+                os.killpg(process.pid, signal.SIGKILL)
+                if isinstance(e, asyncio.CancelledError):
+                    # Reap it even though this task is being cancelled, or it stays a zombie.
+                    await asyncio.shield(process.wait())
+                    raise
+                await process.wait()
+                raise subprocess.TimeoutExpired(args, timeout) from None
+
+        stdout, stderr = stdout.decode(errors="replace"), stderr.decode(errors="replace")
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args, stdout, stderr)
+        return subprocess.CompletedProcess(args, process.returncode, stdout, stderr)
+
+    @staticmethod
+    def _report_failure(error: Exception, asy_code: str, filename_base: str, timeout: float) -> CompileResult:
+        """Prints why a compile failed and returns the failed CompileResult."""
+        if isinstance(error, FileNotFoundError):
+            print("\n---")
+            print("ERROR: The 'asy' command was not found.")
+            print("Please install Asymptote and ensure it is in your system's PATH.")
+            print("---\n")
+            return CompileResult(False, "The 'asy' command was not found.", retryable=False)
+        if isinstance(error, subprocess.TimeoutExpired):
+            print(f"Timed out compiling {filename_base}.asy after {timeout:.0f}s.")
+            return CompileResult(
+                False,
+                f"asy did not finish within {timeout:.0f}s. Simplify the drawing: "
+                "fewer points and no long loops or deep recursion.",
+            )
+        print(f"Failed to compile {filename_base}.asy.")
+        print(f"Stderr: {error.stderr}")
+        # asy reports some errors on stdout, and LaTeX label errors end up there too.
+        return CompileResult(False, summarize_asy_errors(f"{error.stderr}\n{error.stdout}", asy_code))
+
+    def compile_asymptote(
+        self, asy_code: str, output_dir: str, filename_base: str, timeout: float | None = None
+    ) -> CompileResult:
+        """
+        Compiles a string of Asymptote code into a PDF file.
+
         Note: Requires the 'asy' command-line tool to be installed.
-        
+
+        Each call compiles in its own scratch directory inside `output_dir` and
+        moves the results into place with an atomic rename, so concurrent calls
+        never touch each other's files or the process working directory.
+
         Args:
             asy_code: The Asymptote code as a string.
             output_dir: The directory to save the output files.
             filename_base: The base name for the output file (e.g., 'figure1').
-            
+            timeout: Seconds before the compile is killed. Defaults to COMPILE_TIMEOUT.
+
         Returns:
-            True if compilation was successful, False otherwise.
+            A CompileResult, truthy if compilation was successful. On failure
+            it carries a short diagnostic built from asy's output.
         """
         print(f"Attempting to render {filename_base}.asy...")
-        
-        # Asymptote works best when run from the target directory
-        original_cwd = os.getcwd()
+        timeout = self.COMPILE_TIMEOUT if timeout is None else timeout
+
+        os.makedirs(output_dir, exist_ok=True)
         asy_filepath = os.path.join(output_dir, f"{filename_base}.asy")
-        
-        try:
-            os.makedirs(output_dir, exist_ok=True)
-            
-            with open(asy_filepath, "w") as f:
+        pdf_filepath = os.path.join(output_dir, f"{filename_base}.pdf")
+
+        # The scratch directory lives inside output_dir so os.replace stays on one filesystem.
+        with tempfile.TemporaryDirectory(dir=output_dir, prefix=f".{filename_base}-") as work_dir:
+            work_asy = os.path.join(work_dir, f"{filename_base}.asy")
+            work_pdf = os.path.join(work_dir, f"{filename_base}.pdf")
+            with open(work_asy, "w") as f:
                 f.write(asy_code)
 
-            os.chdir(output_dir)
-            
-            # Run asymptote, which will produce a .tex file for inclusion
-            result = subprocess.run(
-                ['asy', '-f', 'pdf', f'{filename_base}.asy'],
-                capture_output=True,
-                text=True,
-                check=True # Raises CalledProcessError on non-zero exit codes
-            )
-            print(f"Successfully rendered {filename_base}.pdf.")
-            return True
-        except FileNotFoundError:
-            print("\n---")
-            print("ERROR: The 'asy' command was not found.")
-            print("Please install Asymptote and ensure it is in your system's PATH.")
-            print("---\n")
-            return False
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to compile {filename_base}.asy.")
-            print(f"Stderr: {e.stderr}")
-            return False
-        finally:
-            os.chdir(original_cwd) # Always change back to the original directory
\ No newline at end of file
+            try:
+                cache_key = ResultCache.make_key("asy -f pdf", asy_code)
+                if self.cache.get_file("asy_pdf", cache_key, work_pdf):
+                    os.replace(work_pdf, pdf_filepath)
+                    print(f"Rendered {filename_base}.pdf from cache.")
+                    return CompileResult(True)
+
+                # Run asymptote, which will produce a .pdf file for inclusion
+                with tracer.span("asy.compile", figure=filename_base):
+                    self._run_asy(['asy', '-f', 'pdf', f'{filename_base}.asy'], work_dir, timeout)
+                self.cache.put_file("asy_pdf", cache_key, work_pdf)
+                os.replace(work_pdf, pdf_filepath)
+                print(f"Successfully rendered {filename_base}.pdf.")
+                return CompileResult(True)
+            except (FileNotFoundError, subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
+                return self._report_failure(e, asy_code, filename_base, timeout)
+            finally:
+                # Keep the latest source next to its output, even when it failed to compile.
+                os.replace(work_asy, asy_filepath)
+
+    async def compile_asymptote_async(
+        self, asy_code: str, output_dir: str, filename_base: str, timeout: float | None = None
+    ) -> CompileResult:
+        """
+        Async form of `compile_asymptote`.
+
+        `asy` runs as an asyncio subprocess, so waiting on it needs no thread.
+        """
+        print(f"Attempting to render {filename_base}.asy...")
+        timeout = self.COMPILE_TIMEOUT if timeout is None else timeout
+
+        os.makedirs(output_dir, exist_ok=True)
+        asy_filepath = os.path.join(output_dir, f"{filename_base}.asy")
+        pdf_filepath = os.path.join(output_dir, f"{filename_base}.pdf")
+
+        with tempfile.TemporaryDirectory(dir=output_dir, prefix=f".{filename_base}-") as work_dir:
+            work_asy = os.path.join(work_dir, f"{filename_base}.asy")
+            work_pdf = os.path.join(work_dir, f"{filename_base}.pdf")
+            async with aiofiles.open(work_asy, "w") as f:
+                await f.write(asy_code)
+
+            try:
+                cache_key = ResultCache.make_key("asy -f pdf", asy_code)
+                if await asyncio.to_thread(self.cache.get_file, "asy_pdf", cache_key, work_pdf):
+                    os.replace(work_pdf, pdf_filepath)
+                    print(f"Rendered {filename_base}.pdf from cache.")
+                    return CompileResult(True)
+
+                with tracer.span("asy.compile", figure=filename_base):
+                    await self._run_asy_async(['asy', '-f', 'pdf', f'{filename_base}.asy'], work_dir, timeout)
+                await asyncio.to_thread(self.cache.put_file, "asy_pdf", cache_key, work_pdf)
+                os.replace(work_pdf, pdf_filepath)
+                print(f"Successfully rendered {filename_base}.pdf.")
+                return CompileResult(True)
+            except (FileNotFoundError, subprocess.TimeoutExpired, subprocess.CalledProcessError) as e:
+                return self._report_failure(e, asy_code, filename_base, timeout)
+            finally:
+                os.replace(work_asy, asy_filepath)
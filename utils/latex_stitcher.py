@@ -0,0 +1,86 @@
+# utils/latex_stitcher.py
+"""Combines LaTeX documents generated for separate page ranges into one document."""
+import re
+
+PLACEHOLDER_RE = re.compile(r"%%FIGURE_PLACEHOLDER_(\d+)%%")
+
+BEGIN_DOCUMENT = "\\begin{document}"
+END_DOCUMENT = "\\end{document}"
+
+
+def split_document(latex: str) -> tuple[str, str]:
+    """
+    Splits a LaTeX document into its preamble and body.
+
+    Returns:
+        (preamble, body). The preamble is empty if there is no \\begin{document}.
+    """
+    start = latex.find(BEGIN_DOCUMENT)
+    if start == -1:
+        return "", latex.strip()
+
+    preamble = latex[:start].strip()
+    body = latex[start + len(BEGIN_DOCUMENT):]
+    end = body.rfind(END_DOCUMENT)
+    if end != -1:
+        body = body[:end]
+    return preamble, body.strip()
+
+
+def renumber_placeholders(body: str, offset: int, figure_count: int, shard_index: int) -> str:
+    """
+    Shifts %%FIGURE_PLACEHOLDER_n%% indices by `offset`.
+
+    Placeholders beyond the `figure_count` figures detected for this shard are
+    renamed so they cannot collide with the next shard's figures.
+    """
+    def _replace(match):
+        n = int(match.group(1))
+        if n > figure_count:
+            return f"%%FIGURE_PLACEHOLDER_UNMATCHED_{shard_index + 1}_{n}%%"
+        return f"%%FIGURE_PLACEHOLDER_{n + offset}%%"
+
+    return PLACEHOLDER_RE.sub(_replace, body)
+
+
+def merge_preambles(preambles: list[str]) -> str:
+    """Uses the first non-empty preamble and appends any \\usepackage lines it is missing."""
+    base = next((p for p in preambles if p), "\\documentclass{article}")
+    lines = base.split("\n")
+    seen = {line.strip() for line in lines}
+    for preamble in preambles:
+        for line in preamble.split("\n"):
+            if line.strip().startswith("\\usepackage") and line.strip() not in seen:
+                lines.append(line.strip())
+                seen.add(line.strip())
+    return "\n".join(lines)
+
+
+def stitch_documents(documents: list[str], figure_counts: list[int]) -> str:
+    """
+    Stitches per-shard LaTeX documents together under a single preamble.
+
+    Args:
+        documents: One complete LaTeX document per shard, in page order.
+        figure_counts: Number of figures detected in each shard. Shard k's
+            placeholder n becomes n + sum(figure_counts[:k]), which lines it up
+            with the global, flattened list of figures.
+
+    Returns:
+        A single LaTeX document with globally numbered figure placeholders.
+    """
+    preambles = []
+    bodies = []
+    offset = 0
+    for index, (document, figure_count) in enumerate(zip(documents, figure_counts)):
+        preamble, body = split_document(document)
+        preambles.append(preamble)
+        bodies.append(renumber_placeholders(body, offset, figure_count, index))
+        offset += figure_count
+
+    return (
+        merge_preambles(preambles)
+        + f"\n\n{BEGIN_DOCUMENT}\n\n"
+        + "\n\n".join(bodies)
+        + f"\n\n{END_DOCUMENT}\n"
+    )
@@ -0,0 +1,24 @@
+# utils/limits.py
+"""
+Process-wide concurrency limits shared by every job.
+
+LLM calls, `asy` and `pdflatex` processes are capped globally rather than per
+job, so a burst of uploads queues for a slot instead of stampeding the API or the CPU.
+
+Every limit is a single PriorityGate shared by threads and every event loop,
+so the threaded pipeline, the async API path and any extra loops draw from one
+quota, and interactive jobs get the next free slot ahead of batch work.
+Coroutines wait for a slot with `slot_async()`, which holds no thread.
+"""
+import os
+
+from utils.rate_limit import PriorityGate
+
+MAX_LLM_CALLS = int(os.getenv("TEXIFY_MAX_LLM_CALLS", "8"))
+MAX_ASY_PROCESSES = int(os.getenv("TEXIFY_MAX_ASY_PROCESSES", str(os.cpu_count() or 2)))
+MAX_LATEX_PROCESSES = int(os.getenv("TEXIFY_MAX_LATEX_PROCESSES", str(os.cpu_count() or 2)))
+MAX_FIGURE_WORKERS = int(os.getenv("TEXIFY_MAX_FIGURE_WORKERS", "4"))
+
+llm_slots = PriorityGate(MAX_LLM_CALLS)
+asy_slots = PriorityGate(MAX_ASY_PROCESSES)
+latex_slots = PriorityGate(MAX_LATEX_PROCESSES)
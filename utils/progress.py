@@ -0,0 +1,55 @@
+# utils/progress.py
+"""
+Wake-ups for job progress streams.
+
+Progress events themselves are stored in the JobStore, so a stream served by
+any worker process can replay and follow any job. The hub only shortens the
+wait: when a job running in this process publishes an event, streams
+following it are woken immediately instead of at their next poll.
+"""
+import asyncio
+import threading
+from contextlib import contextmanager
+
+
+class ProgressHub:
+    """Lets event-loop subscribers wait for a job's next event. `notify` may be called from any thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # job id -> set of (loop, asyncio.Event)
+        self._subscribers = {}
+
+    @contextmanager
+    def subscribe(self, job_id: str):
+        """
+        Registers the calling coroutine for wake-ups and yields its asyncio.Event.
+
+        Clear the event before reading new events from the store, then wait on
+        it; a notification between the read and the wait is not lost.
+        """
+        entry = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._subscribers.setdefault(job_id, set()).add(entry)
+        try:
+            yield entry[1]
+        finally:
+            with self._lock:
+                subscribers = self._subscribers.get(job_id)
+                subscribers.discard(entry)
+                if not subscribers:
+                    del self._subscribers[job_id]
+
+    def notify(self, job_id: str) -> None:
+        """Wakes every subscriber of `job_id`."""
+        with self._lock:
+            subscribers = list(self._subscribers.get(job_id, ()))
+        for loop, event in subscribers:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # The subscriber's loop has closed.
+                pass
+
+
+hub = ProgressHub()
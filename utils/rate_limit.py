@@ -0,0 +1,182 @@
+# utils/rate_limit.py
+"""
+Rate limiting primitives shared by threads and event loops.
+
+A TokenBucket paces requests or tokens per minute. A PriorityGate caps
+concurrency like a semaphore, but hands free slots to the most urgent waiter
+first. Both work the same for threads and for coroutines on any event loop,
+so the threaded and the async pipeline draw from one shared budget.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+# Priority lanes: lower values are served first.
+INTERACTIVE, BATCH = 0, 1
+
+# The lane of the LLM calls and asy/pdflatex runs made in the current context.
+# Set it to BATCH around bulk work so interactive requests overtake it; threads
+# started with submit_with_context and tasks inherit it.
+llm_priority = contextvars.ContextVar("llm_priority", default=INTERACTIVE)
+
+
+class TokenBucket:
+    """
+    Paces a quantity (requests, tokens) to a rate per minute.
+
+    Callers reserve what they are about to use and wait for the returned
+    delay. Reservations may overdraw the bucket, so concurrent callers queue
+    up in reservation order instead of all retrying at once.
+    """
+
+    def __init__(self, per_minute: float):
+        """
+        Args:
+            per_minute: Sustained rate, which is also the burst size. 0 disables the limit.
+        """
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """Takes `amount` from the bucket and returns the seconds to wait before using it."""
+        if not self.capacity:
+            return 0.0
+        with self._lock:
+            self._refill()
+            # A single request larger than the bucket waits for a full bucket, not forever.
+            self._tokens -= min(amount, self.capacity)
+            return max(0.0, -self._tokens / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        """Corrects an earlier reservation by `amount`; negative values give tokens back."""
+        if not self.capacity:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+    def drain(self) -> None:
+        """Empties the bucket, e.g. after the server said the limit was hit."""
+        if not self.capacity:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0)
+
+
+class _Waiter:
+    __slots__ = ("wake", "granted", "abandoned")
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+        self.abandoned = False
+
+
+class PriorityGate:
+    """
+    A counting semaphore whose free slots go to the waiter with the lowest
+    priority value, then the longest-waiting one.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._active = 0
+        self._waiters = []  # heap of (priority, sequence, _Waiter)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def _enqueue(self, priority: int, wake) -> _Waiter | None:
+        """Takes a slot right away if one is free and nobody is queued; otherwise queues a waiter."""
+        with self._lock:
+            if self._active < self.limit and not self._waiters:
+                self._active += 1
+                return None
+            waiter = _Waiter(wake)
+            heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+            return waiter
+
+    def _grant(self) -> None:
+        """Hands free slots to queued waiters. Call with the lock held."""
+        while self._active < self.limit and self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.abandoned:
+                continue
+            waiter.granted = True
+            self._active += 1
+            try:
+                waiter.wake()
+            except RuntimeError:
+                # The waiter's event loop has closed; it will never use the slot.
+                self._active -= 1
+
+    def _abandon(self, waiter: _Waiter) -> None:
+        """Withdraws a waiter that gave up, returning its slot if it was granted meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                self._active -= 1
+                self._grant()
+            else:
+                waiter.abandoned = True
+
+    def release(self) -> None:
+        with self._lock:
+            self._active -= 1
+            self._grant()
+
+    def acquire(self, priority: int | None = None) -> None:
+        """Blocks until a slot is free. `priority` defaults to the context's `llm_priority`."""
+        event = threading.Event()
+        waiter = self._enqueue(llm_priority.get() if priority is None else priority, event.set)
+        if waiter is None:
+            return
+        try:
+            event.wait()
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    async def acquire_async(self, priority: int | None = None) -> None:
+        """Waits for a slot on the running loop without holding a thread."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enqueue(llm_priority.get() if priority is None else priority, wake)
+        if waiter is None:
+            return
+        try:
+            await future
+        except BaseException:
+            self._abandon(waiter)
+            raise
+
+    @contextmanager
+    def slot(self, priority: int | None = None):
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot_async(self, priority: int | None = None):
+        await self.acquire_async(priority)
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,193 @@
+# utils/result_cache.py
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+
+class ResultCache:
+    """An on-disk, content-addressed cache with size-bounded LRU eviction."""
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        Args:
+            cache_dir: Directory in which cache entries are stored.
+            max_bytes: Total size the cache may grow to before the least
+                recently used entries are evicted.
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._total_bytes = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        """
+        Hashes an ordered sequence of str/bytes parts into a cache key.
+
+        Each part is length-prefixed so that ("ab", "c") and ("a", "bc") differ.
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            digest.update(len(part).to_bytes(8, "big"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _path(self, namespace: str, key: str) -> str:
+        return os.path.join(self.cache_dir, namespace, key[:2], key)
+
+    def _entries(self):
+        """Yields (path, mtime, size) for every entry in the cache."""
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.startswith(".tmp-"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def _record(self, namespace: str, hit: bool) -> None:
+        counters = self.hits if hit else self.misses
+        with self._lock:
+            counters[namespace] = counters.get(namespace, 0) + 1
+
+    def get(self, namespace: str, key: str) -> bytes | None:
+        """Returns the cached bytes for `key`, or None on a miss."""
+        path = self._path(namespace, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Bump the mtime so eviction treats this entry as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            self._record(namespace, hit=False)
+            return None
+        self._record(namespace, hit=True)
+        return data
+
+    def put(self, namespace: str, key: str, data: bytes) -> None:
+        """Atomically stores `data` under `key` and evicts old entries if needed."""
+        path = self._path(namespace, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+        with self._lock:
+            try:
+                self._total_bytes -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+            self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        """Deletes least recently used entries until the cache is at 90% of its limit."""
+        target = int(self.max_bytes * 0.9)
+        for path, _, size in sorted(self._entries(), key=lambda entry: entry[1]):
+            if self._total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+                self._total_bytes -= size
+            except FileNotFoundError:
+                pass
+
+    def get_json(self, namespace: str, key: str):
+        data = self.get(namespace, key)
+        return None if data is None else json.loads(data)
+
+    def put_json(self, namespace: str, key: str, value) -> None:
+        self.put(namespace, key, json.dumps(value).encode("utf-8"))
+
+    def get_file(self, namespace: str, key: str, dest_path: str) -> bool:
+        """Copies the cached entry for `key` to `dest_path`. Returns True on a hit."""
+        data = self.get(namespace, key)
+        if data is None:
+            return False
+        with open(dest_path, "wb") as f:
+            f.write(data)
+        return True
+
+    def put_file(self, namespace: str, key: str, src_path: str) -> None:
+        with open(src_path, "rb") as f:
+            self.put(namespace, key, f.read())
+
+    def clear(self) -> None:
+        with self._lock:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._total_bytes = 0
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters per namespace and the current cache size."""
+        with self._lock:
+            namespaces = sorted(set(self.hits) | set(self.misses))
+            return {
+                "size_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "namespaces": {
+                    ns: {"hits": self.hits.get(ns, 0), "misses": self.misses.get(ns, 0)}
+                    for ns in namespaces
+                },
+            }
+
+
+class NullCache(ResultCache):
+    """A cache that never stores anything, used when caching is disabled."""
+
+    def __init__(self):
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+        self._total_bytes = 0
+        self.max_bytes = 0
+
+    def get(self, namespace: str, key: str) -> bytes | None:
+        self._record(namespace, hit=False)
+        return None
+
+    def put(self, namespace: str, key: str, data: bytes) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache() -> ResultCache:
+    """
+    Returns the process-wide cache configured from the environment.
+
+    TEXIFY_CACHE_DIR sets the location (default '.cache/texify'),
+    TEXIFY_CACHE_MAX_MB the size limit (default 512) and
+    TEXIFY_CACHE_DISABLED=1 turns caching off.
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            if os.getenv("TEXIFY_CACHE_DISABLED", "") in ("1", "true", "yes"):
+                _default_cache = NullCache()
+            else:
+                _default_cache = ResultCache(
+                    os.getenv("TEXIFY_CACHE_DIR", os.path.join(".cache", "texify")),
+                    max_bytes=int(os.getenv("TEXIFY_CACHE_MAX_MB", "512")) * 1024 * 1024,
+                )
+        return _default_cache
@@ -0,0 +1,172 @@
+# utils/stage_graph.py
+import asyncio
+import inspect
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from utils.tracing import submit_with_context, tracer
+
+
+class StageGraph:
+    """A small dependency-graph executor that runs independent stages concurrently."""
+
+    def __init__(self, max_workers: int | None = None, on_event=None):
+        """
+        Args:
+            max_workers: Maximum number of stages allowed to run at the same time.
+            on_event: Optional callback, called as on_event(stage, state, seconds, error)
+                with state 'running' when a stage starts and 'done' or 'failed'
+                when it ends. Exceptions it raises are printed and ignored.
+        """
+        self.max_workers = max_workers
+        self.on_event = on_event
+        self._stages = {}
+        self.results = {}
+        self.timings = {}
+
+    def add_stage(self, name: str, fn, deps: tuple[str, ...] = ()) -> None:
+        """
+        Registers a stage in the graph.
+
+        Args:
+            name: Unique name of the stage.
+            fn: Callable invoked with the results of `deps` as positional arguments.
+                Under `run_async` it may also be a coroutine function.
+            deps: Names of stages that must finish before this one starts.
+        """
+        if name in self._stages:
+            raise ValueError(f"Stage '{name}' is already registered.")
+        for dep in deps:
+            if dep not in self._stages:
+                raise ValueError(f"Stage '{name}' depends on unknown stage '{dep}'.")
+        self._stages[name] = (fn, tuple(deps))
+
+    def _emit(self, name: str, state: str, seconds: float | None = None, error: BaseException | None = None) -> None:
+        if self.on_event is None:
+            return
+        try:
+            self.on_event(name, state, seconds, f"{type(error).__name__}: {error}" if error else None)
+        except Exception as e:
+            print(f"Stage event handler failed for '{name}': {e}")
+
+    def _finish_stage(self, name: str, start: float, error: BaseException | None) -> None:
+        self.timings[name] = time.perf_counter() - start
+        self._emit(name, "failed" if error else "done", self.timings[name], error)
+
+    def _run_stage(self, name: str):
+        fn, deps = self._stages[name]
+        start = time.perf_counter()
+        self._emit(name, "running")
+        error = None
+        try:
+            with tracer.span(f"stage.{name}"):
+                return fn(*[self.results[dep] for dep in deps])
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._finish_stage(name, start, error)
+
+    async def _run_stage_async(self, name: str):
+        fn, deps = self._stages[name]
+        args = [self.results[dep] for dep in deps]
+        start = time.perf_counter()
+        self._emit(name, "running")
+        error = None
+        try:
+            with tracer.span(f"stage.{name}"):
+                if inspect.iscoroutinefunction(fn):
+                    result = await fn(*args)
+                else:
+                    # Plain callables may block, so they run in a worker thread.
+                    result = await asyncio.to_thread(fn, *args)
+                # Lambdas wrapping a coroutine function return the coroutine.
+                if inspect.isawaitable(result):
+                    result = await result
+                return result
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._finish_stage(name, start, error)
+
+    def run(self) -> dict:
+        """
+        Runs every stage as soon as all of its dependencies have completed.
+
+        Returns:
+            A dict mapping stage names to their results.
+
+        Raises:
+            The first exception raised by any stage. Stages that have not started yet are skipped.
+        """
+        pending = dict(self._stages)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                ready = [
+                    name for name, (_, deps) in pending.items()
+                    if all(dep in self.results for dep in deps)
+                ]
+                for name in ready:
+                    del pending[name]
+                    running[submit_with_context(executor, self._run_stage, name)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception:
+                        pending.clear()
+                        for other in running:
+                            other.cancel()
+                        raise
+
+        return self.results
+
+    async def run_async(self) -> dict:
+        """
+        Runs the graph as tasks on the current event loop. Behaves like `run`.
+
+        Coroutine stages are awaited on the loop; plain callables run in the
+        loop's default executor. `max_workers` limits concurrent stages here too.
+        Stages still running when another fails are cancelled.
+        """
+        pending = dict(self._stages)
+        running = {}
+        slots = asyncio.Semaphore(self.max_workers or len(self._stages) or 1)
+
+        async def run_stage(name: str):
+            async with slots:
+                return await self._run_stage_async(name)
+
+        try:
+            while pending or running:
+                ready = [
+                    name for name, (_, deps) in pending.items()
+                    if all(dep in self.results for dep in deps)
+                ]
+                for name in ready:
+                    del pending[name]
+                    running[asyncio.create_task(run_stage(name))] = name
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    self.results[name] = task.result()
+        except BaseException:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            raise
+
+        return self.results
+
+    def report(self) -> None:
+        """Prints the wall-clock duration of every completed stage."""
+        print("\n--- Stage Timings ---")
+        for name in self._stages:
+            if name in self.timings:
+                print(f"  {name:<15} {self.timings[name]:7.2f}s")
@@ -0,0 +1,198 @@
+# utils/tracing.py
+"""
+Per-stage spans and Prometheus-style metrics.
+
+Every span records its duration, job id and attributes (token counts, retry
+counts, ...). Completed spans feed a histogram per span name, so the API can
+expose where latency goes through /metrics without parsing interleaved logs.
+"""
+import bisect
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+current_job_id = contextvars.ContextVar("current_job_id", default=None)
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def submit_with_context(executor, fn, *args):
+    """Submits `fn` to `executor` so it runs with the caller's job id and other context."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+class MetricsRegistry:
+    """Thread-safe counters, gauges and histograms rendered in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._values = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _labels_key(labels: dict) -> tuple:
+        return tuple(sorted(labels.items()))
+
+    def _declare(self, name: str, kind: str, help_text: str) -> None:
+        self._types.setdefault(name, kind)
+        if help_text:
+            self._help.setdefault(name, help_text)
+
+    def inc(self, name: str, value: float = 1.0, help_text: str = "", **labels) -> None:
+        with self._lock:
+            self._declare(name, "counter", help_text)
+            key = (name, self._labels_key(labels))
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, help_text: str = "", **labels) -> None:
+        with self._lock:
+            self._declare(name, "gauge", help_text)
+            self._values[(name, self._labels_key(labels))] = float(value)
+
+    def observe(self, name: str, value: float, help_text: str = "", buckets=DEFAULT_BUCKETS, **labels) -> None:
+        with self._lock:
+            self._declare(name, "histogram", help_text)
+            key = (name, self._labels_key(labels))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    "buckets": tuple(buckets),
+                    "counts": [0] * len(buckets),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            index = bisect.bisect_left(histogram["buckets"], value)
+            if index < len(histogram["counts"]):
+                histogram["counts"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @staticmethod
+    def _format_labels(labels) -> str:
+        if not labels:
+            return ""
+        escaped = (
+            (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in labels
+        )
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name in sorted(self._types):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {self._types[name]}")
+
+                for (metric, labels), value in sorted(self._values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {value:g}")
+
+                for (metric, labels), histogram in sorted(self._histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                        cumulative += count
+                        bucket_labels = labels + (("le", f"{bound:g}"),)
+                        lines.append(f"{name}_bucket{self._format_labels(bucket_labels)} {cumulative}")
+                    inf_labels = labels + (("le", "+Inf"),)
+                    lines.append(f"{name}_bucket{self._format_labels(inf_labels)} {histogram['count']}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {histogram['sum']:g}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+class Span:
+    """A single timed operation. Use `set` to attach attributes such as token counts."""
+
+    def __init__(self, name: str, job_id, attributes: dict):
+        self.name = name
+        self.job_id = job_id
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.status = "ok"
+        self.error = None
+
+    def set(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "job_id": self.job_id,
+            "start": self.start,
+            "duration": self.duration,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    """Records spans for pipeline stages and feeds their durations into metrics."""
+
+    def __init__(self, registry: MetricsRegistry, max_spans: int = 5000):
+        self.registry = registry
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Times the enclosed block as a span named `name`.
+
+        The job id is taken from `current_job_id`. Exceptions are recorded on
+        the span and re-raised.
+        """
+        span = Span(name, current_job_id.get(), dict(attributes))
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error"
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            with self._lock:
+                self._spans.append(span)
+            self.registry.observe(
+                "texify_span_duration_seconds",
+                span.duration,
+                help_text="Duration of pipeline spans.",
+                span=name,
+                status=span.status,
+            )
+
+    def record_tokens(self, span: Span, response) -> None:
+        """Copies Gemini usage metadata from `response` onto `span` and the token counters."""
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return
+        for direction, field in (("input", "prompt_token_count"), ("output", "candidates_token_count")):
+            count = getattr(usage, field, None) or 0
+            span.set(f"{direction}_tokens", count)
+            self.registry.inc(
+                "texify_llm_tokens_total",
+                count,
+                help_text="Tokens sent to and received from the LLM.",
+                span=span.name,
+                direction=direction,
+            )
+
+    def spans_for(self, job_id) -> list[dict]:
+        """Returns the recorded spans of one job, oldest first."""
+        with self._lock:
+            return [span.to_dict() for span in self._spans if span.job_id == job_id]
+
+
+metrics = MetricsRegistry()
+tracer = Tracer(metrics)